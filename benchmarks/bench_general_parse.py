@@ -0,0 +1,42 @@
+import os.path
+import sys
+import time
+import argparse
+
+# Run from the repo root or from benchmarks/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from variables import raw_file
+from functions_parse import general_parse, general_parse_fast
+from generate_data import synthetic_sumtotal
+
+
+# Best of n wall times
+def best_of(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--rows", help="Rows in the synthetic feed", type=int, default=1000000)
+    parser.add_argument("-n", "--repeat", help="Repetitions per parser", type=int, default=3)
+    args = parser.parse_args()
+
+    feed = synthetic_sumtotal(args.rows)
+
+    # fileType xlsx skips the 200-day window so both parsers keep the same rows
+    file_instance = raw_file(path='', name='synthetic.csv', csv_true='True', nickname='tracorp', delimiter=',',
+                             fileType='xlsx', date_format='%m/%d/%Y %H:%M')
+
+    slow, df_slow = best_of(lambda: general_parse(feed, file_instance), args.repeat)
+    fast, df_fast = best_of(lambda: general_parse_fast(feed, file_instance), args.repeat)
+
+    print(f"rows: {args.rows}")
+    print(f"general_parse:      {slow:.3f}s ({len(df_slow.index)} rows out)")
+    print(f"general_parse_fast: {fast:.3f}s ({len(df_fast.index)} rows out)")
+    print(f"speedup: {slow / fast:.1f}x")
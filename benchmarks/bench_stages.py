@@ -0,0 +1,148 @@
+import os.path
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+import argparse
+from datetime import datetime
+
+# Run from the repo root or from benchmarks/
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..'))
+
+import variables
+from variables import raw_file, catalog_settings
+from functions_parse import general_parse, general_parse_fast, dfs_merge, final_parse, template_parse
+from functions_catalog import activity_catalog, filter_active_activities
+from functions_in_out import export_csv, export_txt, export_files
+from generate_data import synthetic_sumtotal, synthetic_completions_xlsx, synthetic_merged
+
+import pandas as pd
+
+
+baseline_file = os.path.join(bench_dir, 'baseline.json')
+results_dir = os.path.join(bench_dir, 'results')
+
+
+# Best-of-n wall time plus peak traced memory of one extra run
+def measure(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': round(min(times), 4), 'peak_mb': round(peak / 2**20, 1)}
+
+
+# Benchmarks for one feed size
+def bench_size(rows, repeat, work_dir):
+    sumtotal = synthetic_sumtotal(rows)
+    xlsx = synthetic_completions_xlsx(min(rows, 1048575))
+    merged = synthetic_merged(rows)
+
+    file_csv = raw_file(path='', name='sumTotal.csv', csv_true='True', nickname='tracorp', delimiter=',',
+                        fileType='csv', date_format='%m/%d/%Y %H:%M')
+
+    # general_parse compares object dates against a datetime cutoff on csv feeds, so the
+    # before/after comparison runs both parsers without the 200-day window
+    file_nowindow = raw_file(path='', name='sumTotal.csv', csv_true='True', nickname='tracorp', delimiter=',',
+                             fileType='xlsx', date_format='%m/%d/%Y %H:%M')
+    file_xlsx = raw_file(path='', name='Successful_TraCorp_Completions.xlsx', csv_true='False', nickname='xlsx_report',
+                         delimiter='', fileType='xlsx')
+    file_out_csv = raw_file(path=os.path.join(work_dir, 'toSumtotal.csv'), name='toSumtotal.csv', csv_true='True',
+                            nickname='sumTotal_modified', delimiter=',', fileType='csv')
+    file_out_tmp = raw_file(path=os.path.join(work_dir, 'tmp_csv_pipes.csv'), name='tmp_csv_pipes.csv', csv_true='True',
+                            nickname='tmp_sumTotal_modified', delimiter=',', fileType='csv')
+    file_out_txt = raw_file(path=os.path.join(work_dir, 'TracorpTraining.txt'), name='TracorpTraining.txt', csv_true='False',
+                            nickname='TracorpTraining.txt', delimiter='', fileType='txt')
+
+    parsed = general_parse_fast(sumtotal, file_csv)
+    catalog = activity_catalog(catalog_settings(source='list', path='', query='', ttl=3600))
+    catalog.refresh()
+    df_active_activities = pd.DataFrame(variables.active_activities)
+    final = final_parse(merged)
+    template_final = template_parse(merged, variables.sumtotal_template)
+
+    # export_txt deletes its input, so each run writes the tmp csv first
+    def export_both():
+        export_csv(final, file_out_tmp)
+        export_txt(file_out_tmp, file_out_txt)
+
+    stages = {
+        'general_parse': lambda: general_parse(sumtotal, file_nowindow),
+        'general_parse_fast': lambda: general_parse_fast(sumtotal, file_nowindow),
+        'general_parse_fast_window': lambda: general_parse_fast(sumtotal, file_csv),
+        'general_parse_fast_xlsx': lambda: general_parse_fast(xlsx, file_xlsx),
+        'dfs_merge': lambda: dfs_merge(parsed, df_active_activities),
+        'filter_active_activities': lambda: filter_active_activities(parsed, catalog),
+        'final_parse': lambda: final_parse(merged),
+        'template_parse': lambda: template_parse(merged, variables.sumtotal_template),
+        'export_csv': lambda: export_csv(final, file_out_csv),
+        'export_csv_txt': export_both,
+        'export_files': lambda: export_files(final, file_out_csv, file_out_txt),
+        'export_files_template': lambda: export_files(template_final, file_out_csv, file_out_txt,
+                                                      template=variables.sumtotal_template)}
+
+    results = {}
+    for name, function in stages.items():
+        results[name] = measure(function, repeat)
+        print(f"{rows:>9} {name:<26} {results[name]['seconds']:>9.3f}s {results[name]['peak_mb']:>9.1f} MB")
+
+    return results
+
+
+# Print the change against the stored baseline
+def compare(results, baseline, threshold):
+    regressions = 0
+    for size, stages in results.items():
+        for name, result in stages.items():
+            base = baseline.get(size, {}).get(name)
+            if not base or not base['seconds']:
+                continue
+            ratio = result['seconds'] / base['seconds']
+            flag = "REGRESSION" if ratio > 1 + threshold else ""
+            regressions += bool(flag)
+            print(f"{size:>9} {name:<26} {base['seconds']:>9.3f}s -> {result['seconds']:>9.3f}s ({ratio:5.2f}x) {flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and memory-measure the transform stages")
+    parser.add_argument("-s", "--sizes", help="Feed sizes in rows (10k - 10M)", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("-n", "--repeat", help="Timed repetitions per stage", type=int, default=3)
+    parser.add_argument("--save-baseline", help="Store these results as the baseline", action="store_true")
+    parser.add_argument("--threshold", help="Slowdown vs baseline reported as a regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Keep the library's own logging out of the timings
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for rows in args.sizes:
+            results[str(rows)] = bench_size(rows, args.repeat, work_dir)
+
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    results_file = os.path.join(results_dir, datetime.now().strftime("%Y%m%d%H%M%S") + ".json")
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results: {results_file}")
+
+    if args.save_baseline:
+        with open(baseline_file, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved: {baseline_file}")
+
+    elif os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        sys.exit(1 if regressions else 0)
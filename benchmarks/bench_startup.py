@@ -0,0 +1,88 @@
+import os.path
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import statistics
+import subprocess
+from datetime import datetime
+
+# Run from the repo root or from benchmarks/
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.abspath(os.path.join(bench_dir, '..'))
+main_script = os.path.join(repo_dir, 'main.py')
+results_dir = os.path.join(bench_dir, 'results')
+
+
+# Startup budget per command: median wall seconds, and modules the command must not import
+budgets = {
+    'help': {'args': ['--help'], 'seconds': 0.5, 'forbidden': ['pandas', 'numpy', 'pyodbc', 'paramiko']},
+    'check_config': {'args': ['--check-config'], 'seconds': 0.5, 'forbidden': ['pandas', 'numpy', 'pyodbc', 'paramiko']},
+    'dry_run': {'args': ['--dry-run'], 'seconds': 3.0, 'forbidden': ['pyodbc', 'paramiko']}}
+
+
+# Median wall time of n runs, plus the packages one -X importtime run loaded
+def measure(command_args, repeat, work_dir, config):
+    command = [sys.executable, main_script, '-p', work_dir, '-c', config] + command_args
+
+    times = []
+    returncode = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        returncode = subprocess.run(command, cwd=work_dir, capture_output=True).returncode
+        times.append(time.perf_counter() - start)
+
+    # importtime lines: "import time: self [us] | cumulative | imported package" (self times add up to the total)
+    trace = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:], cwd=work_dir, capture_output=True, text=True)
+    modules = {}
+    for line in trace.stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[0].strip().isdigit():
+            package = fields[2].strip().split('.')[0]
+            modules[package] = modules.get(package, 0) + int(fields[0])
+
+    return {'seconds': round(statistics.median(times), 3), 'returncode': returncode,
+            'import_ms': round(sum(modules.values()) / 1000, 1), 'modules': sorted(modules)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check CLI startup time against the per-command budget")
+    parser.add_argument("-n", "--repeat", help="Runs per command", type=int, default=5)
+    parser.add_argument("-c", "--config", help="Configuration file to start with", default=os.path.join(repo_dir, 'config.ini'))
+    parser.add_argument("--commands", help="Commands to measure", nargs="+", choices=list(budgets), default=list(budgets))
+    args = parser.parse_args()
+
+    results = {}
+    over_budget = 0
+    work_dir = tempfile.mkdtemp()
+    try:
+        for name in args.commands:
+            budget = budgets[name]
+            result = measure(budget['args'], args.repeat, work_dir, os.path.abspath(args.config))
+            loaded = [module for module in budget['forbidden'] if module in result['modules']]
+
+            flags = []
+            if result['returncode'] != 0:
+                flags.append(f"exit {result['returncode']}")
+            if result['seconds'] > budget['seconds']:
+                flags.append(f"OVER BUDGET ({budget['seconds']}s)")
+            if loaded:
+                flags.append(f"IMPORTED {', '.join(loaded)}")
+            over_budget += bool(flags)
+
+            result['loaded_forbidden'] = loaded
+            results[name] = result
+            print(f"{name:<14} {result['seconds']:>7.3f}s  imports {result['import_ms']:>8.1f} ms  {' '.join(flags)}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    results_file = os.path.join(results_dir, "startup_" + datetime.now().strftime("%Y%m%d%H%M%S") + ".json")
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results: {results_file}")
+
+    sys.exit(1 if over_budget else 0)
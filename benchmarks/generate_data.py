@@ -0,0 +1,100 @@
+import os.path
+import sys
+import numpy as np
+import pandas as pd
+import argparse
+
+# Run from the repo root or from benchmarks/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from variables import active_activities
+
+
+# Excel's row limit - larger xlsx reports are capped
+xlsx_max_rows = 1048575
+
+# Inactive codes mixed into the feeds (roughly 1 row in 10)
+inactive_activities = ["ADOLD100", "ADOLD200", "SAFETY01", "SAFETY02", "TRVPOL2019", "HRIS0001"]
+
+
+# Shared pieces of both feeds: rows with realistic cardinalities and duplicates
+def synthetic_rows(rows, seed=0, employees=20000, duplicate_rate=0.3, days=400):
+    rng = np.random.default_rng(seed)
+
+    # Draw unique completions, then re-send a share of them (TraCorp re-exports history)
+    unique_rows = max(int(rows * (1 - duplicate_rate)), 1)
+    codes = np.array(active_activities['ActivityCode'] + inactive_activities)
+    weights = np.where(np.isin(codes, inactive_activities), 0.15, 1.0)
+    weights = weights / weights.sum()
+
+    employee = rng.integers(0, employees, unique_rows)
+    activity = rng.choice(codes, unique_rows, p=weights)
+    completion = pd.Timestamp.now().normalize() - pd.to_timedelta(rng.integers(0, days, unique_rows), unit='D')
+
+    take = np.concatenate([np.arange(unique_rows), rng.integers(0, unique_rows, rows - unique_rows)])
+    rng.shuffle(take)
+
+    return pd.DataFrame({
+        'employee': employee[take],
+        'Activity Code': activity[take],
+        'Completion Date': completion[take],
+        'Score': rng.choice([100.0, 95.0, 90.0, 80.0, np.nan], rows, p=[0.5, 0.2, 0.15, 0.1, 0.05]),
+        'Status': rng.choice([4, 2, 3], rows, p=[0.9, 0.05, 0.05])})
+
+
+# sumTotal.csv layout
+def synthetic_sumtotal(rows, seed=0, employees=20000, duplicate_rate=0.3):
+    df = synthetic_rows(rows, seed, employees, duplicate_rate)
+    return pd.DataFrame({
+        'Status': df['Status'],
+        'Activity Code': df['Activity Code'],
+        'Completion Date': df['Completion Date'].dt.strftime('%m/%d/%Y %H:%M'),
+        'Score': df['Score'],
+        'Student Email': "  User" + df['employee'].astype(str) + "@AZDOT.gov ",
+        'Student Username': df['employee'] + 100000})
+
+
+# Successful_TraCorp_Completions.xlsx layout
+def synthetic_completions_xlsx(rows, seed=1, employees=20000, duplicate_rate=0.3):
+    df = synthetic_rows(rows, seed, employees, duplicate_rate)
+    return pd.DataFrame({
+        'Activity Code': df['Activity Code'],
+        'Completion Date': df['Completion Date'],
+        'Score': df['Score'],
+        'Student ID': "user" + df['employee'].astype(str) + "@azdot.gov",
+        'Student Username': df['employee'] + 100000})
+
+
+# Merged-row layout (final_parse / export input)
+def synthetic_merged(rows, seed=2, employees=20000):
+    df = synthetic_rows(rows, seed, employees, duplicate_rate=0)
+    return pd.DataFrame({
+        'ActivityCode': df['Activity Code'],
+        'Email': "user" + df['employee'].astype(str) + "@azdot.gov",
+        'EmpID': df['employee'] + 100000,
+        'CompletionDate': df['Completion Date'],
+        'Score': df['Score'].fillna(0).astype(int)})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic sumTotal.csv / completions xlsx files")
+    parser.add_argument("-r", "--rows", help="Rows per file", type=int, default=100000)
+    parser.add_argument("-o", "--output", help="Output directory", default="benchmarks/data")
+    parser.add_argument("-e", "--employees", help="Distinct employees (emails)", type=int, default=20000)
+    parser.add_argument("--duplicate-rate", help="Share of re-sent completions", type=float, default=0.3)
+    parser.add_argument("--xlsx", help="Also write the xlsx report (needs openpyxl)", action="store_true")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    csv_file = os.path.join(args.output, f"sumTotal_{args.rows}.csv")
+    synthetic_sumtotal(args.rows, employees=args.employees, duplicate_rate=args.duplicate_rate).to_csv(csv_file, index=False)
+    print(f"wrote {csv_file}")
+
+    if args.xlsx:
+        xlsx_rows = min(args.rows, xlsx_max_rows)
+        xlsx_file = os.path.join(args.output, f"Successful_TraCorp_Completions_{xlsx_rows}.xlsx")
+        synthetic_completions_xlsx(xlsx_rows, employees=args.employees,
+                                   duplicate_rate=args.duplicate_rate).to_excel(xlsx_file, index=False)
+        print(f"wrote {xlsx_file}")
@@ -0,0 +1,209 @@
+import os.path
+import gzip
+import json
+import shutil
+import logging
+from datetime import datetime, timedelta
+import variables
+from functions_trace import traced
+from functions_in_out import file_sha256
+
+
+
+# zstd when the zstandard package is installed, gzip otherwise
+def archive_codec(compression):
+
+    if compression in ('auto', 'zstd'):
+        try:
+            import zstandard
+            return 'zst'
+        except ImportError:
+            if compression == 'zstd':
+                logging.warning("zstandard is not installed - archiving with gzip")
+
+    return 'gz'
+
+
+def blob_dir(root, file_hash):
+    return os.path.join(root, 'blobs', file_hash[:2])
+
+
+# Existing blob for a hash, in either codec (None if not stored)
+def find_blob(root, file_hash):
+
+    for codec in ('zst', 'gz'):
+        blob = os.path.join(blob_dir(root, file_hash), f"{file_hash}.{codec}")
+        if os.path.exists(blob):
+            return blob
+
+    return None
+
+
+# Compress a file into the blob store unless its content is already there
+def store_blob(root, file, compression='auto'):
+
+    file_hash = file_sha256(file)
+    blob = find_blob(root, file_hash)
+    if blob is not None:
+        logging.debug(f"Archive already holds {os.path.basename(file)} ({file_hash[:12]})")
+        return file_hash, blob, False
+
+    codec = archive_codec(compression)
+    os.makedirs(blob_dir(root, file_hash), exist_ok=True)
+    blob = os.path.join(blob_dir(root, file_hash), f"{file_hash}.{codec}")
+    tmp_blob = blob + ".tmp"
+
+    with open(file, "rb") as source:
+        if codec == 'zst':
+            import zstandard
+            with open(tmp_blob, "wb") as target:
+                zstandard.ZstdCompressor(level=10).copy_stream(source, target)
+        else:
+            with gzip.open(tmp_blob, "wb") as target:
+                shutil.copyfileobj(source, target)
+    os.replace(tmp_blob, blob)
+
+    return file_hash, blob, True
+
+
+# Copy a blob back out to dest
+def restore_blob(root, file_hash, dest):
+
+    blob = find_blob(root, file_hash)
+    if blob is None:
+        raise FileNotFoundError(f"No archived blob for {file_hash}")
+
+    with open(dest, "wb") as target:
+        if blob.endswith('.zst'):
+            import zstandard
+            with open(blob, "rb") as source:
+                zstandard.ZstdDecompressor().copy_stream(source, target)
+        else:
+            with gzip.open(blob, "rb") as source:
+                shutil.copyfileobj(source, target)
+
+    return dest
+
+
+def load_archive_index(root):
+    index_file = os.path.join(root, 'index.json')
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+
+def save_archive_index(root, index):
+    index_file = os.path.join(root, 'index.json')
+    with open(index_file + ".tmp", "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(index_file + ".tmp", index_file)
+
+
+# Archive Files - content-addressed blobs plus a manifest for this run
+@traced
+def archive_files(settings, files, run_id=None):
+    logging.info("Archiving files...")
+
+    root = settings.path
+    run_id = run_id or datetime.now().strftime("%Y%m%d%H%M")
+    manifest = {'run': run_id, 'created': datetime.now().isoformat(timespec='seconds'), 'files': []}
+
+    os.makedirs(os.path.join(root, 'manifests'), exist_ok=True)
+
+    for role, file in files.items():
+        if not file or not os.path.exists(file):
+            logging.warning(f"Not archived, file not found: {role} ({file})")
+            continue
+        try:
+            file_hash, blob, stored = store_blob(root, file, settings.compression)
+            size = os.path.getsize(file)
+            manifest['files'].append({'role': role, 'name': os.path.basename(file), 'hash': file_hash,
+                                      'size': size, 'stored': os.path.getsize(blob)})
+            logging.debug(f"{role}: {os.path.basename(file)} -> {file_hash[:12]} ({'new' if stored else 'deduplicated'})")
+        except Exception as e:
+            logging.critical("Error archiving " + file)
+            logging.critical(e)
+
+    manifest_file = os.path.join(root, 'manifests', f"{run_id}.json")
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    # hash -> runs, for "which run produced this file"
+    index = load_archive_index(root)
+    for entry in manifest['files']:
+        runs = index.setdefault(entry['hash'], [])
+        if run_id not in runs:
+            runs.append(run_id)
+    save_archive_index(root, index)
+
+    logging.info(f"SUCCESS: archive_files() - {len(manifest['files'])} files in run {run_id}")
+    return manifest_file
+
+
+# Runs that archived a file (path or SHA-256)
+def lookup_archive(settings, file_or_hash):
+
+    file_hash = file_sha256(file_or_hash) if os.path.exists(file_or_hash) else file_or_hash
+    runs = load_archive_index(settings.path).get(file_hash, [])
+
+    matches = []
+    for run_id in runs:
+        manifest_file = os.path.join(settings.path, 'manifests', f"{run_id}.json")
+        if not os.path.exists(manifest_file):
+            continue
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        for entry in manifest['files']:
+            if entry['hash'] == file_hash:
+                matches.append({'run': run_id, 'created': manifest['created'], 'role': entry['role'], 'name': entry['name']})
+
+    for match in matches:
+        logging.info(f"{file_hash[:12]}: run {match['run']} ({match['created']}) {match['role']} {match['name']}")
+    if not matches:
+        logging.info(f"{file_hash[:12]}: not in the archive")
+
+    return matches
+
+
+# Drop manifests past retention and the blobs no remaining manifest uses
+@traced
+def prune_archive(settings):
+    logging.info(f"Pruning archive (retention {settings.retention_days} days)...")
+
+    root = settings.path
+    manifest_dir = os.path.join(root, 'manifests')
+    if not os.path.exists(manifest_dir):
+        return
+
+    cutoff = datetime.now() - timedelta(days=settings.retention_days)
+    index = {}
+    removed_runs = 0
+
+    for manifest_name in sorted(os.listdir(manifest_dir)):
+        manifest_file = os.path.join(manifest_dir, manifest_name)
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+
+        if datetime.fromisoformat(manifest['created']) < cutoff:
+            os.remove(manifest_file)
+            removed_runs += 1
+            continue
+
+        for entry in manifest['files']:
+            index.setdefault(entry['hash'], []).append(manifest['run'])
+
+    removed_blobs = 0
+    freed = 0
+    blob_root = os.path.join(root, 'blobs')
+    if os.path.exists(blob_root):
+        for dirpath, dirnames, filenames in os.walk(blob_root):
+            for blob_name in filenames:
+                if blob_name.split('.')[0] not in index:
+                    blob = os.path.join(dirpath, blob_name)
+                    freed += os.path.getsize(blob)
+                    os.remove(blob)
+                    removed_blobs += 1
+
+    save_archive_index(root, index)
+    logging.info(f"SUCCESS: prune_archive() - {removed_runs} runs, {removed_blobs} blobs, {freed / 2**20:.1f} MB freed")
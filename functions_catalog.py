@@ -0,0 +1,91 @@
+import os.path
+import time
+import pandas as pd
+import logging
+from collections import Counter
+import variables
+
+
+
+# Active activity catalog - codes cached for settings.ttl seconds
+class activity_catalog:
+    def __init__(self, settings):
+        self.settings = settings
+        self.codes = pd.Index([], dtype=object)
+        self.loaded_at = None
+        self.hits = Counter()
+        self.misses = Counter()
+
+    # Reload codes when the TTL has run out
+    # (a failed reload keeps the codes already loaded; with none loaded yet it raises,
+    # as an empty catalog would filter out every row)
+    def refresh(self, conn=None):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.settings.ttl:
+            return self.codes
+
+        try:
+            codes = load_activity_codes(self.settings, conn)
+            self.codes = pd.Index(sorted(set(codes)), dtype=object)
+            self.loaded_at = time.monotonic()
+            logging.info(f"Activity catalog loaded: {len(self.codes)} active codes ({self.settings.source})")
+
+        except Exception as e:
+            logging.critical(f"Error occurred: {e}")
+            logging.critical(f"FAIL: activity_catalog.refresh({self.settings.source})")
+            if self.loaded_at is None:
+                raise
+            logging.warning(f"Keeping the {len(self.codes)} active codes loaded earlier")
+
+        return self.codes
+
+
+# Read active codes from the configured source
+def load_activity_codes(settings, conn=None):
+
+    if settings.source == 'file':
+        with open(settings.path, "r") as codes_file:
+            codes = [line.strip() for line in codes_file]
+        return [code for code in codes if code and not code.startswith('#')]
+
+    if settings.source == 'sql':
+        return pd.read_sql(settings.query, conn).iloc[:, 0].dropna().astype(str).str.strip().tolist()
+
+    return list(variables.active_activities['ActivityCode'])
+
+
+# Filter out inactive activities with a membership mask
+def filter_active_activities(dataframe, catalog):
+
+    df = dataframe
+
+    try:
+        activity = dataframe['ActivityCode']
+        mask = activity.isin(catalog.codes).to_numpy()
+
+        # Per-activity volume, kept across chunks and runs
+        # (categorical codes count every category, so zero counts are dropped)
+        hits = activity[mask].value_counts()
+        misses = activity[~mask].value_counts()
+        catalog.hits.update(hits[hits > 0].to_dict())
+        catalog.misses.update(misses[misses > 0].to_dict())
+
+        df = dataframe.loc[mask]
+        logging.debug(f"filter_active_activities(): kept {int(mask.sum())}/{len(mask)} rows")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical("FAIL: filter_active_activities()")
+
+    return df
+
+
+# Log hit/miss counts per activity
+def log_catalog_stats(catalog):
+
+    logging.info(f"Active activity hits: {sum(catalog.hits.values())}, misses: {sum(catalog.misses.values())}")
+
+    for code, count in catalog.hits.most_common():
+        logging.info(f"  hit  {code}: {count}")
+
+    for code, count in catalog.misses.most_common():
+        logging.debug(f"  miss {code}: {count}")
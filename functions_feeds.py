@@ -0,0 +1,115 @@
+import time
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functions_in_out import import_files
+from functions_parse import general_parse_fast
+from functions_state import watermark_rows
+from functions_catalog import filter_active_activities
+from functions_roster import enrich_emails
+from functions_key_index import drop_known_keys
+from functions_trace import traced
+
+
+
+# Log records raised in a worker process, handed back to the parent with the result
+class worker_log_capture(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        # Formatted here - args and tracebacks do not always pickle
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+# Worker process start-up - drop handlers inherited from the parent (fork), logs go back with each result
+def feed_worker_init(log_level):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(log_level)
+
+
+# Process pool whole-file feeds (xlsx, unchunked csv) parse in (None = parse on the stage thread);
+# chunked and streamed csv feeds never come here - their chunk generators are consumed on the stage thread
+def feed_process_pool(processes):
+
+    if processes < 1:
+        return None
+
+    logging.info(f"Feed parse pool: {processes} processes")
+    return ProcessPoolExecutor(max_workers=processes, initializer=feed_worker_init,
+                               initargs=(logging.getLogger().getEffectiveLevel(),))
+
+
+# Parse a downloaded feed file (runs in a worker process)
+# Returns the frame plus the state the parent commits: watermark tracker, catalog hits/misses, log records
+# (or the error, which parse_feed raises once the worker's log records are handled)
+def parse_feed_file(file_in, file_path, table, watermark, pending, catalog, roster, keys, key_index):
+
+    capture = worker_log_capture()
+    logging.getLogger().addHandler(capture)
+    start = time.perf_counter()
+
+    try:
+        df = general_parse_fast(import_files(file_in, file_path), file_in)
+        df = watermark_rows(df, watermark, pending)
+
+        if catalog is not None:
+            # Counted from zero here, the parent adds them to its own totals
+            catalog.hits = Counter()
+            catalog.misses = Counter()
+            df = filter_active_activities(df, catalog)
+            df = enrich_emails(df, roster, table)
+
+        df = drop_known_keys(df, keys, table, key_index)
+        logging.debug(f"parse_feed_file({file_in.nickname}): {len(df.index)} rows in {time.perf_counter() - start:.2f}s")
+
+    except Exception as e:
+        return {'error': e, 'logs': capture.records}
+
+    finally:
+        logging.getLogger().removeHandler(capture)
+
+    return {'frame': df, 'pending': pending,
+            'hits': catalog.hits if catalog is not None else Counter(),
+            'misses': catalog.misses if catalog is not None else Counter(),
+            'logs': capture.records}
+
+
+# Parse a feed file in the pool and commit the worker's state updates here
+@traced
+def parse_feed(pool, file_in, file_path, table, watermark, pending, catalog=None, roster=None, keys=(), key_index=None):
+
+    worker_catalog = catalog
+    if catalog is not None:
+        # Workers only need the codes; the counters stay with the parent
+        worker_catalog = type(catalog)(catalog.settings)
+        worker_catalog.codes = catalog.codes
+        worker_catalog.loaded_at = catalog.loaded_at
+
+    if pool is None:
+        result = parse_feed_file(file_in, file_path, table, watermark, pending, worker_catalog, roster, keys, key_index)
+    else:
+        result = pool.submit(parse_feed_file, file_in, file_path, table, watermark, pending,
+                             worker_catalog, roster, keys, key_index).result()
+
+        for record in result['logs']:
+            logging.getLogger().handle(record)
+
+    if 'error' in result:
+        raise result['error']
+
+    if pool is not None:
+        pending.clear()
+        pending.update(result['pending'])
+
+    if catalog is not None:
+        catalog.hits.update(result['hits'])
+        catalog.misses.update(result['misses'])
+
+    return result['frame']
@@ -3,20 +3,29 @@ import os.path
 import csv
 import pandas as pd
 from datetime import date, datetime, timedelta
-import pyodbc
+import hashlib
 import logging
-import argparse
+import time
+import smtplib
+import zipfile
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
 import variables
+from functions_trace import traced
+from functions_sftp import transfers
 
 
 
 
 # Import files
-def import_files(file_instance):
+@traced
+def import_files(file_instance, file_path=None):
 
     df = pd.DataFrame()
 
-    file = file_instance.path
+    file = file_path or file_instance.path
     csv_true = file_instance.csv_true
     name = file_instance.name
     nickname = file_instance.nickname
@@ -29,6 +38,9 @@ def import_files(file_instance):
         if file_type == 'csv':
             read_file = pd.read_csv(file)
 
+        elif file_instance.cache_dir:
+            read_file = import_xlsx_cached(file_instance, file)
+
         else:
             read_file = pd.read_excel(file, index_col=None)
         
@@ -40,11 +52,158 @@ def import_files(file_instance):
         logging.critical(f"Error occurred: {e}")
         logging.critical(f"FAIL: import_files({name})")
         logging.critical(f"{name}.csv_true = {csv_true}\n")
+        raise  # An unreadable input must fail its stage, not load (and record) an empty frame
 
     return df
 
 
+# SHA-256 of a file's contents
+def file_sha256(file):
+
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+
+# Fastest installed read-only xlsx engine
+def xlsx_engine():
+
+    try:
+        import python_calamine
+        return 'calamine'
+    except ImportError:
+        return None
+
+
+
+# Import xlsx through a Parquet cache keyed by content hash
+@traced
+def import_xlsx_cached(file_instance, file):
+
+    name = file_instance.name
+    cache_dir = file_instance.cache_dir
+
+    start = time.perf_counter()
+    file_hash = file_sha256(file)
+    cache_file = os.path.join(cache_dir, f"{file_instance.nickname}_{file_hash}.parquet")
+    logging.debug(f"xlsx cache file: {cache_file}")
+
+    if os.path.exists(cache_file):
+        df = pd.read_parquet(cache_file)
+        logging.info(f"{name}: loaded from cache in {time.perf_counter() - start:.2f}s")
+        return df
+
+    engine = xlsx_engine()
+    df = pd.read_excel(file, index_col=None, engine=engine)
+    logging.info(f"{name}: parsed with {engine or 'default'} engine in {time.perf_counter() - start:.2f}s")
+
+    try:
+        if not os.path.exists(cache_dir):
+            logging.debug("Cache directory does not exist. Creating...")
+            os.makedirs(cache_dir)
+
+        # Write then rename so a half-written file is never read back
+        tmp_file = cache_file + ".tmp"
+        df.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, cache_file)
+
+        # Only the latest version of the report is worth keeping
+        for old_file in glob.glob(os.path.join(cache_dir, f"{file_instance.nickname}_*.parquet")):
+            if old_file != cache_file:
+                os.remove(old_file)
+                logging.debug(f"Removed stale cache file: {old_file}")
+
+        logging.info(f"{name}: cached as {cache_file}")
+
+    except Exception as e:
+        logging.warning(f"Could not cache {name}: {e}")
+
+    return df
+
+
+
+# Import csv in bounded chunks (generator)
+@traced
+def import_files_chunked(file_instance, file_path=None, usecols=None, dtype=None):
+
+    # file_path may also be an open binary stream
+    file = file_path or file_instance.path
+    name = file_instance.name
+    chunksize = file_instance.chunksize or 100000
+
+    logging.info(f"Streaming file: {name} ({chunksize} rows per chunk)")
+    logging.debug(f"File path: {file}")
+
+    rows = 0
+    chunks = 0
+
+    with pd.read_csv(file, sep=file_instance.delimiter or ',', usecols=usecols,
+                     dtype=dtype, chunksize=chunksize) as reader:
+        for chunk in reader:
+            rows += len(chunk.index)
+            chunks += 1
+            logging.debug(f"{name}: read chunk {chunks} ({rows} rows so far)")
+            yield chunk
+
+    logging.info(f"SUCCESS: import_files_chunked({name}) - {rows} rows in {chunks} chunks")
+
+
+
+# Stream reader that optionally copies everything read to a local file
+class stream_tee:
+    def __init__(self, source, tee_path=None):
+        self.source = source
+        self.sink = None
+        if tee_path:
+            tee_dir = os.path.dirname(tee_path)
+            if tee_dir and not os.path.exists(tee_dir):
+                logging.debug("Stream archive directory does not exist. Creating...")
+                os.makedirs(tee_dir)
+            self.sink = open(tee_path, "wb")
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.bytes_read += len(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        return data
+
+    def close(self):
+        self.source.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+
+# Import csv in chunks straight from SFTP - parsing overlaps the transfer
+@traced
+def import_remote_chunked(file_instance, sftp_info, usecols=None, dtype=None, tee_path=None):
+
+    logging.info(f"Streaming {sftp_info.file} from {sftp_info.sftpurl}")
+    if tee_path:
+        logging.debug(f"Keeping a local copy for the archive: {tee_path}")
+
+    start = time.perf_counter()
+    source = stream_tee(transfers.open_remote(sftp_info), tee_path)
+
+    try:
+        yield from import_files_chunked(file_instance, source, usecols=usecols, dtype=dtype)
+    finally:
+        source.close()
+
+    seconds = time.perf_counter() - start
+    rate = source.bytes_read / seconds if seconds > 0 else 0
+    logging.info(f"Streamed {source.bytes_read} bytes in {seconds:.2f}s ({rate / 2**20:.2f} MB/s)")
+
+
+
 # Export csv
+@traced
 def export_csv(dataframe, file_instance):
 
     filePath = file_instance.path
@@ -66,6 +225,7 @@ def export_csv(dataframe, file_instance):
 
 
 # Export txt file
+@traced
 def export_txt(input_csv, output_txt):
 
     inputCsvPath = input_csv.path
@@ -99,196 +259,233 @@ def export_txt(input_csv, output_txt):
 
 
 
+# Export csv and SumTotal txt in one pass (no tmp csv)
+@traced
+def export_files(dataframe, csv_instance, txt_instance, template=None, chunk_rows=50000):
+
+    csvPath = csv_instance.path
+    txtPath = txt_instance.path
+    txtName = txt_instance.name
+
+    logging.info(f"Exporting files: {csvPath}, {txtPath}")
+
+    try:
+        with open(csvPath, "w", newline="", encoding="utf-8") as csv_file, \
+             open(txtPath, "w", newline="", encoding="utf-8") as txt_file:
+
+            writer = csv.writer(csv_file, delimiter=csv_instance.delimiter or ',', lineterminator=os.linesep)
+
+            # Template constants are formatted once here instead of per row;
+            # a template-free frame is written column for column
+            if template is None:
+                header = [str(column) for column in dataframe.columns]
+                layout = [(index, None) for index in range(len(dataframe.columns))]
+            else:
+                header = [column.name for column in template]
+                positions = {name: index for index, name in enumerate(dataframe.columns)}
+                layout = [(positions[column.name], None) if column.source is not None
+                          else (-1, '' if column.value is None else str(column.value))
+                          for column in template]
+
+            # Header is written to both, as export_txt used to copy it over
+            writer.writerow(header)
+            txt_file.write(" ".join(header) + os.linesep)
+
+            for offset in range(0, len(dataframe.index), chunk_rows):
+                chunk = dataframe.iloc[offset:offset + chunk_rows]
+
+                # Format each field once (None/NaN -> ''), then write it to both files
+                values = chunk.astype(object).where(chunk.notna(), '')
+                rows = [[str(row[index]) if index >= 0 else constant for index, constant in layout]
+                        for row in values.itertuples(index=False, name=None)]
+
+                writer.writerows(rows)
+                txt_file.write("".join(" ".join(row) + os.linesep for row in rows))
+
+        logging.info(f"Created {txtName}")
+        logging.info(f"SUCCESS: export_files({csvPath}, {txtName})")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: export_files({csvPath}, {txtName})")
+
+
+
+
 # # # Original functions:
 # Download file from SFTP
-def download_file(host_url, host_username, file_path, key_path, temp_path):
-    logging.info("Downloading file from TraCorp SFTP...")
-    logging.debug("SFTP URL: " + host_url)
-    logging.debug("SFTP Username: " + host_username)
-    logging.debug("SFTP File Path: " + file_path)
-    logging.debug("SFTP Key Path: " + key_path)
+@traced
+def download_file(sftp_info, temp_path):
+    logging.info(f"Downloading file from {sftp_info.sftpurl} SFTP...")
+    logging.debug("SFTP URL: " + sftp_info.sftpurl)
+    logging.debug("SFTP Username: " + sftp_info.username)
+    logging.debug("SFTP File Path: " + sftp_info.file)
+    logging.debug("SFTP Key Path: " + sftp_info.key)
 
     try:
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        with pysftp.Connection(host=host_url, username=host_username, private_key=key_path, cnopts=cnopts) as sftp:
-            sftp.get(file_path)
-            sftp.close()
+        file = transfers.download(sftp_info, temp_path)
     except Exception as e:
         logging.critical("Error downloading file from SFTP")
         logging.critical(e)
+        raise
     else:
-        file_name = os.path.basename(file_path)
-        file = os.path.join(temp_path, file_name)
         logging.info("File downloaded successfully.")
         logging.debug("File path: " + file)
         return file
 
 
 # Upload file to SFTP
-def upload_file(host_url, host_username, file_path, key_path, file):
-    logging.info("Uploading file to SumTotal SFTP...")
-    logging.debug("SFTP URL: " + host_url)
-    logging.debug("SFTP Username: " + host_username)
-    logging.debug("SFTP File Path: " + file_path)
-    logging.debug("SFTP Key Path: " + key_path)
+@traced
+def upload_file(sftp_info, file):
+    logging.info(f"Uploading file to {sftp_info.sftpurl} SFTP...")
+    logging.debug("SFTP URL: " + sftp_info.sftpurl)
+    logging.debug("SFTP Username: " + sftp_info.username)
+    logging.debug("SFTP File Path: " + sftp_info.file)
+    logging.debug("SFTP Key Path: " + sftp_info.key)
     logging.debug("File path: " + file)
 
     try:
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        with pysftp.Connection(host=host_url, username=host_username, private_key=key_path, cnopts=cnopts) as sftp:
-            sftp.chdir(os.path.dirname(file_path))
-            sftp.put(file)
-            sftp.close()
+        transfers.upload(sftp_info, file)
     except Exception as e:
         logging.critical("Error uploading file to SFTP")
         logging.critical(e)
-    
+        raise
     else:
         logging.info("File uploaded successfully.")
 
 
-# Email Logs
-def email_log_and_files(email_from, email_to, email_server, email_port, log_file, tracorp_file, sumtotal_file, modified_file):
-    # Email log file
-    logging.info("Emailing log and files...")
-
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = email_from
-        msg['To'] = email_to
-        msg['Subject'] = "SumTotalLMS_TraCorp Transform and Upload Log"
-        email_body = "Please see attached log file and files for SumTotalLMS_TraCorp Transform and Upload."
-        
-
-        # Attach log file
-        # Test if log file exists
-        if os.path.exists(log_file): 
-            attachment = open(log_file, "rb")
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload((attachment).read())
-            attachment.close()
-            part.add_header(
-                'Content-Disposition', "attachment; filename= %s" % log_file)
-            msg.attach(part)
-        else: 
-            email_body = email_body + "\n\nLog file not found."
-
-        # Attach tracorp file
-        # Test if tracorp file exists
-        if os.path.exists(tracorp_file):
-            attachment = open(tracorp_file, "rb")
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload((attachment).read())
-            attachment.close()
-            part.add_header('Content-Disposition',
-                            "attachment; filename= %s" % tracorp_file)
-            msg.attach(part)
-        else:
-            email_body = email_body + "\n\nTraCorp file not found."
-
-        # Attach sumtotal file
-        # Test if sumtotal file exists
-        if os.path.exists(sumtotal_file):
-            attachment = open(sumtotal_file, "rb")
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload((attachment).read())
-            attachment.close()
-            part.add_header('Content-Disposition',
-                            "attachment; filename= %s" % sumtotal_file)
-            msg.attach(part)
+# Email Logs - bundle attachments into one zip and send in the background
+class report_sender(threading.Thread):
+    def __init__(self, smtp_info, subject, body, files, stats, bundle_path):
+        super().__init__(name="email-report")
+        self.smtp_info = smtp_info
+        self.subject = subject
+        self.body = body
+        self.files = files
+        self.stats = stats
+        self.bundle_path = bundle_path
+        # Set once the attachments are zipped, so the caller may delete them
+        self.bundled = threading.Event()
+
+    def run(self):
+        prune_report_bundles(os.path.dirname(self.bundle_path), self.smtp_info.keep_bundle_days)
+
+        try:
+            bundle_size = bundle_report_files(self.files, self.bundle_path)
+        except Exception as e:
+            logging.critical("Error bundling report files")
+            logging.critical(e)
+            bundle_size = None
+            if os.path.exists(self.bundle_path):
+                os.remove(self.bundle_path)
+        finally:
+            self.bundled.set()
+
+        # A bundle that went out attached is deleted; an unsent or over-cap one (the email points to it) is kept
+        # until prune_report_bundles
+        try:
+            attached = send_report_email(self.smtp_info, self.subject, self.body, self.files, self.stats,
+                                         self.bundle_path, bundle_size)
+        except Exception as e:
+            logging.critical("Error emailing log and files")
+            logging.critical(e)
         else:
-            email_body = email_body + "\n\nSumTotal file not found."
-
-        # Attach modified file
-        # Test if modified file exists
-        if os.path.exists(modified_file):
-            attachment = open(modified_file, "rb")
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload((attachment).read())
-            attachment.close()
-            part.add_header('Content-Disposition',
-                            "attachment; filename= %s" % modified_file)
-            msg.attach(part)
-        else:
-            email_body = email_body + "\n\nModified file not found."
+            logging.info("Log and files emailed successfully")
+            if attached:
+                os.remove(self.bundle_path)
+                logging.debug(f"Deleted {self.bundle_path}")
 
-        # Attach email body
-        msg.attach(MIMEText(email_body, 'plain'))
 
-        # Send email
-        server = smtplib.SMTP(email_server, email_port)
-        server.starttls()
-        text = msg.as_string()
-        server.sendmail(email_from, email_to, text)
-        server.quit()
-    except Exception as e:
-        logging.critical("Error emailing log and files")
-        logging.critical(e)
-        
-    else:
-        logging.info("Log and files emailed successfully")
+# Zip the files that exist (returns zip size in bytes)
+def bundle_report_files(files, bundle_path):
 
+    with zipfile.ZipFile(bundle_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as bundle:
+        for label, file in files.items():
+            if file and os.path.exists(file):
+                bundle.write(file, arcname=os.path.basename(file))
 
+    return os.path.getsize(bundle_path)
 
-# Archive Files
-def archive_files(tracorp_file, sumtotal_file, modified_file):
-    logging.info("Archiving files...")
-    # Setup File Archive Paths
-    archive_root = os.path.join(args.path, 'archive')
-    archive_date = datetime.now().strftime("%Y%m%d%H%M")
-    archive_path = os.path.join(archive_root, archive_date)
-    logging.debug("Archive path: " + archive_path)
 
-    # Create Archive Root Directory if it doesn't exist
-    if not os.path.exists(archive_root):
-        logging.debug("Archive root directory does not exist. Creating...")
-        os.makedirs(archive_root)
+# Delete report zips older than keep_days
+def prune_report_bundles(log_dir, keep_days):
 
-    # Create archive directory if it doesn't exist
-    if not os.path.exists(archive_path):
-        logging.debug("Archive directory does not exist. Creating...")
-        os.makedirs(archive_path)
+    cutoff = time.time() - keep_days * 86400
+    for bundle_path in glob.glob(os.path.join(log_dir, "*.report.zip")):
+        try:
+            if os.path.getmtime(bundle_path) < cutoff:
+                os.remove(bundle_path)
+                logging.info(f"Deleted report bundle older than {keep_days} days: {bundle_path}")
+        except OSError as e:
+            logging.warning(f"Failed to delete {bundle_path}: {e}")
 
-    # New File Paths
-    tracorp_archive = os.path.join(
-        archive_path, os.path.basename(tracorp_file))
-    sumtotal_archive = os.path.join(
-        archive_path, os.path.basename(sumtotal_file))
-    modified_archive = os.path.join(
-        archive_path, os.path.basename(modified_file))
 
-    logging.debug("TraCorp archive path: " + tracorp_archive)
-    logging.debug("SumTotal archive path: " + sumtotal_archive)
-    logging.debug("Modified archive path: " + modified_archive)
+# Plain-text run summary
+def report_summary(files, stats):
 
-    # Copy files to archive directory
-    logging.debug("Copying files to archive directory...")
+    lines = ["", "Run summary:"]
+    for key, value in stats.items():
+        lines.append(f"  {key}: {value}")
 
-    try:
-        logging.debug("Copying " + tracorp_file + " to " + tracorp_archive)
-        shutil.copy2(tracorp_file, tracorp_archive)
-    except Exception as e:
-        logging.critical("Error copying " + tracorp_file + " to " + tracorp_archive)
-        logging.critical(e)
-    else:
-        logging.debug("TraCorp file copied successfully")
-    try:
-        logging.debug("Copying " + sumtotal_file + " to " + sumtotal_archive)
-        shutil.copy2(sumtotal_file, sumtotal_archive)
-    except Exception as e:
-        logging.critical("Error copying " + sumtotal_file + " to " + sumtotal_archive)
-        logging.critical(e)
+    lines.append("")
+    lines.append("Files:")
+    for label, file in files.items():
+        if file and os.path.exists(file):
+            lines.append(f"  {label}: {os.path.basename(file)} ({os.path.getsize(file):,} bytes)")
+        else:
+            lines.append(f"  {label}: not found")
+
+    return "\n".join(lines)
+
+
+# Send the report email (zip attached when under the size cap; returns True when it was)
+def send_report_email(smtp_info, subject, body, files, stats, bundle_path, bundle_size):
+
+    msg = MIMEMultipart()
+    msg['From'] = smtp_info.addressFrom
+    msg['To'] = smtp_info.addressTo
+    msg['Subject'] = subject
+
+    max_bytes = smtp_info.max_attachment_mb * 2**20
+    attached = False
+    if bundle_size is None:
+        body = body + "\n\nAttachments left out: the report bundle could not be created (see the log)."
+        logging.warning("Report bundle could not be created - sending summary only")
+    elif bundle_size <= max_bytes:
+        with open(bundle_path, "rb") as attachment:
+            part = MIMEApplication(attachment.read(), Name=os.path.basename(bundle_path))
+        part['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(bundle_path)
+        msg.attach(part)
+        attached = True
+        logging.info(f"Report bundle attached: {bundle_size:,} bytes")
     else:
-        logging.debug("SumTotal file copied successfully")
+        body = body + f"\n\nAttachments left out: bundle is over the {smtp_info.max_attachment_mb} MB cap."
+        body = body + f"\nThe files are kept in {bundle_path} for {smtp_info.keep_bundle_days} days."
+        logging.warning(f"Report bundle over {smtp_info.max_attachment_mb} MB - sending summary only")
+
+    msg.attach(MIMEText(body + "\n" + report_summary(files, stats), 'plain'))
+
+    server = smtplib.SMTP(smtp_info.server, int(smtp_info.port), timeout=60)
     try:
-        logging.debug("Copying " + modified_file + " to " + modified_archive)
-        shutil.copy2(modified_file, modified_archive)
-    except Exception as e:
-        logging.critical("Error copying " + modified_file + " to " + modified_archive)
-        logging.critical(e)
-    else:
-        logging.debug("Modified file copied successfully")
+        if smtp_info.starttls:
+            server.starttls()
+        server.sendmail(smtp_info.addressFrom, smtp_info.addressTo, msg.as_string())
+    finally:
+        server.quit()
+
+    return attached
+
+
+# Start emailing the log and files; returns the sender thread
+@traced
+def email_log_and_files(smtp_info, log_file, files, stats):
+    logging.info("Emailing log and files...")
 
+    files = dict({'log': log_file}, **files)
+    bundle_path = os.path.splitext(log_file)[0] + ".report.zip"
+    sender = report_sender(smtp_info, "SumTotalLMS_TraCorp Transform and Upload Log",
+                           "Please see attached log file and files for SumTotalLMS_TraCorp Transform and Upload.",
+                           files, stats, bundle_path)
+    sender.start()
 
+    return sender
@@ -0,0 +1,302 @@
+import os.path
+import sqlite3
+import numpy as np
+import pandas as pd
+import logging
+import variables
+from functions_sql import table_ref, sql_dialect
+
+
+
+# Fixed hash key so digests are stable between runs
+hash_key = "tracorpkeyindex0"
+
+
+# Normalised (activity, email, completion date) key strings
+def key_strings(dataframe, activity, email, date):
+
+    return (dataframe[activity].astype(str).str.strip().str.upper() + "|" +
+            dataframe[email].astype(str).str.strip().str.lower() + "|" +
+            pd.to_datetime(dataframe[date]).dt.strftime('%Y-%m-%d'))
+
+
+# Digest key strings into uint64 keys
+def string_digests(keys):
+    return pd.util.hash_pandas_object(keys, index=False, hash_key=hash_key).to_numpy()
+
+
+# Digest (activity, email, completion date) into uint64 keys
+def key_digests(dataframe, activity, email, date):
+    return string_digests(key_strings(dataframe, activity, email, date))
+
+
+# Load key index from disk (sorted uint64 array)
+def load_key_index(settings):
+
+    keys = np.empty(0, dtype=np.uint64)
+
+    if not os.path.exists(settings.path):
+        logging.info(f"Key index not found: {settings.path}")
+        return keys
+
+    try:
+        keys = np.load(settings.path)
+        logging.info(f"Key index loaded: {settings.path} ({len(keys)} keys)")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: load_key_index({settings.path})")
+
+    return keys
+
+
+# Save key index to disk (write then rename)
+def save_key_index(settings, keys):
+
+    index_dir = os.path.dirname(settings.path)
+    if index_dir and not os.path.exists(index_dir):
+        logging.debug("Key index directory does not exist. Creating...")
+        os.makedirs(index_dir)
+
+    tmp_path = settings.path + ".tmp"
+    with open(tmp_path, "wb") as index_file:
+        np.save(index_file, keys)
+    os.replace(tmp_path, settings.path)
+
+    logging.debug(f"Key index saved: {settings.path} ({len(keys)} keys)")
+
+
+# Exact keys behind the digests (SQLite file next to the index) - a digest hit only drops a row
+# once its full key is found here, so a hash collision can never drop a new completion
+def key_sidecar_path(settings):
+    return os.path.splitext(settings.path)[0] + ".sqlite3"
+
+
+def open_key_sidecar(settings):
+
+    index_dir = os.path.dirname(settings.path)
+    if index_dir and not os.path.exists(index_dir):
+        logging.debug("Key index directory does not exist. Creating...")
+        os.makedirs(index_dir)
+
+    store = sqlite3.connect(key_sidecar_path(settings))
+    store.execute("CREATE TABLE IF NOT EXISTS keys (digest INTEGER, key TEXT, PRIMARY KEY (digest, key)) WITHOUT ROWID")
+    return store
+
+
+# uint64 digests as SQLite (signed 64-bit) integers
+def sidecar_digests(digests):
+    return np.asarray(digests, dtype=np.uint64).view(np.int64).tolist()
+
+
+# Add keys to the sidecar (caller commits)
+def add_sidecar_keys(store, digests, keys):
+    store.executemany("INSERT OR IGNORE INTO keys (digest, key) VALUES (?, ?)",
+                      zip(sidecar_digests(digests), [str(key) for key in keys]))
+
+
+# Every digest the sidecar holds an exact key for
+def load_sidecar_digests(settings):
+
+    if not os.path.exists(key_sidecar_path(settings)):
+        return np.empty(0, dtype=np.uint64)
+
+    store = sqlite3.connect(key_sidecar_path(settings))
+    try:
+        rows = store.execute("SELECT DISTINCT digest FROM keys").fetchall()
+    finally:
+        store.close()
+
+    return np.unique(np.array([row[0] for row in rows], dtype=np.int64).view(np.uint64))
+
+
+# Mask of digest hits whose exact key is in the sidecar
+def confirm_known_keys(settings, digests, keys):
+
+    confirmed = np.zeros(len(digests), dtype=bool)
+
+    if not os.path.exists(key_sidecar_path(settings)):
+        logging.warning(f"Key index has no exact keys ({key_sidecar_path(settings)}) - run with --rebuild-key-index")
+        return confirmed
+
+    values = sidecar_digests(digests)
+    keys = [str(key) for key in keys]
+    lookup = sorted(set(values))
+    stored = set()
+
+    store = sqlite3.connect(key_sidecar_path(settings))
+    try:
+        for offset in range(0, len(lookup), 500):
+            batch = lookup[offset:offset + 500]
+            placeholders = ','.join('?' for _ in batch)
+            stored.update(store.execute(f"SELECT digest, key FROM keys WHERE digest IN ({placeholders})", batch).fetchall())
+    finally:
+        store.close()
+
+    confirmed[:] = [(digest, key) in stored for digest, key in zip(values, keys)]
+    return confirmed
+
+
+# Membership mask of df keys against the index
+def known_key_mask(digests, keys):
+
+    if len(keys) == 0:
+        return np.zeros(len(digests), dtype=bool)
+
+    position = np.searchsorted(keys, digests)
+    position[position == len(keys)] = 0
+
+    return keys[position] == digests
+
+
+# Drop rows already known to be in the table before staging them
+# (digest hits are confirmed against the exact keys; unconfirmed hits are left to the SQL anti-join)
+def drop_known_keys(dataframe, keys, table, settings):
+
+    activity = table.key_activity
+    email = table.key_email
+    date = table.key_date
+
+    if len(keys) == 0 or len(dataframe.index) == 0:
+        return dataframe
+
+    if not all(col in dataframe.columns for col in (activity, email, date)):
+        logging.debug(f"drop_known_keys(): df has no {activity}/{email}/{date} keys, skipping")
+        return dataframe
+
+    try:
+        strings = key_strings(dataframe, activity, email, date)
+        digests = string_digests(strings)
+        mask = known_key_mask(digests, keys)
+
+        hits = np.flatnonzero(mask)
+        if len(hits) > 0:
+            confirmed = confirm_known_keys(settings, digests[hits], strings.to_numpy()[hits])
+            mask[hits[~confirmed]] = False
+            if not confirmed.all():
+                logging.info(f"Digest hits without an exact key match (left to SQL): {int((~confirmed).sum())}")
+
+        df = dataframe.loc[~mask].reset_index(drop=True)
+
+        logging.info(f"Known duplicates dropped locally: {int(mask.sum())}/{len(dataframe.index)}")
+        logging.info(f"SUCCESS: drop_known_keys({table.name})")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: drop_known_keys({table.name})")
+        df = dataframe
+
+    return df
+
+
+# Add newly merged rows to the index
+def update_key_index(settings, keys, dataframe, table):
+
+    if dataframe is None or len(dataframe.index) == 0:
+        return keys
+
+    try:
+        # Merged rows come back with the email key aliased as Email
+        email = 'Email' if 'Email' in dataframe.columns else table.key_email
+        strings = key_strings(dataframe, table.key_activity, email, table.key_date)
+        digests = string_digests(strings)
+
+        # Exact keys first - an index digest without one is only ever left to SQL
+        sidecar = open_key_sidecar(settings)
+        try:
+            with sidecar:
+                add_sidecar_keys(sidecar, digests, strings)
+        finally:
+            sidecar.close()
+
+        keys = np.union1d(keys, digests)
+        save_key_index(settings, keys)
+
+        logging.info(f"Key index updated: +{len(digests)} rows ({len(keys)} keys)")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: update_key_index({settings.path})")
+
+    return keys
+
+
+# Read every key of a table as digests (and into an open sidecar, when given one)
+def table_key_digests(conn, table, sidecar=None):
+
+    query = f"""
+    SELECT {table.key_activity}, {table.key_email}, {table.key_date}
+    FROM {table_ref(conn, table)}
+    WHERE {table.key_email} IS NOT NULL;
+    """
+
+    # Local store dates are text
+    parse_dates = [table.key_date] if sql_dialect(conn) == 'sqlite' else None
+
+    parts = [np.empty(0, dtype=np.uint64)]
+    for chunk in pd.read_sql(query, conn, chunksize=100000, parse_dates=parse_dates):
+        strings = key_strings(chunk, table.key_activity, table.key_email, table.key_date)
+        parts.append(string_digests(strings))
+        if sidecar is not None:
+            add_sidecar_keys(sidecar, parts[-1], strings)
+
+    return np.unique(np.concatenate(parts))
+
+
+# Rebuild key index from the table
+def rebuild_key_index(conn, table, settings):
+
+    logging.info(f"Rebuilding key index from {table.path}")
+
+    try:
+        sidecar = open_key_sidecar(settings)
+        try:
+            with sidecar:
+                sidecar.execute("DELETE FROM keys")
+                keys = table_key_digests(conn, table, sidecar)
+        finally:
+            sidecar.close()
+
+        save_key_index(settings, keys)
+        logging.info(f"SUCCESS: rebuild_key_index({table.name}) - {len(keys)} keys\n")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: rebuild_key_index({table.name})\n")
+
+
+# Compare key index against the table
+def check_key_index(conn, table, settings):
+
+    logging.info(f"Checking key index against {table.path}")
+
+    consistent = False
+
+    try:
+        keys = load_key_index(settings)
+        table_keys = table_key_digests(conn, table)
+        sidecar_keys = load_sidecar_digests(settings)
+
+        # Keys in the index but not the table would drop new rows - must rebuild
+        extra = np.setdiff1d(keys, table_keys, assume_unique=True)
+        # Keys in the table but not the index only cost a SQL round trip
+        missing = np.setdiff1d(table_keys, keys, assume_unique=True)
+
+        logging.info(f"Index keys: {len(keys)}, table keys: {len(table_keys)}")
+        logging.info(f"Index keys not in table: {len(extra)}")
+        logging.info(f"Table keys not in index: {len(missing)}")
+        # Index keys without an exact key never drop a row - they only cost a SQL round trip
+        inexact = np.setdiff1d(keys, sidecar_keys, assume_unique=True)
+        logging.info(f"Index keys without an exact key: {len(inexact)}")
+
+        consistent = len(extra) == 0 and len(missing) == 0 and len(inexact) == 0
+        if consistent:
+            logging.info(f"SUCCESS: check_key_index({table.name})\n")
+        else:
+            logging.warning(f"Key index out of sync with {table.path} - run with --rebuild-key-index\n")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: check_key_index({table.name})\n")
+
+    return consistent
@@ -0,0 +1,159 @@
+import os.path
+import time
+import sqlite3
+import logging
+import threading
+from datetime import date, datetime
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import variables
+from functions_trace import traced
+
+
+
+# Dates go into the local store as ISO text, so equal dates compare equal whatever type they came in as
+sqlite3.register_adapter(pd.Timestamp, lambda value: value.isoformat(sep=' '))
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(sep=' '))
+sqlite3.register_adapter(date, lambda value: value.isoformat() + ' 00:00:00')
+sqlite3.register_adapter(np.int64, int)
+sqlite3.register_adapter(np.int32, int)
+sqlite3.register_adapter(np.float64, float)
+
+
+# Open the local store (one file, shared by every "server")
+def open_local_store(settings):
+
+    store_dir = os.path.dirname(settings.path)
+    if store_dir and not os.path.exists(store_dir):
+        logging.debug("Local store directory does not exist. Creating...")
+        os.makedirs(store_dir)
+
+    # Pooled connections move between stage threads, one thread at a time
+    conn = sqlite3.connect(settings.path, timeout=60, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+# Create the local copies of the configured tables
+# (key tables get their key columns, tables without keys are roster extracts)
+def ensure_local_schema(conn, tables):
+
+    with conn:
+        for table in tables:
+            if table.key_email:
+                conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS "{table.name}" (
+                    {table.key_activity} TEXT,
+                    {table.key_email} TEXT,
+                    EmpID TEXT,
+                    {table.key_date} TEXT,
+                    Score NUMERIC)""")
+                # Anti-join lookups in merge_new_rows
+                if table.table_type == 'permanent':
+                    conn.execute(f"""CREATE INDEX IF NOT EXISTS "ix_{table.name}_key"
+                                     ON "{table.name}" ({table.key_activity}, {table.key_email}, {table.key_date})""")
+            else:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{table.name}" (EIN TEXT, EmployeeEmailAddress TEXT)')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table.name}_ein" ON "{table.name}" (EIN)')
+
+
+# Add columns a frame brings that the local table does not have yet
+def ensure_local_columns(cursor, tablePath, columns):
+
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({tablePath})").fetchall()}
+    for column in columns:
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {tablePath} ADD COLUMN {column}")
+            logging.debug(f"{tablePath}: added column {column}")
+
+
+# Local stand-in for connection_manager (--no-sql) - same interface, every server name maps to the local store
+class local_connection_manager:
+    def __init__(self, settings, tables):
+        self.settings = settings
+        self.idle = []
+        self.connect_times = []
+        self.lock = threading.Lock()
+
+        conn = self.open_connection()
+        ensure_local_schema(conn, tables)
+        self.idle.append(conn)
+
+    # Open a new connection and time it
+    def open_connection(self):
+        start = time.perf_counter()
+        conn = open_local_store(self.settings)
+        with self.lock:
+            self.connect_times.append(time.perf_counter() - start)
+        logging.debug(f"Local store opened: {self.settings.path}")
+        return conn
+
+    # Nothing to warm up - the local store opens instantly
+    def prefetch(self, names):
+        pass
+
+    # Check out a connection
+    def acquire(self, name):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        return conn if conn is not None else self.open_connection()
+
+    # Check out / return around a with block
+    @contextmanager
+    def connection(self, name):
+        conn = self.acquire(name)
+        try:
+            yield conn
+        finally:
+            self.release(name, conn)
+
+    # Return a connection to the pool
+    def release(self, name, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    # Close every pooled connection
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    # Log connect count
+    def log_connect_stats(self):
+        logging.info(f"Local store {self.settings.path}: {len(self.connect_times)} connection(s)")
+
+
+# Copy a SQL Server table into the local store (--sync-local)
+@traced
+def sync_local_table(conn, local, table, columns):
+
+    logging.info(f"Copying {table.path} into the local store...")
+
+    try:
+        start = time.perf_counter()
+        query = f"SELECT {', '.join(columns)} FROM {table.path}"
+        insert = f'INSERT INTO "{table.name}" ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})'
+
+        counter = 0
+        with local:
+            local.execute(f'DELETE FROM "{table.name}"')
+            for chunk in pd.read_sql(query, conn, chunksize=100000):
+                if table.key_date:
+                    chunk[table.key_date] = pd.to_datetime(chunk[table.key_date])
+                values = chunk.astype(object).where(chunk.notna(), None)
+                local.executemany(insert, list(values.itertuples(index=False, name=None)))
+                counter += len(chunk.index)
+
+        logging.info(f"SUCCESS: sync_local_table({table.name}) - {counter} rows in {time.perf_counter() - start:.2f}s\n")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: sync_local_table({table.name})\n")
+        raise
@@ -1,16 +1,65 @@
-import glob
-import os.path
-import csv
+import numpy as np
 import pandas as pd
 from datetime import date, datetime, timedelta
-import pyodbc
 import logging
-import argparse
 import variables
+from functions_trace import traced
 
 
 
+# Raw columns general_parse reads from any feed
+parse_columns = ['Status', 'Activity Code', 'ActivityCode', 'Completion Date', 'CompletionDate',
+                 'Score', 'Student ID', 'Student Email', 'Student Username']
+
+# Dtypes pinned when streaming csv feeds
+parse_dtypes = {'Activity Code': str, 'ActivityCode': str, 'Student ID': str, 'Student Email': str}
+
+
+# pyarrow available for Arrow-backed strings (checked once)
+arrow_strings = {}
+
+
+# Concrete dtype for a frame_schema entry
+def schema_dtype(dtype):
+    if dtype == 'string':
+        if 'available' not in arrow_strings:
+            try:
+                import pyarrow
+                arrow_strings['available'] = True
+            except ImportError:
+                arrow_strings['available'] = False
+        return pd.StringDtype('pyarrow') if arrow_strings['available'] else pd.StringDtype()
+    return dtype
+
+
+# Cast the schema's columns to their compact dtypes, in place (callers pass frames they own)
+def apply_schema(dataframe, schema=None):
+
+    schema = schema or variables.frame_schema
+
+    for column, dtype in schema.items():
+        if column not in dataframe.columns:
+            continue
+
+        target = schema_dtype(dtype)
+        series = dataframe[column]
+        if series.dtype == target:
+            continue
+
+        if dtype.startswith('datetime64'):
+            dataframe[column] = pd.to_datetime(series, errors='coerce').astype(target)
+        elif dtype.startswith('int'):
+            dataframe[column] = pd.to_numeric(series, errors='coerce').fillna(0).astype(target)
+        elif dtype.startswith('Int'):
+            dataframe[column] = pd.to_numeric(series, errors='coerce').astype(target)
+        else:
+            dataframe[column] = series.astype(target)
+
+    return dataframe
+
+
 # General df parse
+@traced
 def general_parse(dataframe, file_instance):
 
     logging.info(f"Parsing file: {file_instance.name}")
@@ -90,7 +139,82 @@ def general_parse(dataframe, file_instance):
     return df
 
     
+# Fast df parse - explicit formats and dtypes, driven by variables.feed_column_maps
+@traced
+def general_parse_fast(dataframe, file_instance, window_days=200):
+
+    logging.info(f"Parsing file (fast): {file_instance.name}")
+
+    mapping = variables.feed_column_maps.get(file_instance.nickname, variables.feed_column_maps['default'])
+    df = pd.DataFrame()
+
+    # First source column present in this feed for each output column
+    source = {}
+    for column, candidates in mapping.items():
+        for candidate in candidates:
+            if candidate in dataframe.columns:
+                source[column] = dataframe[candidate]
+                break
+
+    try:
+        # Parse dates once, with the feed's format when it has one
+        completion = pd.to_datetime(source['CompletionDate'], format=file_instance.date_format or None,
+                                    errors='coerce', cache=True).dt.normalize()
+
+        # Build one row mask so every column is copied once
+        keep = pd.Series(True, index=dataframe.index)
+        if 'Status' in source:
+            keep &= source['Status'] == 4
+
+        if file_instance.fileType == 'csv':
+            # Filter for CompletionDate >= 6 months ago
+            cutoff_date = pd.Timestamp.now().normalize() - pd.Timedelta(days=window_days)
+            logging.info(f"Cutoff date = {cutoff_date}")
+            keep &= completion >= cutoff_date
+
+        columns = {}
+        columns['ActivityCode'] = source['ActivityCode'][keep].astype('string')
+        columns['CompletionDate'] = completion[keep]
+
+        if 'Score' in source:
+            columns['Score'] = pd.to_numeric(source['Score'][keep], errors='coerce').fillna(0)
+
+        # Email normalized in one chain on the filtered rows only
+        if 'Email' in source:
+            columns['Email'] = source['Email'][keep].astype('string').str.strip().str.lower().fillna('BLANK')
+
+        if 'EmpID' in source:
+            columns['EmpID'] = pd.to_numeric(source['EmpID'][keep], errors='coerce').astype('Int64')
+
+        df = apply_schema(pd.DataFrame(columns).reset_index(drop=True))
+
+        # Log Number of Rows in DataFrame
+        logging.debug(f"Number of rows in DataFrame: {len(df.index)}")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: general_parse_fast({file_instance.name})")
+        raise  # A feed whose columns changed must fail its stage, not load (and record) an empty frame
+
+    return df
+
+
+# General parse over a stream of chunks (generator)
+@traced
+def general_parse_chunks(chunks, file_instance):
+
+    rows = 0
+
+    for chunk in chunks:
+        df = general_parse_fast(chunk, file_instance)
+        rows += len(df.index)
+        yield df
+
+    logging.info(f"SUCCESS: general_parse_chunks({file_instance.name}) - {rows} rows kept")
+
+
 # Merge for active activities
+@traced
 def dfs_merge(df_left, df_right):
 
     df = pd.DataFrame()
@@ -107,39 +231,68 @@ def dfs_merge(df_left, df_right):
 
 
 
+# Format a date column once per distinct value and map the strings back
+def format_dates(series, date_format):
+
+    codes, uniques = pd.factorize(pd.to_datetime(series))
+    if len(uniques) == 0:
+        return pd.Series([None] * len(codes), index=series.index, dtype=object)
+
+    formatted = np.asarray(uniques.strftime(date_format), dtype=object)
+    return pd.Series(np.where(codes >= 0, formatted[codes], None), index=series.index, dtype=object)
+
+
+# Build the variable columns of an output template (constants are left to the writer)
+@traced
+def template_parse(dataframe, template):
+    logging.info("Performing template_parse()")
+
+    df = pd.DataFrame()
+
+    try:
+        columns = {}
+        for column in template:
+            if column.source is None:
+                continue
+            if column.date_format:
+                columns[column.name] = format_dates(dataframe[column.source], column.date_format)
+            else:
+                columns[column.name] = dataframe[column.source]
+
+        df = pd.DataFrame(columns, index=dataframe.index)
+
+        logging.info("SUCCESS: template_parse()\n")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical("FAIL: template_parse()\n")
+
+    return df
+
+
+# Full output frame, constants included
+def materialize_template(dataframe, template):
+
+    df = pd.DataFrame(index=dataframe.index)
+    for column in template:
+        if column.source is None:
+            df[column.name] = column.value
+        else:
+            df[column.name] = dataframe[column.name]
+
+    return df
+
+
 # Final df parse - required static values
+@traced
 def final_parse(dataframe):
     logging.info("Performing final_parse()")
 
     df = pd.DataFrame()
 
     try:
-        df['EmployeeNumber'] = dataframe['Email']
-        df['ActivityCode'] = dataframe['ActivityCode']
-        df['ClassStartDate'] = None
-        df['RegistrationDate'] = None
-
-        df['CompletionDate'] = pd.to_datetime(dataframe['CompletionDate'])
-        df.loc[:, 'CompletionDate'] = df['CompletionDate'].dt.strftime('%m/%d/%Y') + ' 09:00'
-
-        df['FirstLaunchDate'] = None
-        df['Score'] = dataframe['Score']
-        df['Passed'] = 1
-        df['CancellationDate'] = None
-        df['PaymentTerm'] = None
-        df['Cost'] = None
-        df['Currency'] = None
-        df['Timezone'] = 'America/Phoenix'
-        df['Status'] = 4
-        df['Notes'] = None
-        df['SubscriptionSourceActivityCode'] = None
-        df['SubscriptionSourceActivityStartDate'] = None
-        df['ElapsedTime'] = None
-        df['CompletionStatus'] = 1
-        df['Location_Name'] = None
-        df['Slotstart_Date'] = None
-        df['Slotend_Date'] = None
-        df['EmpID'] = dataframe['EmpID']
+        df = materialize_template(template_parse(dataframe, variables.sumtotal_template),
+                                  variables.sumtotal_template)
 
         logging.info("SUCCESS: final_parse()\n")
 
@@ -147,4 +300,4 @@ def final_parse(dataframe):
         logging.critical(f"Error occurred: {e}")
         logging.critical("FAIL: final_parse()\n")
     
-    return df
\ No newline at end of file
+    return df
@@ -0,0 +1,179 @@
+import time
+import logging
+import threading
+from functions_trace import call_profiled, record_trace, current_rss_mb
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+
+# Pipeline stage - func(results) runs once every stage in deps has succeeded
+# and every stage in after has finished, whatever its outcome (ordering only);
+# stages sharing a group are held to the run's per-group limit, and a release stage's
+# result is dropped from the results once every stage depending on it has finished
+class pipeline_stage:
+    def __init__(self, name, func, deps=(), locks=(), after=(), group=None, release=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.locks = list(locks)
+        self.after = list(after)
+        self.group = group
+        self.release = release
+
+
+# Returned by a stage to skip everything downstream of it without failing the run
+class skip_branch:
+    def __init__(self, reason):
+        self.reason = reason
+
+
+# Named locks shared by stages that must not overlap (e.g. mastercompletions writes)
+pipeline_locks = {}
+pipeline_locks_guard = threading.Lock()
+
+
+def pipeline_lock(name):
+    with pipeline_locks_guard:
+        if name not in pipeline_locks:
+            pipeline_locks[name] = threading.Lock()
+        return pipeline_locks[name]
+
+
+# Run one stage holding its locks
+def run_stage(stage, results):
+
+    locks = [pipeline_lock(name) for name in sorted(stage.locks)]
+    for lock in locks:
+        lock.acquire()
+
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    status = 'ok'
+
+    try:
+        logging.debug(f"Stage started: {stage.name}")
+        result = call_profiled(stage.name, stage.func, results)
+        logging.info(f"Stage finished: {stage.name} ({time.perf_counter() - start:.2f}s)")
+        return result
+
+    except BaseException:
+        status = 'error'
+        raise
+
+    finally:
+        record_trace(f"stage:{stage.name}", time.perf_counter() - start, time.thread_time() - cpu_start, status=status,
+                     rss_mb=current_rss_mb())
+        for lock in reversed(locks):
+            lock.release()
+
+
+# Log the stage graph in the order it can run (--dry-run)
+def log_pipeline_plan(stages, limits=None):
+
+    limits = limits or {}
+    waves = {}
+    wave = 0
+    remaining = {stage.name: stage for stage in stages}
+
+    # Wave n = stages whose deps and after-stages are all in earlier waves
+    while remaining:
+        ready = [name for name, stage in remaining.items()
+                 if all(dep in waves for dep in stage.deps + stage.after)]
+        if not ready:
+            raise ValueError(f"Pipeline has a dependency cycle: {', '.join(remaining)}")
+        for name in ready:
+            waves[name] = wave
+            del remaining[name]
+        wave += 1
+
+    logging.info(f"Dry run: {len(stages)} stages in {wave} waves")
+    for stage in sorted(stages, key=lambda stage: waves[stage.name]):
+        details = []
+        if stage.deps:
+            details.append(f"deps {', '.join(stage.deps)}")
+        if stage.after:
+            details.append(f"after {', '.join(stage.after)}")
+        if stage.locks:
+            details.append(f"locks {', '.join(stage.locks)}")
+        if stage.group in limits:
+            details.append(f"{stage.group} (max {limits[stage.group]})")
+        logging.info(f"  [{waves[stage.name]}] {stage.name}" + (f" - {'; '.join(details)}" if details else ""))
+
+
+# Run stages as a dependency graph on a thread pool
+# limits = {group: stages of that group allowed to run at once}
+def run_pipeline(stages, max_workers=4, limits=None):
+
+    stages = {stage.name: stage for stage in stages}
+    for stage in stages.values():
+        for dep in stage.deps + stage.after:
+            if dep not in stages:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}")
+
+    limits = limits or {}
+    results = {}
+    status = {}
+    running = {}
+    consumers = {name: [other.name for other in stages.values() if name in other.deps] for name in stages}
+
+    logging.info(f"Running pipeline: {len(stages)} stages, {max_workers} workers")
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+        while len(status) < len(stages):
+
+            # Skip anything downstream of a failed, skipped or short-circuited stage
+            changed = True
+            while changed:
+                changed = False
+                for name, stage in stages.items():
+                    upstream = [status.get(dep) for dep in stage.deps]
+                    if name in status or not any(state in ('failed', 'skipped', 'short-circuit') for state in upstream):
+                        continue
+                    status[name] = 'skipped' if 'failed' in upstream else 'short-circuit'
+                    changed = True
+                    if status[name] == 'skipped':
+                        logging.warning(f"Stage skipped: {name}")
+                    else:
+                        logging.info(f"Stage short-circuited: {name}")
+
+            # Drop results nothing will read any more (frames are freed as soon as their consumers finish)
+            for name, stage in stages.items():
+                if stage.release and name in results and all(consumer in status for consumer in consumers[name]):
+                    del results[name]
+                    logging.debug(f"Stage result released: {name}")
+
+            # Submit every stage whose dependencies are done (while its group is under its limit)
+            for name, stage in stages.items():
+                if (name not in status and name not in running
+                        and all(status.get(dep) == 'done' for dep in stage.deps)
+                        and all(dep in status for dep in stage.after)):
+                    if stage.group in limits:
+                        in_group = sum(1 for other in running if stages[other].group == stage.group)
+                        if in_group >= limits[stage.group]:
+                            continue
+                    running[name] = executor.submit(run_stage, stage, results)
+
+            if not running:
+                # Nothing runnable and nothing running - the remaining stages wait on each other
+                blocked = [name for name in stages if name not in status]
+                if blocked:
+                    raise ValueError(f"Pipeline has a dependency cycle: {', '.join(blocked)}")
+                continue
+
+            finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+            for name in [name for name, future in running.items() if future in finished]:
+                future = running.pop(name)
+                try:
+                    results[name] = future.result()
+                    status[name] = 'done'
+                    if isinstance(results[name], skip_branch):
+                        status[name] = 'short-circuit'
+                        logging.info(f"Stage {name} short-circuited its branch: {results[name].reason}")
+                except Exception as e:
+                    status[name] = 'failed'
+                    logging.critical(f"Error occurred: {e}")
+                    logging.critical(f"FAIL: stage {name}")
+
+    logging.info(f"Pipeline finished in {time.perf_counter() - start:.2f}s")
+    return results, status
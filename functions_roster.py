@@ -0,0 +1,141 @@
+import os.path
+import time
+import sqlite3
+import pandas as pd
+import logging
+import variables
+from functions_trace import traced
+from functions_sql import table_ref
+from functions_parse import apply_schema
+
+
+
+# Open (and create) the local roster store
+def open_roster_store(settings):
+
+    store_dir = os.path.dirname(settings.path)
+    if store_dir and not os.path.exists(store_dir):
+        logging.debug("Roster cache directory does not exist. Creating...")
+        os.makedirs(store_dir)
+
+    store = sqlite3.connect(settings.path)
+    store.execute("CREATE TABLE IF NOT EXISTS roster (ein INTEGER PRIMARY KEY, email TEXT)")
+    store.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return store
+
+
+def read_meta(store, key):
+    row = store.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def write_meta(store, key, value):
+    store.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+# True while the local roster is inside its TTL
+def roster_is_fresh(settings):
+
+    if not os.path.exists(settings.path):
+        return False
+
+    store = open_roster_store(settings)
+    try:
+        refreshed = read_meta(store, 'refreshed')
+    finally:
+        store.close()
+
+    return refreshed is not None and time.time() - float(refreshed) < settings.ttl
+
+
+# Refresh the local roster from VW_EmployeeRoster (delta when a delta column is configured)
+@traced
+def refresh_roster(conn, table_roster, settings):
+
+    logging.info(f"Refreshing roster cache from {table_ref(conn, table_roster)}")
+
+    store = open_roster_store(settings)
+
+    try:
+        delta_column = settings.delta_column
+        high_water = read_meta(store, 'high_water') if delta_column else None
+
+        columns = "EIN, EmployeeEmailAddress" + (f", {delta_column}" if delta_column else "")
+        query = f"SELECT {columns} FROM {table_ref(conn, table_roster)} WHERE EIN IS NOT NULL"
+        params = None
+        if high_water is not None:
+            query += f" AND {delta_column} > ?"
+            params = [high_water]
+
+        df = pd.read_sql(query, conn, params=params)
+        ein = pd.to_numeric(df['EIN'], errors='coerce')
+        keep = ein.notna()
+        rows = [(int(number), None if pd.isna(email) else str(email))
+                for number, email in zip(ein[keep], df['EmployeeEmailAddress'][keep])]
+
+        with store:
+            # A full pull replaces the roster so leavers drop out
+            if high_water is None:
+                store.execute("DELETE FROM roster")
+            store.executemany("INSERT INTO roster (ein, email) VALUES (?, ?) "
+                              "ON CONFLICT(ein) DO UPDATE SET email = excluded.email", rows)
+            write_meta(store, 'refreshed', time.time())
+            if delta_column and len(df.index) > 0:
+                write_meta(store, 'high_water', df[delta_column].max())
+
+        mode = "delta" if high_water is not None else "full"
+        logging.info(f"SUCCESS: refresh_roster() - {len(rows)} rows ({mode})\n")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical("FAIL: refresh_roster()\n")
+
+    finally:
+        store.close()
+
+
+# EIN -> email map from the local store
+@traced
+def load_roster(settings):
+
+    roster = pd.Series([], dtype=object)
+
+    try:
+        store = open_roster_store(settings)
+        try:
+            df = pd.read_sql("SELECT ein, email FROM roster", store)
+        finally:
+            store.close()
+
+        roster = pd.Series(df['email'].to_numpy(), index=df['ein'].astype('int64'))
+        logging.info(f"Roster cache loaded: {len(roster)} employees")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: load_roster({settings.path})")
+
+    return roster
+
+
+# Fill the tmp table's email column from the roster (in-memory hash join on EmpID)
+def enrich_emails(dataframe, roster, table):
+
+    email = table.key_email
+
+    if roster is None or len(dataframe.index) == 0 or 'EmpID' not in dataframe.columns:
+        return dataframe
+
+    try:
+        df = dataframe.copy()
+        df[email] = df['EmpID'].map(roster)
+        apply_schema(df)
+
+        matched = int(df[email].notna().sum())
+        logging.debug(f"enrich_emails(): {matched}/{len(df.index)} rows matched the roster")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical("FAIL: enrich_emails()")
+        df = dataframe
+
+    return df
@@ -0,0 +1,176 @@
+import json
+import time
+import signal
+import logging
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+# State kept warm between service cycles (a one-off run leaves persistent off and closes everything at the end)
+class warm_state:
+    def __init__(self, persistent=False):
+        self.persistent = persistent
+        self.connections = None
+        self.feed_pool = None
+        self.catalog = None
+        self.roster = None
+        self.key_state = None
+        # Report emails still sending (joined when the service stops)
+        self.reports = []
+
+
+# Service counters for /health and /metrics
+class service_metrics:
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.polls = 0
+        self.cycles = 0
+        self.cycles_failed = 0
+        self.stages_failed = 0
+        self.rows_merged = {}
+        self.last_poll = None
+        self.last_cycle = None
+        self.last_success = None
+        self.next_poll = None
+
+    # Record a finished cycle
+    def cycle_finished(self, started, seconds, status, rows_merged):
+        failed = sum(1 for state in status.values() if state in ('failed', 'skipped'))
+
+        with self.lock:
+            self.cycles += 1
+            self.stages_failed += failed
+            if failed:
+                self.cycles_failed += 1
+            else:
+                self.last_success = time.time()
+            for feed, rows in rows_merged.items():
+                self.rows_merged[feed] = self.rows_merged.get(feed, 0) + (rows or 0)
+            self.last_cycle = {'started': datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+                               'seconds': round(seconds, 1),
+                               'stages': {state: sum(1 for value in status.values() if value == state)
+                                          for state in set(status.values())}}
+
+    # /health document
+    def health(self):
+        with self.lock:
+            healthy = self.last_cycle is None or self.last_cycle['stages'].get('failed', 0) == 0
+            return {'status': 'ok' if healthy else 'degraded',
+                    'uptime_s': round(time.time() - self.started),
+                    'poll_interval_s': self.poll_interval,
+                    'polls': self.polls,
+                    'cycles': self.cycles,
+                    'last_poll': stamp(self.last_poll),
+                    'last_success': stamp(self.last_success),
+                    'next_poll': stamp(self.next_poll),
+                    'last_cycle': self.last_cycle}
+
+    # /metrics (Prometheus text format)
+    def metrics(self):
+        with self.lock:
+            lines = [f"tracorp_uptime_seconds {time.time() - self.started:.0f}",
+                     f"tracorp_polls_total {self.polls}",
+                     f"tracorp_cycles_total {self.cycles}",
+                     f"tracorp_cycles_failed_total {self.cycles_failed}",
+                     f"tracorp_stages_failed_total {self.stages_failed}"]
+            if self.last_cycle:
+                lines.append(f"tracorp_last_cycle_seconds {self.last_cycle['seconds']}")
+            if self.last_success:
+                lines.append(f"tracorp_last_success_timestamp_seconds {self.last_success:.0f}")
+            for feed, rows in sorted(self.rows_merged.items()):
+                lines.append(f'tracorp_rows_merged_total{{feed="{feed}"}} {rows}')
+        return "\n".join(lines) + "\n"
+
+
+# ISO timestamp (None stays None)
+def stamp(seconds):
+    return datetime.fromtimestamp(seconds).isoformat(timespec='seconds') if seconds else None
+
+
+# Local health/metrics endpoint on a background thread
+def start_health_server(host, port, metrics):
+
+    class health_handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') == '/health':
+                body, content_type = json.dumps(metrics.health(), indent=2), 'application/json'
+            elif self.path.rstrip('/') == '/metrics':
+                body, content_type = metrics.metrics(), 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404)
+                return
+
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(f"health endpoint: {format % args}")
+
+    server = ThreadingHTTPServer((host, port), health_handler)
+    thread = threading.Thread(target=server.serve_forever, name="health", daemon=True)
+    thread.start()
+    logging.info(f"Health endpoint on http://{host}:{port}/health and /metrics")
+
+    return server
+
+
+# Send new log records to log_file (the previous cycle's file is closed)
+def switch_log_file(log_file):
+
+    root = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.FileHandler):
+            formatter = handler.formatter or formatter
+            root.removeHandler(handler)
+            handler.close()
+
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(formatter)
+    root.addHandler(file_handler)
+    logging.debug("Log file: " + log_file)
+
+
+# Poll loop - run_cycle() whenever poll() reports new input, until SIGINT/SIGTERM
+def run_service(settings, poll, run_cycle, metrics):
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logging.info(f"Signal {signum} received - stopping after the current cycle")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    logging.info(f"Service started: polling every {settings.poll_interval}s")
+
+    while not stop.is_set():
+        poll_started = time.time()
+
+        try:
+            with metrics.lock:
+                metrics.polls += 1
+                metrics.last_poll = poll_started
+
+            if poll():
+                run_cycle()
+
+        except Exception as e:
+            logging.critical(f"Error occurred: {e}")
+            logging.critical("FAIL: service cycle")
+
+        with metrics.lock:
+            metrics.next_poll = poll_started + settings.poll_interval
+        stop.wait(max(poll_started + settings.poll_interval - time.time(), 0))
+
+    logging.info("Service stopped")
@@ -0,0 +1,218 @@
+import os.path
+import json
+import hashlib
+import time
+import logging
+import threading
+import variables
+
+
+
+# Read/write block size for transfers
+block_size = 256 * 1024
+
+
+# Open an SFTP session with paramiko
+def open_sftp_session(sftp_info):
+
+    # Loaded with the first session, not at import
+    import paramiko
+
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+
+    if sftp_info.known_hosts:
+        client.load_host_keys(sftp_info.known_hosts)
+        client.set_missing_host_key_policy(paramiko.RejectPolicy())
+    else:
+        client.set_missing_host_key_policy(paramiko.WarningPolicy())
+
+    client.connect(hostname=sftp_info.sftpurl, port=sftp_info.port, username=sftp_info.username,
+                   key_filename=sftp_info.key, look_for_keys=False, allow_agent=False)
+
+    sftp = client.open_sftp()
+    # Keep the SSH client alive as long as the SFTP session
+    sftp.ssh_client = client
+    return sftp
+
+
+# SFTP transfers - one reusable session per host/user, resumable by offset.
+# connect(sftp_info) -> paramiko.SFTPClient can be swapped for a local paramiko test server.
+# Partial downloads and upload resume records go in partial_dir (next to the local file when None),
+# so they outlive a cleared temp directory and resume on the next run.
+class sftp_transfer_manager:
+    def __init__(self, connect=open_sftp_session, partial_dir=None):
+        self.connect = connect
+        self.partial_dir = partial_dir
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    # Where a partial transfer of file_name waits for the next attempt
+    def partial_path(self, local_dir, file_name):
+        partial_dir = self.partial_dir or local_dir
+        if not os.path.exists(partial_dir):
+            os.makedirs(partial_dir)
+        return os.path.join(partial_dir, file_name)
+
+    # Reuse the session for this host/user while its transport is alive
+    def session(self, sftp_info):
+        key = (sftp_info.sftpurl, sftp_info.port, sftp_info.username)
+
+        with self.lock:
+            sftp = self.sessions.get(key)
+            if sftp is not None:
+                transport = sftp.get_channel().get_transport()
+                if transport is not None and transport.is_active():
+                    return sftp
+                logging.info(f"SFTP session to {sftp_info.sftpurl} is closed - reconnecting")
+
+            start = time.perf_counter()
+            sftp = self.connect(sftp_info)
+            self.sessions[key] = sftp
+            logging.info(f"SFTP session opened to {sftp_info.sftpurl} in {time.perf_counter() - start:.2f}s")
+            return sftp
+
+    # Download remote file to local_dir, resuming a partial download
+    def download(self, sftp_info, local_dir, remote_path=None):
+        remote_path = remote_path or sftp_info.file
+        local_file = os.path.join(local_dir, os.path.basename(remote_path))
+        part_file = self.partial_path(local_dir, os.path.basename(remote_path) + ".part")
+        meta_file = part_file + ".json"
+
+        sftp = self.session(sftp_info)
+        remote = sftp.stat(remote_path)
+        identity = {'host': sftp_info.sftpurl, 'path': remote_path, 'size': remote.st_size, 'mtime': remote.st_mtime}
+
+        # Resume only a partial of this exact remote file
+        offset = 0
+        if os.path.exists(part_file) and os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                if json.load(f) == identity:
+                    offset = min(os.path.getsize(part_file), remote.st_size)
+        if offset == 0:
+            with open(meta_file, "w") as f:
+                json.dump(identity, f)
+
+        logging.info(f"Downloading {remote_path} ({remote.st_size} bytes, resuming at {offset})")
+        start = time.perf_counter()
+
+        with sftp.open(remote_path, "rb") as remote_file, open(part_file, "ab" if offset else "wb") as f:
+            remote_file.seek(offset)
+            # Pipelined reads of everything still missing
+            remote_file.prefetch(remote.st_size)
+            while True:
+                data = remote_file.read(block_size)
+                if not data:
+                    break
+                f.write(data)
+
+        os.replace(part_file, local_file)
+        os.remove(meta_file)
+
+        log_rate("Downloaded", remote_path, remote.st_size - offset, time.perf_counter() - start)
+        return local_file
+
+    # Cheap identity of a remote file (size and mtime) for change detection without reading it
+    def remote_identity(self, sftp_info, remote_path=None):
+        remote = self.session(sftp_info).stat(remote_path or sftp_info.file)
+        return f"{remote.st_size}:{int(remote.st_mtime)}"
+
+    # Open a remote file for streaming reads (prefetch runs in the background)
+    def open_remote(self, sftp_info, remote_path=None):
+        remote_path = remote_path or sftp_info.file
+        sftp = self.session(sftp_info)
+        remote_file = sftp.open(remote_path, "rb")
+        remote_file.prefetch()
+        return remote_file
+
+    # Upload local_file next to sftp_info.file, resuming a partial upload
+    def upload(self, sftp_info, local_file, remote_dir=None):
+        remote_dir = remote_dir or os.path.dirname(sftp_info.file)
+        remote_path = remote_dir.rstrip("/") + "/" + os.path.basename(local_file)
+        part_path = remote_path + ".part"
+        size = os.path.getsize(local_file)
+        meta_file = self.partial_path(os.path.dirname(local_file), os.path.basename(local_file) + ".upload.json")
+        identity = {'host': sftp_info.sftpurl, 'path': remote_path, 'size': size, 'sha256': upload_sha256(local_file)}
+
+        sftp = self.session(sftp_info)
+
+        # Resume only a remote partial this exact file started (any other .part is overwritten)
+        offset = 0
+        if os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                if json.load(f) == identity:
+                    try:
+                        offset = sftp.stat(part_path).st_size
+                    except IOError:
+                        pass
+        if offset > size:
+            offset = 0
+        if offset == 0:
+            with open(meta_file, "w") as f:
+                json.dump(identity, f)
+
+        logging.info(f"Uploading {local_file} to {remote_path} ({size} bytes, resuming at {offset})")
+        start = time.perf_counter()
+
+        with open(local_file, "rb") as f, sftp.open(part_path, "r+b" if offset else "wb") as remote_file:
+            f.seek(offset)
+            remote_file.seek(offset)
+            # Don't wait for each write to be acknowledged
+            remote_file.set_pipelined(True)
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                remote_file.write(data)
+
+        # paramiko drops the status of a failed pipelined write - the partial must hold the whole file before it goes live
+        written = sftp.stat(part_path).st_size
+        if written != size:
+            raise IOError(f"Upload of {local_file} left {written} of {size} bytes in {part_path}")
+
+        # Replace the previous upload only once the new one is complete
+        try:
+            sftp.posix_rename(part_path, remote_path)
+        except IOError:
+            try:
+                sftp.remove(remote_path)
+            except IOError:
+                pass
+            sftp.rename(part_path, remote_path)
+        os.remove(meta_file)
+
+        log_rate("Uploaded", remote_path, size - offset, time.perf_counter() - start)
+        return remote_path
+
+    # Close every session
+    def close_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+
+        for sftp in sessions:
+            try:
+                sftp.close()
+                if getattr(sftp, 'ssh_client', None) is not None:
+                    sftp.ssh_client.close()
+            except Exception:
+                pass
+
+
+# SHA-256 of a file to upload (ties a remote partial to its source)
+def upload_sha256(file):
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Log transfer throughput
+def log_rate(action, path, transferred, seconds):
+    rate = transferred / seconds if seconds > 0 else 0
+    logging.info(f"{action} {path}: {transferred} bytes in {seconds:.2f}s ({rate / 2**20:.2f} MB/s)")
+
+
+# Shared manager for the run
+transfers = sftp_transfer_manager()
@@ -1,16 +1,20 @@
-import glob
 import os.path
-import csv
 import pandas as pd
-from datetime import date, datetime, timedelta
-import pyodbc
 import logging
-import argparse
+import time
+import sqlite3
+import getpass
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import variables
+from functions_trace import traced
+from functions_parse import apply_schema
 
 
 
 # Connect to SQL Servers
+@traced
 def connect_sql_server(server_instance):
 
     conn = None
@@ -31,6 +35,7 @@ def connect_sql_server(server_instance):
 
 
     try:
+        import pyodbc
         conn = pyodbc.connect('DRIVER='+driver+';SERVER='+server+';DATABASE=' +
                               database+';UID='+user+';Trusted_Connection=yes;TrustServerCertificate=yes')
         cursor = conn.cursor()
@@ -46,11 +51,308 @@ def connect_sql_server(server_instance):
 
 
 
+# SQL Server connection string
+def connection_string(server_instance):
+    return ('DRIVER=' + server_instance.driver + ';SERVER=' + server_instance.server +
+            ';DATABASE=' + server_instance.database + ';UID=' + server_instance.user +
+            ';Trusted_Connection=yes;TrustServerCertificate=yes')
+
+
+
+# Lazy, pooled SQL Server connections keyed by server name
+class connection_manager:
+    def __init__(self, servers, retries=2):
+        self.servers = {server.server: server for server in servers}
+        self.retries = retries
+        self.idle = {name: [] for name in self.servers}
+        self.pending = {}
+        self.connect_times = {name: [] for name in self.servers}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.servers), 1), thread_name_prefix="sql-connect")
+
+    # Open a new connection and time it
+    def open_connection(self, name):
+        server_instance = self.servers[name]
+
+        logging.info(f"Connecting to SQL Server {name}...")
+        logging.debug("SQL Server Connection String: " + connection_string(server_instance))
+        logging.debug("Current User: " + getpass.getuser())
+
+        # Loaded with the first connection, not at import
+        import pyodbc
+
+        start = time.perf_counter()
+        conn = pyodbc.connect(connection_string(server_instance))
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.connect_times[name].append(elapsed)
+
+        logging.info(f"SUCCESS: connect_sql_server({name}) in {elapsed:.2f}s")
+        return conn
+
+    # Start connecting in the background (parallel across servers)
+    def prefetch(self, names):
+        with self.lock:
+            for name in names:
+                if name not in self.pending and not self.idle[name]:
+                    self.pending[name] = self.executor.submit(self.open_connection, name)
+
+    # Cheap round trip to catch stale sessions
+    def validate(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception as e:
+            logging.warning(f"Stale SQL Server connection: {e}")
+            return False
+
+    # Check out a validated connection - an idle one, else the background connect, else a new one
+    # (a background connect is only taken when it is used, so close_all still sees it otherwise)
+    def acquire(self, name):
+        with self.lock:
+            conn = self.idle[name].pop() if self.idle[name] else None
+
+        if conn is not None and not self.validate(conn):
+            close_quietly(conn)
+            conn = None
+
+        if conn is None:
+            with self.lock:
+                pending = self.pending.pop(name, None)
+
+            if pending is not None:
+                try:
+                    conn = pending.result()
+                except Exception as e:
+                    logging.warning(f"Background connect to {name} failed: {e}")
+
+            if conn is not None and not self.validate(conn):
+                close_quietly(conn)
+                conn = None
+
+        attempt = 0
+        while conn is None:
+            attempt += 1
+            try:
+                conn = self.open_connection(name)
+            except Exception as e:
+                logging.critical(e)
+                logging.critical(f"FAIL: connect_sql_server({name}) attempt {attempt}/{self.retries}\n")
+                if attempt >= self.retries:
+                    raise ConnectionError(f"Could not connect to SQL Server {name}") from e
+
+        return conn
+
+    # Check out / return around a with block
+    @contextmanager
+    def connection(self, name):
+        conn = self.acquire(name)
+        try:
+            yield conn
+        finally:
+            self.release(name, conn)
+
+    # Return a connection to the pool
+    def release(self, name, conn):
+        with self.lock:
+            self.idle[name].append(conn)
+
+    # Close every pooled connection
+    def close_all(self):
+        with self.lock:
+            pending = list(self.pending.values())
+            idle = [conn for conns in self.idle.values() for conn in conns]
+            self.pending = {}
+            self.idle = {name: [] for name in self.servers}
+
+        for future in pending:
+            try:
+                idle.append(future.result())
+            except Exception:
+                pass
+
+        for conn in idle:
+            close_quietly(conn)
+
+    # Log connect latency per server
+    def log_connect_stats(self):
+        for name, times in self.connect_times.items():
+            if times:
+                logging.info(f"SQL Server {name}: {len(times)} connect(s), "
+                             f"avg {sum(times) / len(times):.2f}s, max {max(times):.2f}s")
+
+
+
+# SQL dialect of a connection/cursor - 'sqlite' for the local store (--no-sql), 'mssql' otherwise
+def sql_dialect(conn):
+    if isinstance(conn, (sqlite3.Connection, sqlite3.Cursor)):
+        return 'sqlite'
+    return 'mssql'
+
+
+# Table reference - the configured path on SQL Server, the bare table name in the local store
+def table_ref(conn, table):
+    if sql_dialect(conn) == 'sqlite':
+        return f'"{table.name}"'
+    return table.path
+
+
+# Empty a tmp table before a load (SQLite has no TRUNCATE)
+def truncate_statement(conn, tablePath):
+    if sql_dialect(conn) == 'sqlite':
+        return f"DELETE FROM {tablePath};"
+    return f"TRUNCATE TABLE {tablePath};"
+
+
+# Close a connection, ignoring errors
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+
 # Insert dfs into database
+@traced
 def insert_query(conn, dataframe, table):
 
     tableName = table.name
-    tablePath = table.path
+    tablePath = table_ref(conn, table)
+    tableType = table.table_type
+    batchSize = table.batch_size
+
+    # batch_size = 0 keeps the legacy row-by-row path (for comparison)
+    if batchSize <= 0:
+        return insert_query_rowwise(conn, dataframe, table)
+
+    logging.info(f"Bulk inserting df into table: {tablePath}")
+
+    try:
+        # Log Number of Rows in DataFrame
+        dfLength = len(dataframe.index)
+        logging.info(f"Number of rows in {tableName}: {dfLength}")
+        logging.info(f"Batch size: {batchSize}")
+
+        start = time.perf_counter()
+
+        # Create a cursor - the whole load runs in one transaction
+        cursor = conn.cursor()
+        if sql_dialect(conn) == 'mssql':
+            cursor.fast_executemany = True
+
+        # Truncate the table
+        if tableType == 'tmp':
+            cursor.execute(truncate_statement(conn, tablePath))
+
+        counter = insert_batches(cursor, dataframe, tablePath, batchSize)
+
+        conn.commit()
+        cursor.close()
+
+        elapsed = time.perf_counter() - start
+        rate = counter / elapsed if elapsed > 0 else 0
+        logging.info(f"{tablePath}: {counter} rows in {elapsed:.2f}s ({rate:,.0f} rows/sec, bulk)")
+        logging.info(f"SUCCESS: insert_query({tablePath}) \n")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        conn.rollback()  # Roll back changes if an error occurs
+        logging.critical(f"FAIL: insert_query({tableName}) \n")
+        raise  # Later stages must not merge a half-loaded tmp table
+
+
+
+# Insert a stream of dfs into database in one transaction
+@traced
+def insert_query_chunks(conn, chunks, table):
+
+    tableName = table.name
+    tablePath = table_ref(conn, table)
+    tableType = table.table_type
+    batchSize = table.batch_size if table.batch_size > 0 else 1000
+
+    logging.info(f"Streaming chunks into table: {tablePath}")
+
+    try:
+        start = time.perf_counter()
+
+        cursor = conn.cursor()
+        if sql_dialect(conn) == 'mssql':
+            cursor.fast_executemany = True
+
+        # Truncate the table
+        if tableType == 'tmp':
+            cursor.execute(truncate_statement(conn, tablePath))
+
+        # Each chunk is parsed and inserted before the next one is read
+        counter = 0
+        for chunk in chunks:
+            counter += insert_batches(cursor, chunk, tablePath, batchSize)
+            logging.debug(f"{tablePath}: Inserted chunk... {counter} rows so far")
+
+        conn.commit()
+        cursor.close()
+
+        elapsed = time.perf_counter() - start
+        rate = counter / elapsed if elapsed > 0 else 0
+        logging.info(f"{tablePath}: {counter} rows in {elapsed:.2f}s ({rate:,.0f} rows/sec, streamed)")
+        logging.info(f"SUCCESS: insert_query_chunks({tablePath}) \n")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        conn.rollback()  # Roll back changes if an error occurs
+        logging.critical(f"FAIL: insert_query_chunks({tableName}) \n")
+        raise  # Later stages must not merge a half-loaded tmp table
+
+
+
+# Send one df to an open cursor in executemany() batches (caller commits)
+def insert_batches(cursor, dataframe, tablePath, batchSize):
+
+    if len(dataframe.index) == 0:
+        return 0
+
+    # Local tables pick up columns the frame brings (SQL Server tables are defined up front)
+    if sql_dialect(cursor) == 'sqlite':
+        from functions_local import ensure_local_columns
+        ensure_local_columns(cursor, tablePath, dataframe.columns)
+
+    # Define the SQL query dynamically with placeholders for parameterized values
+    columns = ','.join(dataframe.columns)
+    placeholders = ','.join(['?' for _ in dataframe.columns])
+    query = f"""
+    INSERT INTO {tablePath}
+        ({columns})
+        VALUES
+        ({placeholders})
+    """
+
+    # NaN/NaT -> None so they go over the wire as NULL
+    values = dataframe.astype(object).where(dataframe.notna(), None)
+    rows = list(values.itertuples(index=False, name=None))
+
+    counter = 0
+    for offset in range(0, len(rows), batchSize):
+        batch = rows[offset:offset + batchSize]
+        cursor.executemany(query, batch)
+        counter += len(batch)
+        logging.debug(f"{tablePath}: Inserted batch... {counter}/{len(rows)}")
+
+    return counter
+
+
+
+# Insert dfs into database - one row and one commit at a time
+@traced
+def insert_query_rowwise(conn, dataframe, table):
+
+    tableName = table.name
+    tablePath = table_ref(conn, table)
     tableType = table.table_type
 
     logging.info(f"Inserting df into table: {tablePath}")
@@ -62,17 +364,18 @@ def insert_query(conn, dataframe, table):
 
         # Write to log every 5% of rows
         logInt = int(dfLength) / 20
-        logInt = round(logInt)
+        logInt = max(round(logInt), 1)
         logging.info("Log interval: " + str(logInt))
 
         counter = 0
+        start = time.perf_counter()
 
         # Create a cursor
         cursor = conn.cursor()
 
         # Truncate the table
         if tableType == 'tmp':
-            cursor.execute(f"TRUNCATE TABLE {tablePath};")
+            cursor.execute(truncate_statement(conn, tablePath))
             conn.commit()
 
         # Iterate over rows in the DataFrame
@@ -104,6 +407,9 @@ def insert_query(conn, dataframe, table):
         # Close the cursor and connection
         cursor.close()
 
+        elapsed = time.perf_counter() - start
+        rate = counter / elapsed if elapsed > 0 else 0
+        logging.info(f"{tablePath}: {counter} rows in {elapsed:.2f}s ({rate:,.0f} rows/sec, row-by-row)")
         logging.info(f"SUCCESS: insert_query({tablePath}) \n")
 
     except Exception as e:
@@ -113,35 +419,52 @@ def insert_query(conn, dataframe, table):
 
 
 
-# Adotmaster - join for correct email address
-def correct_email(conn):
+# Adotmaster - join for correct email address (fallback for rows the roster cache missed)
+@traced
+def correct_email(conn, table_tmp, table_roster):
+
+    tmpPath = table_ref(conn, table_tmp)
+    tmpEmail = table_tmp.key_email
+    rosterPath = table_ref(conn, table_roster)
 
     logging.info("Querying for correct email")
 
     try:
         cursor = conn.cursor()
 
-        null_check_query = """
+        null_check_query = f"""
         SELECT COUNT(*)
-        FROM [eric].[dbo].[tmp_Tracorp_Daily]
-        WHERE Email_adotmaster IS NULL
+        FROM {tmpPath}
+        WHERE {tmpEmail} IS NULL
         """
 
         cursor.execute(null_check_query)
         null_count = cursor.fetchone()[0]
+        logging.info(f"Rows without {tmpEmail}: {null_count}")
 
         if null_count > 0:
 
-            query = """ 
+            query = f""" 
             UPDATE tc 
-            SET tc.Email_adotmaster = am.EmployeeEmailAddress
-            FROM [eric].[dbo].[tmp_Tracorp_Daily] AS tc
-            JOIN [adotmaster].[dbo].[VW_EmployeeRoster] AS am ON tc.EmpID = am.EIN;
+            SET tc.{tmpEmail} = am.EmployeeEmailAddress
+            FROM {tmpPath} AS tc
+            JOIN {rosterPath} AS am ON tc.EmpID = am.EIN
+            WHERE tc.{tmpEmail} IS NULL;
             """
 
+            # SQLite: the target is named in UPDATE and its columns are unqualified in SET
+            if sql_dialect(conn) == 'sqlite':
+                query = f"""
+                UPDATE {tmpPath} AS tc
+                SET {tmpEmail} = am.EmployeeEmailAddress
+                FROM {rosterPath} AS am
+                WHERE tc.EmpID = am.EIN
+                    AND tc.{tmpEmail} IS NULL;
+                """
+
             cursor.execute(query)
             conn.commit()
-            logging.info("Emails updated in tmp_Tracorp_Daily")
+            logging.info(f"Emails updated in {table_tmp.name}")
 
 
         cursor.close()
@@ -155,11 +478,12 @@ def correct_email(conn):
 
 
 # General remove duplicates
+@traced
 def general_distinct_query(conn, table_left, table_right):
 
     tableLeft_name = table_left.name
     tableLeft_database = table_left.path
-    tableLeft_path = table_left.path
+    tableLeft_path = table_ref(conn, table_left)
     tableLeft_type = table_left.table_type
     tableLeft_email = table_left.key_email
     tableLeft_activity = table_left.key_activity
@@ -167,7 +491,7 @@ def general_distinct_query(conn, table_left, table_right):
 
     tableRight_name = table_right.name
     tableRight_database = table_right.database
-    tableRight_path= table_right.path
+    tableRight_path= table_ref(conn, table_right)
     tableRight_type = table_right.table_type
     tableRight_email = table_right.key_email
     tableRight_activity = table_right.key_activity
@@ -220,3 +544,135 @@ def general_distinct_query(conn, table_left, table_right):
 
     return df
 
+
+
+
+# Rows of a tmp table the merge will leave out for want of an email - (ActivityCode, EmpID, CompletionDate)
+@traced
+def unmatched_email_rows(conn, table_tmp):
+
+    tmpPath = table_ref(conn, table_tmp)
+    tmpEmail = table_tmp.key_email
+    tmpActivity = table_tmp.key_activity
+    tmpDate = table_tmp.key_date
+
+    try:
+        query = f"""
+        SELECT {tmpActivity} AS ActivityCode, EmpID, {tmpDate} AS CompletionDate
+        FROM {tmpPath}
+        WHERE {tmpEmail} IS NULL
+            OR {tmpEmail} = 'BLANK'
+        """
+
+        cursor = conn.cursor()
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        cursor.close()
+
+        df = pd.DataFrame.from_records(rows, columns=['ActivityCode', 'EmpID', 'CompletionDate'])
+        # Local dates are stored as text
+        df['CompletionDate'] = pd.to_datetime(df['CompletionDate'])
+        logging.info(f"Rows without {tmpEmail} in {tmpPath}: {len(df.index)}")
+
+    except Exception as e:
+        logging.critical(f"FAIL: unmatched_email_rows({tmpPath})")
+        logging.critical(f"Error occurred: {e} \n")
+        raise  # The watermark must not move without knowing what the merge leaves out
+
+    return df
+
+
+
+
+# Set-based merge of new rows from a tmp table into mastercompletions
+@traced
+def merge_new_rows(conn, table_left, table_right, return_rows=False):
+
+    tableLeft_path = table_ref(conn, table_left)
+    tableLeft_email = table_left.key_email
+    tableLeft_activity = table_left.key_activity
+    tableLeft_date = table_left.key_date
+
+    tableRight_path = table_ref(conn, table_right)
+    tableRight_email = table_right.key_email
+    tableRight_activity = table_right.key_activity
+    tableRight_date = table_right.key_date
+
+    logging.info(f"Merging new rows from {tableLeft_path} into {tableRight_path}")
+
+    df = None
+
+    # Only ship the inserted rows back when a later stage needs them
+    # (OUTPUT inserted.* on SQL Server, RETURNING at the end of the statement in the local store)
+    sqlite = sql_dialect(conn) == 'sqlite'
+    output = ""
+    returning = ""
+    if return_rows and not sqlite:
+        output = f"""
+        OUTPUT
+            inserted.{tableRight_activity},
+            inserted.{tableRight_email} AS Email,
+            inserted.EmpID,
+            inserted.{tableRight_date},
+            inserted.Score"""
+    elif return_rows:
+        returning = f"""
+        RETURNING
+            {tableRight_activity},
+            {tableRight_email} AS Email,
+            EmpID,
+            {tableRight_date},
+            Score"""
+
+    try:
+        query = f"""
+        INSERT INTO {tableRight_path}
+            ({tableRight_activity}, {tableRight_email}, EmpID, {tableRight_date}, Score){output}
+        SELECT
+            l.{tableLeft_activity},
+            l.{tableLeft_email},
+            l.EmpID,
+            l.{tableLeft_date},
+            l.Score
+        FROM
+            {tableLeft_path} AS l
+        WHERE
+            l.{tableLeft_email} IS NOT NULL
+            AND l.{tableLeft_email} <> 'BLANK'
+            AND NOT EXISTS (
+                SELECT 1
+                FROM {tableRight_path} AS r
+                WHERE r.{tableRight_activity} = l.{tableLeft_activity}
+                    AND r.{tableRight_email} = l.{tableLeft_email}
+                    AND r.{tableRight_date} = l.{tableLeft_date}
+            ){returning};
+        """
+
+        cursor = conn.cursor()
+        cursor.execute(query)
+
+        if return_rows:
+            rows = cursor.fetchall()
+            columns = [column[0] for column in cursor.description]
+            df = pd.DataFrame.from_records(rows, columns=columns)
+            # Local dates are stored as text
+            if sqlite:
+                df[tableRight_date] = pd.to_datetime(df[tableRight_date])
+            apply_schema(df)
+            inserted = len(df.index)
+        else:
+            inserted = cursor.rowcount
+
+        conn.commit()
+        cursor.close()
+
+        logging.info(f"Rows inserted into {tableRight_path}: {inserted}")
+        logging.info(f"SUCCESS: merge_new_rows({tableLeft_path}) \n")
+
+    except Exception as e:
+        logging.critical(f"FAIL: merge_new_rows({tableLeft_path})")
+        logging.critical(f"Error occurred: {e} \n")
+        conn.rollback()  # Roll back changes if an error occurs
+        raise  # Watermarks and the key index only move after a successful merge
+
+    return df
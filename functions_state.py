@@ -0,0 +1,199 @@
+import os.path
+import json
+import threading
+import numpy as np
+import pandas as pd
+import logging
+import variables
+from functions_key_index import key_strings, string_digests, key_digests
+
+
+
+# Run-state store - a small JSON document shared by every stage of a run
+state_lock = threading.Lock()
+
+
+# Load run state (empty when there is none yet)
+def load_run_state(settings):
+
+    if not os.path.exists(settings.path):
+        return {}
+
+    with open(settings.path, "r") as state_file:
+        return json.load(state_file)
+
+
+# Set state[section][key] = value and save (write then rename)
+def update_run_state(settings, section, key, value):
+
+    with state_lock:
+        state = load_run_state(settings)
+        state.setdefault(section, {})[key] = value
+
+        state_dir = os.path.dirname(settings.path)
+        if state_dir and not os.path.exists(state_dir):
+            logging.debug("Run state directory does not exist. Creating...")
+            os.makedirs(state_dir)
+
+        tmp_path = settings.path + ".tmp"
+        with open(tmp_path, "w") as state_file:
+            json.dump(state, state_file, indent=2, default=str)
+        os.replace(tmp_path, settings.path)
+
+    logging.debug(f"Run state updated: {section}.{key}")
+
+
+# # Watermarks - last completion date processed per feed, plus the keys seen on that day and the rows left out
+# without an email (retried behind the watermark until retry_days after they were first left out)
+
+# Stored watermark for a feed (None = no watermark yet)
+def load_watermark(settings, nickname):
+
+    watermark = load_run_state(settings).get('watermarks', {}).get(nickname)
+    if watermark:
+        logging.info(f"Watermark for {nickname}: {watermark['date']} ({len(watermark['keys'])} boundary keys, "
+                     f"{len(watermark.get('retry', {}))} rows to retry)")
+    else:
+        logging.info(f"No watermark for {nickname} - processing the full window")
+
+    return watermark
+
+
+# Tracker for the watermark this run will leave behind, seeded from the stored one
+def start_watermark(watermark):
+
+    if not watermark:
+        return {'date': None, 'keys': set(), 'retry': {}}
+
+    return {'date': pd.Timestamp(watermark['date']), 'keys': set(int(key) for key in watermark['keys']),
+            'retry': {int(key): first for key, first in watermark.get('retry', {}).items()}}
+
+
+# Digest (activity, email, employee, completion date) - a row's identity on the watermark day
+# (EmpID tells apart employees who share the 'BLANK' email)
+def boundary_digests(dataframe):
+
+    keys = key_strings(dataframe, 'ActivityCode', 'Email', 'CompletionDate')
+    if 'EmpID' in dataframe.columns:
+        keys = keys + "|" + pd.to_numeric(dataframe['EmpID'], errors='coerce').astype('Int64').astype(str)
+    return string_digests(keys)
+
+
+# Digest (activity, employee, completion date) - a left-out row's identity before and after its email is filled
+def retry_digests(dataframe):
+
+    df = pd.DataFrame({'ActivityCode': dataframe['ActivityCode'],
+                       'EmpID': pd.to_numeric(dataframe['EmpID'], errors='coerce').astype('Int64')
+                                if 'EmpID' in dataframe.columns else pd.NA,
+                       'CompletionDate': dataframe['CompletionDate']})
+    return key_digests(df, 'ActivityCode', 'EmpID', 'CompletionDate')
+
+
+# Keep rows after the watermark, rows on the watermark day that were not seen before, and left-out rows to retry
+def apply_watermark(dataframe, watermark):
+
+    if not watermark or len(dataframe.index) == 0:
+        return dataframe
+
+    date = pd.Timestamp(watermark['date'])
+    completion = dataframe['CompletionDate']
+
+    keep = (completion > date).to_numpy(copy=True)
+    boundary = (completion == date).to_numpy()
+
+    if boundary.any():
+        digests = boundary_digests(dataframe.loc[boundary])
+        seen = np.isin(digests, np.array([int(key) for key in watermark['keys']], dtype=np.uint64))
+        keep[np.flatnonzero(boundary)[~seen]] = True
+
+    retried = 0
+    behind = np.flatnonzero(~keep)
+    if watermark.get('retry') and len(behind):
+        again = np.isin(retry_digests(dataframe.iloc[behind]), np.array([int(key) for key in watermark['retry']], dtype=np.uint64))
+        keep[behind[again]] = True
+        retried = int(again.sum())
+
+    logging.info(f"Watermark {date.date()}: {int(keep.sum()) - retried}/{len(keep)} rows at or past it, {retried} left-out rows retried")
+    return dataframe.loc[keep].reset_index(drop=True)
+
+
+# Move the tracker forward over rows processed this run
+def observe_watermark(pending, dataframe):
+
+    if len(dataframe.index) == 0:
+        return
+
+    completion = dataframe['CompletionDate']
+    latest = completion.max()
+    if pd.isna(latest):
+        return
+
+    if pending['date'] is None or latest > pending['date']:
+        pending['date'] = latest
+        pending['keys'] = set()
+    elif latest < pending['date']:
+        return
+
+    on_day = dataframe.loc[(completion == pending['date']).to_numpy()]
+    pending['keys'].update(int(key) for key in boundary_digests(on_day))
+
+
+# Watermark filter + tracker for a parsed frame or chunk
+def watermark_rows(dataframe, watermark, pending):
+
+    df = apply_watermark(dataframe, watermark)
+    observe_watermark(pending, df)
+    return df
+
+
+# Remember the rows the merge left out (no email yet - e.g. a new hire not on the roster) so the next runs process
+# them again behind the watermark; a row never matched (blank student ID, EmpID never on the roster) is given up
+# retry_days after it was first left out
+def retry_unmatched_rows(pending, unmatched, retry_days):
+
+    today = pd.Timestamp.now().normalize()
+    retry = {}
+    for digest in (retry_digests(unmatched) if len(unmatched.index) else []):
+        retry[int(digest)] = pending['retry'].get(int(digest), today.strftime('%Y-%m-%d'))
+
+    expired = {key: first for key, first in retry.items() if today - pd.Timestamp(first) > pd.Timedelta(days=retry_days)}
+    if expired:
+        logging.warning(f"{len(expired)} rows left out without an email since {min(expired.values())} - "
+                        f"no longer retried after {retry_days} days")
+
+    pending['retry'] = {key: first for key, first in retry.items() if key not in expired}
+    if pending['retry']:
+        logging.info(f"{len(pending['retry'])} rows left out without an email - retried next run")
+
+
+# Persist the tracker once the feed's rows are merged
+def save_watermark(settings, nickname, pending):
+
+    if pending['date'] is None:
+        return
+
+    watermark = {'date': pending['date'].strftime('%Y-%m-%d'), 'keys': sorted(pending['keys']),
+                 'retry': {str(key): first for key, first in sorted(pending['retry'].items())}}
+    update_run_state(settings, 'watermarks', nickname, watermark)
+    logging.info(f"Watermark for {nickname} advanced to {watermark['date']} ({len(watermark['keys'])} boundary keys)")
+
+
+# # Input fingerprints - content hash of each input at its last successful run
+
+# Previous fingerprint record when the input is unchanged (None otherwise)
+def unchanged_input(settings, nickname, file_hash):
+
+    record = load_run_state(settings).get('inputs', {}).get(nickname)
+    if record and record.get('hash') == file_hash:
+        return record
+
+    return None
+
+
+# Record an input's fingerprint once its branch has finished
+def save_input_fingerprint(settings, nickname, file_hash, seconds):
+
+    record = {'hash': file_hash, 'seconds': round(seconds, 1),
+              'recorded': pd.Timestamp.now().isoformat(timespec='seconds')}
+    update_run_state(settings, 'inputs', nickname, record)
+    logging.info(f"Fingerprint recorded for {nickname}: {file_hash[:12]}... ({record['seconds']}s branch)")
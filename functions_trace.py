@@ -0,0 +1,242 @@
+import os.path
+import sys
+import json
+import time
+import cProfile
+import logging
+import inspect
+import threading
+import functools
+from datetime import datetime
+
+# Memory readings - psutil when installed, else the resource module (POSIX only)
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+
+# Run profile - one record per traced call, written next to the log file
+run_profile = {'started': datetime.now().isoformat(timespec='seconds'), 'stages': []}
+run_profile_lock = threading.Lock()
+
+# Stage / function names to run under cProfile (--profile) and where to put the .prof files
+profile_settings = {'stages': set(), 'path': '.'}
+
+# What the peak RSS reading covers: 'process' (since start-up) or 'run' (since reset_run_profile() cleared it)
+peak_rss_scope = {'self': 'process'}
+
+
+# Start a new run profile (service mode, one per cycle) - and a new peak RSS where the OS allows it
+def reset_run_profile():
+    with run_profile_lock:
+        run_profile['started'] = datetime.now().isoformat(timespec='seconds')
+        run_profile['stages'] = []
+        run_profile.pop('finished', None)
+        run_profile.pop('memory', None)
+    peak_rss_scope['self'] = 'run' if reset_peak_rss() else 'process'
+
+
+# Reset the kernel's peak RSS (VmHWM) of this process (Linux only; False where it can't be reset)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Peak RSS from /proc/self/status, in MB (None off Linux)
+def proc_peak_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 2**10, 1)
+    except OSError:
+        pass
+    return None
+
+
+# Set up --profile
+def configure_tracing(profile_stages, profile_path):
+    profile_settings['stages'] = set(profile_stages or [])
+    profile_settings['path'] = profile_path
+
+
+# Resident set size right now, in MB (None without psutil)
+def current_rss_mb():
+    if psutil is None:
+        return None
+    return round(psutil.Process().memory_info().rss / 2**20, 1)
+
+
+# Peak resident set size in MB - this process over peak['scope'] ('run' once reset_run_profile() could reset it,
+# else 'process'), and finished worker processes over the whole process lifetime
+def peak_rss_mb():
+
+    peak = {'self': proc_peak_rss_mb(), 'children': None, 'scope': peak_rss_scope['self']}
+
+    if peak['self'] is None and psutil is not None:
+        memory = psutil.Process().memory_info()
+        # peak_wset on Windows; elsewhere psutil only has the current RSS
+        if getattr(memory, 'peak_wset', None):
+            peak['self'] = round(memory.peak_wset / 2**20, 1)
+
+    if resource is not None:
+        # ru_maxrss is KB on Linux, bytes on macOS
+        scale = 2**20 if sys.platform == 'darwin' else 2**10
+        if peak['self'] is None:
+            peak['self'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+        peak['children'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+
+    if peak['self'] is None:
+        peak['self'] = current_rss_mb()
+
+    # Only VmHWM can be reset - any other reading covers the process lifetime
+    if proc_peak_rss_mb() is None:
+        peak['scope'] = 'process'
+
+    return peak
+
+
+# Rows in a DataFrame-like value (None for anything else)
+def row_count(value):
+    if hasattr(value, 'index') and hasattr(value, 'columns'):
+        return len(value.index)
+    return None
+
+
+# Append one record to the run profile
+def record_trace(name, wall, cpu, rows_in=None, rows_out=None, status='ok', rss_mb=None):
+
+    rows = rows_out if rows_out is not None else rows_in
+    record = {'stage': name,
+              'thread': threading.current_thread().name,
+              'wall_s': round(wall, 4),
+              'cpu_s': round(cpu, 4),
+              'rows_in': rows_in,
+              'rows_out': rows_out,
+              'rows_per_s': round(rows / wall, 1) if rows and wall > 0 else None,
+              'status': status}
+    if rss_mb is not None:
+        record['rss_mb'] = rss_mb
+
+    with run_profile_lock:
+        run_profile['stages'].append(record)
+
+    logging.debug(f"trace {name}: {record['wall_s']}s wall, {record['cpu_s']}s cpu, "
+                  f"rows {rows_in} -> {rows_out}")
+
+
+# Run func under cProfile when its name was asked for with --profile
+def call_profiled(name, func, *args, **kwargs):
+
+    if name not in profile_settings['stages']:
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        stamp = datetime.now().strftime("%H%M%S%f")
+        prof_file = os.path.join(profile_settings['path'], f"profile_{name}_{stamp}.prof")
+        profiler.dump_stats(prof_file)
+        logging.info(f"cProfile for {name} written to {prof_file}")
+
+
+# Decorator - wall time, CPU time and row counts per call
+def traced(func):
+
+    name = func.__name__
+
+    # Generators are timed across the whole iteration, one chunk at a time
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            wall = 0.0
+            cpu = 0.0
+            rows_out = 0
+            status = 'ok'
+            generator = func(*args, **kwargs)
+            try:
+                while True:
+                    wall_start = time.perf_counter()
+                    cpu_start = time.thread_time()
+                    try:
+                        chunk = call_profiled(name, next, generator)
+                    except StopIteration:
+                        break
+                    finally:
+                        wall += time.perf_counter() - wall_start
+                        cpu += time.thread_time() - cpu_start
+                    rows_out += row_count(chunk) or 0
+                    yield chunk
+            except GeneratorExit:
+                status = 'closed'
+                raise
+            except BaseException:
+                status = 'error'
+                raise
+            finally:
+                generator.close()
+                record_trace(name, wall, cpu, rows_out=rows_out, status=status)
+
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        rows_in = next((row_count(arg) for arg in args if row_count(arg) is not None), None)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        status = 'ok'
+        result = None
+        try:
+            result = call_profiled(name, func, *args, **kwargs)
+            return result
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            record_trace(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start,
+                         rows_in=rows_in, rows_out=row_count(result), status=status)
+
+    return wrapper
+
+
+# Write the run profile as JSON next to the log file
+def write_run_profile(log_file):
+
+    profile_file = os.path.splitext(log_file)[0] + ".profile.json"
+
+    try:
+        with run_profile_lock:
+            run_profile['finished'] = datetime.now().isoformat(timespec='seconds')
+            # Peak RSS of this run where it can be reset per cycle (peak_rss_scope = run), else of the process so far;
+            # worker peaks always cover the process lifetime; plus the highest stage-end reading of this run
+            peak = peak_rss_mb()
+            stage_rss = [record['rss_mb'] for record in run_profile['stages'] if record.get('rss_mb') is not None]
+            run_profile['memory'] = {'peak_rss_mb': peak['self'], 'peak_rss_scope': peak['scope'],
+                                     'peak_rss_workers_mb': peak['children'],
+                                     'max_stage_rss_mb': max(stage_rss) if stage_rss else None}
+            profile = dict(run_profile)
+
+        with open(profile_file, "w") as f:
+            json.dump(profile, f, indent=2, default=str)
+
+        logging.info(f"Peak RSS ({peak['scope']}): {profile['memory']['peak_rss_mb']} MB "
+                     f"(finished workers, process lifetime: {profile['memory']['peak_rss_workers_mb']} MB)")
+        logging.info(f"Run profile written to {profile_file}")
+
+    except Exception as e:
+        logging.critical(f"Error occurred: {e}")
+        logging.critical(f"FAIL: write_run_profile({profile_file})")
+
+    return profile_file
@@ -1,18 +1,32 @@
-import glob
 import os.path
-import csv
-import pandas as pd
-from datetime import date, datetime, timedelta
-import pyodbc
+from datetime import datetime
 import logging
 import argparse
 import configparser
+import importlib
+import shutil
+import time
 
-# Custom modules
+# Custom modules (standard library only - fast to import)
 from variables import *
-from functions_sql import *
-from functions_in_out import *
-from functions_parse import *
+from functions_trace import *
+from functions_pipeline import *
+from functions_service import *
+
+# Pipeline modules (pandas, numpy) - loaded by load_pipeline_modules() once a command needs them,
+# so --help and --check-config never import them; pyodbc and paramiko load with the first connection
+pipeline_modules = ['functions_sql', 'functions_in_out', 'functions_parse', 'functions_key_index', 'functions_catalog',
+                    'functions_roster', 'functions_state', 'functions_archive', 'functions_feeds', 'functions_local']
+
+
+# Same as "from module import *" for every pipeline module
+def load_pipeline_modules():
+    start = time.perf_counter()
+    for module_name in pipeline_modules:
+        module = importlib.import_module(module_name)
+        names = getattr(module, '__all__', [name for name in vars(module) if not name.startswith('_')])
+        globals().update({name: getattr(module, name) for name in names})
+    logging.debug(f"Pipeline modules loaded in {time.perf_counter() - start:.2f}s")
 
 
 # Parse Arguments
@@ -20,24 +34,42 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", help="Configuration file path", default="config.ini")
     parser.add_argument("-p", "--path", help="Working directory", default=".")
-    parser.add_argument("-n", "--no-sql", help="Execute without connecting to SQL Server", action="store_true")
+    parser.add_argument("-n", "--no-sql", help="Run against the local store ([local_store]) instead of SQL Server", action="store_true")
     parser.add_argument("-d", "--debug", help="Debug mode", action="store_true")
     parser.add_argument("-v", "--verbose", help="Enable verbose console", action="store_true")
+    parser.add_argument("-w", "--workers", help="Pipeline stages run at once", type=int, default=4)
+    parser.add_argument("--processes", help="Worker processes parsing whole-file feeds, e.g. xlsx (chunked/streamed csv feeds always parse on their stage thread; 0 = no pool)", type=int, default=2)
+    parser.add_argument("--full-window", help="Ignore ingestion watermarks and reprocess the whole 200-day window", action="store_true")
+    parser.add_argument("-f", "--force", help="Process inputs even when they match the last successful run", action="store_true")
+    parser.add_argument("--profile", help="Capture cProfile output for a stage or function (repeatable)", action="append", metavar="STAGE", default=[])
+    parser.add_argument("--check-config", help="Validate the configuration file and exit", action="store_true")
+    parser.add_argument("--dry-run", help="Log the stage graph the run would execute and exit (no SQL, SFTP or email)", action="store_true")
+    parser.add_argument("--service", help="Keep running and poll the feed sources on the [service] schedule", action="store_true")
+    parser.add_argument("--sync-local", help="Copy mastercompletions and the roster from SQL Server into the local store and exit", action="store_true")
+    parser.add_argument("--archive-prune", help="Apply archive retention and exit", action="store_true")
+    parser.add_argument("--archive-lookup", help="List the runs that archived a file (path or SHA-256) and exit", metavar="FILE")
+    parser.add_argument("--rebuild-key-index", help="Rebuild the mastercompletions key index and exit", action="store_true")
+    parser.add_argument("--check-key-index", help="Check the mastercompletions key index against SQL Server and exit", action="store_true")
     args = parser.parse_args()
     return args
 
 
 
-# Setup logging
-def setup_logging(path, debug):
+# Log file for a run starting now
+def log_file_name(path):
     # Get current datetime in YYYYMMDDHHMM format
     now = datetime.now().strftime("%Y%m%d%H%M")
     log_path = os.path.join(path, "logs")
-    log_file = os.path.join(log_path, "reformatTracorp_" + now + ".log")
     # Create log directory if it doesn't exist
     if not os.path.exists(log_path):
         logging.debug("Log directory does not exist. Creating...")
         os.makedirs(log_path)
+    return os.path.join(log_path, "reformatTracorp_" + now + ".log")
+
+
+# Setup logging
+def setup_logging(path, debug):
+    log_file = log_file_name(path)
 
     if debug:
         log_level = logging.DEBUG
@@ -79,208 +111,69 @@ def read_config(configFilePath):
 
 
 
-def download_file(host_url, host_username, file_path, key_path, temp_path):
-    logging.info("Downloading file from TraCorp SFTP...")
-    logging.debug("SFTP URL: " + host_url)
-    logging.debug("SFTP Username: " + host_username)
-    logging.debug("SFTP File Path: " + file_path)
-    logging.debug("SFTP Key Path: " + key_path)
-
-    try:
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        with pysftp.Connection(host=host_url, username=host_username, private_key=key_path, cnopts=cnopts) as sftp:
-            sftp.get(file_path)
-            sftp.close()
-    except Exception as e:
-        logging.critical("Error downloading file from SFTP")
-        logging.critical(e)
-    else:
-        file_name = os.path.basename(file_path)
-        file = os.path.join(temp_path, file_name)
-        logging.info("File downloaded successfully.")
-        logging.debug("File path: " + file)
-        return file
-
-
-
-
-
-
-# Upload file to SFTP
-def upload_file(host_url, host_username, file_path, key_path, file):
-    logging.info("Uploading file to SumTotal SFTP...")
-    logging.debug("SFTP URL: " + host_url)
-    logging.debug("SFTP Username: " + host_username)
-    logging.debug("SFTP File Path: " + file_path)
-    logging.debug("SFTP Key Path: " + key_path)
-    logging.debug("File path: " + file)
-
-    try:
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        with pysftp.Connection(host=host_url, username=host_username, private_key=key_path, cnopts=cnopts) as sftp:
-            sftp.chdir(os.path.dirname(file_path))
-            sftp.put(file)
-            sftp.close()
-    except Exception as e:
-        logging.critical("Error uploading file to SFTP")
-        logging.critical(e)
-    
-    else:
-        logging.info("File uploaded successfully.")
-
-
-
-# Email Log and Files
-def email_log_and_files(email_from, email_to, email_server, email_port, log_file, tracorp_file, sumtotal_file, modified_file):
-    # Email log file
-    logging.info("Emailing log and files...")
-
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = email_from
-        msg['To'] = email_to
-        msg['Subject'] = "SumTotalLMS_TraCorp Transform and Upload Log"
-        email_body = "Please see attached log file and files for SumTotalLMS_TraCorp Transform and Upload."
-        
+# SQL connections - SQL Server, or the local store with --no-sql
+def sql_connections(config):
+    if args.no_sql:
+        local_store = local_store_instance(config)[0]
+        local_store.path = os.path.join(args.path, local_store.path)
+        logging.info(f"No SQL mode: using the local store {local_store.path}")
+        return local_connection_manager(local_store, table_instance(config))
+    return connection_manager(server_instance(config))
 
-        # Attach log file
-        # Test if log file exists
-        if os.path.exists(log_file): 
-            attachment = open(log_file, "rb")
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload((attachment).read())
-            attachment.close()
-            part.add_header(
-                'Content-Disposition', "attachment; filename= %s" % log_file)
-            msg.attach(part)
-        else: 
-            email_body = email_body + "\n\nLog file not found."
-
-        # Attach tracorp file
-        # Test if tracorp file exists
-        if os.path.exists(tracorp_file):
-            attachment = open(tracorp_file, "rb")
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload((attachment).read())
-            attachment.close()
-            part.add_header('Content-Disposition',
-                            "attachment; filename= %s" % tracorp_file)
-            msg.attach(part)
-        else:
-            email_body = email_body + "\n\nTraCorp file not found."
-
-        # Attach sumtotal file
-        # Test if sumtotal file exists
-        if os.path.exists(sumtotal_file):
-            attachment = open(sumtotal_file, "rb")
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload((attachment).read())
-            attachment.close()
-            part.add_header('Content-Disposition',
-                            "attachment; filename= %s" % sumtotal_file)
-            msg.attach(part)
-        else:
-            email_body = email_body + "\n\nSumTotal file not found."
-
-        # Attach modified file
-        # Test if modified file exists
-        if os.path.exists(modified_file):
-            attachment = open(modified_file, "rb")
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload((attachment).read())
-            attachment.close()
-            part.add_header('Content-Disposition',
-                            "attachment; filename= %s" % modified_file)
-            msg.attach(part)
-        else:
-            email_body = email_body + "\n\nModified file not found."
 
-        # Attach email body
-        msg.attach(MIMEText(email_body, 'plain'))
+# Key index maintenance (--rebuild-key-index / --check-key-index)
+def key_index_command(config):
 
-        # Send email
-        server = smtplib.SMTP(email_server, email_port)
-        server.starttls()
-        text = msg.as_string()
-        server.sendmail(email_from, email_to, text)
-        server.quit()
-    except Exception as e:
-        logging.critical("Error emailing log and files")
-        logging.critical(e)
-        
-    else:
-        logging.info("Log and files emailed successfully")
+    table_mastercompletions = table_instance(config)[3]
+    server_aidwsql = server_instance(config)[1]
+    key_index = key_index_instance(config)[0]
+    key_index.path = os.path.abspath(os.path.join(args.path, key_index.path))
 
+    connections = sql_connections(config)
+    conn_aidwsql = connections.acquire(server_aidwsql.server)
 
+    if args.rebuild_key_index:
+        rebuild_key_index(conn_aidwsql, table_mastercompletions, key_index)
 
-# Archive Files
-def archive_files(tracorp_file, sumtotal_file, modified_file):
-    logging.info("Archiving files...")
-    # Setup File Archive Paths
-    archive_root = os.path.join(args.path, 'archive')
-    archive_date = datetime.now().strftime("%Y%m%d%H%M")
-    archive_path = os.path.join(archive_root, archive_date)
-    logging.debug("Archive path: " + archive_path)
+    if args.check_key_index:
+        check_key_index(conn_aidwsql, table_mastercompletions, key_index)
 
-    # Create Archive Root Directory if it doesn't exist
-    if not os.path.exists(archive_root):
-        logging.debug("Archive root directory does not exist. Creating...")
-        os.makedirs(archive_root)
+    connections.release(server_aidwsql.server, conn_aidwsql)
+    connections.close_all()
 
-    # Create archive directory if it doesn't exist
-    if not os.path.exists(archive_path):
-        logging.debug("Archive directory does not exist. Creating...")
-        os.makedirs(archive_path)
 
-    # New File Paths
-    tracorp_archive = os.path.join(
-        archive_path, os.path.basename(tracorp_file))
-    sumtotal_archive = os.path.join(
-        archive_path, os.path.basename(sumtotal_file))
-    modified_archive = os.path.join(
-        archive_path, os.path.basename(modified_file))
+# Refresh the local store's mastercompletions and roster copies from SQL Server (--sync-local)
+def local_store_command(config):
 
-    logging.debug("TraCorp archive path: " + tracorp_archive)
-    logging.debug("SumTotal archive path: " + sumtotal_archive)
-    logging.debug("Modified archive path: " + modified_archive)
+    server_sql11worke = server_instance(config)[0]
+    server_aidwsql = server_instance(config)[1]
+    table_vw_emp_roster = table_instance(config)[0]
+    table_mastercompletions = table_instance(config)[3]
+    local_store = local_store_instance(config)[0]
+    local_store.path = os.path.join(args.path, local_store.path)
 
-    # Copy files to archive directory
-    logging.debug("Copying files to archive directory...")
+    connections = connection_manager(server_instance(config))
+    local_connections = local_connection_manager(local_store, table_instance(config))
 
     try:
-        logging.debug("Copying " + tracorp_file + " to " + tracorp_archive)
-        shutil.copy2(tracorp_file, tracorp_archive)
-    except Exception as e:
-        logging.critical("Error copying " + tracorp_file + " to " + tracorp_archive)
-        logging.critical(e)
-    else:
-        logging.debug("TraCorp file copied successfully")
-    try:
-        logging.debug("Copying " + sumtotal_file + " to " + sumtotal_archive)
-        shutil.copy2(sumtotal_file, sumtotal_archive)
-    except Exception as e:
-        logging.critical("Error copying " + sumtotal_file + " to " + sumtotal_archive)
-        logging.critical(e)
-    else:
-        logging.debug("SumTotal file copied successfully")
-    try:
-        logging.debug("Copying " + modified_file + " to " + modified_archive)
-        shutil.copy2(modified_file, modified_archive)
-    except Exception as e:
-        logging.critical("Error copying " + modified_file + " to " + modified_archive)
-        logging.critical(e)
-    else:
-        logging.debug("Modified file copied successfully")
-
+        with local_connections.connection('local') as local:
+            with connections.connection(server_aidwsql.server) as conn_aidwsql:
+                sync_local_table(conn_aidwsql, local, table_mastercompletions,
+                                 [table_mastercompletions.key_activity, table_mastercompletions.key_email, 'EmpID',
+                                  table_mastercompletions.key_date, 'Score'])
+            with connections.connection(server_sql11worke.server) as conn_sql11worke:
+                sync_local_table(conn_sql11worke, local, table_vw_emp_roster, ['EIN', 'EmployeeEmailAddress'])
+    finally:
+        connections.close_all()
+        local_connections.close_all()
 
 
 
 
+# Main - warm carries connections, caches and the parse pool between service cycles
+def main(log_file, config, warm=None):
 
-# Main
-def main(log_file, config):
+    warm = warm or warm_state()
 
     # # Class Instances
     # SQL Servers
@@ -294,26 +187,18 @@ def main(log_file, config):
     tables = table_instance(config)
     for index, table in enumerate(tables, start=1):
         table_vw_emp_roster = table_instance(config)[0]
-        table_tmp_xlsx = table_instance(config)[1]
-        table_tmp_tracorp = table_instance(config)[2]
         table_mastercompletions = table_instance(config)[3]
 
 
-    # In/out Files
+    # In/out Files, SFTP Settings & Feeds (feeds refer to files by nickname, tables by name, SFTP by section)
     in_out_files = io_file_instance(config)
-    for index, table in enumerate(in_out_files, start=1):
-        file_in_xlsx = io_file_instance(config)[0]
-        file_in_tracorp = io_file_instance(config)[1]
-        file_out_csv = io_file_instance(config)[2]
-        file_out_tmp = io_file_instance(config)[3]
-        file_out_txt = io_file_instance(config)[4]
-
-
-    # SFTP Settings
     sftp_servers = sftp_instance(config)
-    for index, sftp_server in enumerate(sftp_servers, start=1):
-        sftp_tc = sftp_instance(config)[0]
-        sftp_st = sftp_instance(config)[1]
+    feeds = feed_instance(config)
+
+    files_by_nickname = {io_file.nickname: io_file for io_file in in_out_files}
+    tables_by_name = {table.name: table for table in tables}
+    sftp_by_name = {sftp_server.name: sftp_server for sftp_server in sftp_servers}
+    logging.info(f"Feeds: {', '.join(feed.name for feed in feeds)}")
 
 
     # SMTP Settings
@@ -322,6 +207,35 @@ def main(log_file, config):
         smtp_connect = smtp_instance(config)[0]
 
 
+    # Parquet caches (resolved before changing into the temp directory)
+    for io_file in in_out_files:
+        if io_file.cache_dir:
+            io_file.cache_dir = os.path.abspath(os.path.join(args.path, io_file.cache_dir))
+
+    # Activity catalog (resolved before changing into the temp directory; kept warm in service mode)
+    if warm.catalog is None:
+        warm.catalog = activity_catalog(catalog_instance(config)[0])
+        warm.catalog.settings.path = os.path.abspath(os.path.join(args.path, warm.catalog.settings.path))
+    catalog = warm.catalog
+
+    # Roster cache (resolved before changing into the temp directory)
+    roster_cache = roster_instance(config)[0]
+    roster_cache.path = os.path.abspath(os.path.join(args.path, roster_cache.path))
+
+    # Archive (resolved before changing into the temp directory)
+    archive = archive_instance(config)[0]
+    archive.path = os.path.abspath(os.path.join(args.path, archive.path))
+
+    # Run state (resolved before changing into the temp directory)
+    run_state = run_state_instance(config)[0]
+    run_state.path = os.path.abspath(os.path.join(args.path, run_state.path))
+    transfers.partial_dir = os.path.abspath(os.path.join(args.path, run_state.partial_path))
+
+    # Key Index (resolved before changing into the temp directory)
+    key_index = key_index_instance(config)[0]
+    key_index.path = os.path.abspath(os.path.join(args.path, key_index.path))
+
+
 
 
 
@@ -341,93 +255,361 @@ def main(log_file, config):
 
     # # # Functions
 
-    # Connect to SQL Servers
-    conn_sql11worke, cur_sql11worke = connect_sql_server(server_sql11worke)
-    conn_aidwsql, cur_aidwsql = connect_sql_server(server_aidwsql)
-
-
-    # Get file from SFTP (TraCorp) - Excel (all adoa completions report)
-    df_xlsx_report = download_file(sftp_tc.sftpurl, sftp_tc.username, sftp_tc.file, sftp_tc.key, temp_path)
-
-    # Parse XLSX Report (file_instance is for logging)
-    df_xlsx_parsed = general_parse(df_xlsx_report, file_in_xlsx)
-
-    # Query Insert XLSX
-    insert_query(conn_aidwsql, df_xlsx_parsed, table_tmp_xlsx)
-
-
-    # Query compare with mastercompletions & remove duplicates to df
-    df_xlsx_unique = general_distinct_query(conn_aidwsql, table_tmp_xlsx, table_mastercompletions)
-
-    # Update mastercompletions with daily xlsx unique df
-    insert_query(conn_aidwsql, df_xlsx_unique, table_mastercompletions)
-
-
+    # Ingestion watermarks - only rows at or past them are processed, unless --full-window
+    watermarks = {}
+    pending_watermarks = {}
+    for feed in feeds:
+        file_in = files_by_nickname[feed.file]
+        watermarks[feed.name] = None if args.full_window else load_watermark(run_state, file_in.nickname)
+        pending_watermarks[feed.name] = start_watermark(watermarks[feed.name])
+
+
+    # Inputs that match the last successful run skip their whole branch (--force / --full-window reprocess them)
+    branch_started = {}
+
+    # Rows each feed merged (its frames are released once the stages that read them are done)
+    merged_rows = {}
+
+    # Last successful run of an unchanged input - None when it runs anyway (--force / --full-window, or an enriching
+    # feed with left-out rows a refreshed roster may now match)
+    def unchanged_record(feed, file_in, fingerprint):
+        if args.force or args.full_window:
+            return None
+        record = unchanged_input(run_state, file_in.nickname, fingerprint)
+        retry = pending_watermarks[feed.name]['retry']
+        if record and feed.enrich and retry:
+            logging.info(f"{file_in.name} unchanged, but {len(retry)} rows left out without an email are retried")
+            return None
+        return record
+
+    def fingerprint_input(feed, file_in, file_path):
+        file_hash = file_sha256(file_path)
+        record = unchanged_record(feed, file_in, file_hash)
+        if record:
+            logging.info(f"{file_in.name} unchanged since {record['recorded']} - skipping its branch "
+                         f"(saves ~{record['seconds']}s)")
+            return skip_branch(f"{file_in.name} unchanged")
+        return file_hash
+
+    def fingerprint_remote(feed, file_in, sftp_info):
+        identity = transfers.remote_identity(sftp_info, sftp_info.file)
+        record = unchanged_record(feed, file_in, identity)
+        if record:
+            logging.info(f"{file_in.name} unchanged on {sftp_info.sftpurl} since {record['recorded']} - skipping its branch "
+                         f"(saves ~{record['seconds']}s)")
+            return skip_branch(f"{file_in.name} unchanged")
+        return identity
+
+    def record_input(feed, file_in, file_hash):
+        save_input_fingerprint(run_state, file_in.nickname, file_hash, time.perf_counter() - branch_started[feed.name])
+
+
+    # # Shared stages
+    # Load the mastercompletions key index (shared by the feeds' merge stages, which all hold the mastercompletions lock)
+    def stage_key_index(results):
+        if warm.key_state is None:
+            warm.key_state = {'keys': load_key_index(key_index) if key_index.enabled else []}
+
+    # Load active activity catalog (only a sql catalog needs a connection; a failed first load fails the stage)
+    def stage_catalog(results):
+        if catalog.settings.source != 'sql':
+            catalog.refresh()
+            return
+        with connections.connection(server_aidwsql.server) as conn_aidwsql:
+            catalog.refresh(conn_aidwsql)
+
+    # Refresh the local roster when its TTL has run out, then load the EIN -> email map
+    # (the loaded map is reused between service cycles until the next refresh)
+    def stage_roster(results):
+        if not roster_cache.enabled:
+            return None
+
+        if not roster_is_fresh(roster_cache):
+            with connections.connection(server_sql11worke.server) as conn_sql11worke:
+                refresh_roster(conn_sql11worke, table_vw_emp_roster, roster_cache)
+            warm.roster = None
+
+        if warm.roster is None:
+            warm.roster = load_roster(roster_cache)
+
+        return warm.roster
+
+
+    # # Feed branch - download, parse, load, (correct email,) merge, (export, upload, archive,) record
+    def feed_stages(feed):
+        file_in = files_by_nickname[feed.file]
+        table_tmp = tables_by_name[feed.table]
+        sftp_in = sftp_by_name[feed.sftp]
+        chunked = file_in.stream or file_in.chunksize > 0
+        group = f"feed:{feed.name}"
+
+        # Get file from SFTP
+        def stage_download(results):
+            # Roster server is only needed for feeds that enrich
+            if feed.enrich:
+                connections.prefetch([server_sql11worke.server])
+            branch_started[feed.name] = time.perf_counter()
+
+            # Streaming reads the remote file during parsing; with stream_archive its bytes are copied here
+            # (without it nothing is written locally, so there is no path)
+            if file_in.stream:
+                if not file_in.stream_archive:
+                    return None
+                return os.path.join(temp_path, os.path.basename(sftp_in.file))
+
+            return download_file(sftp_in, temp_path)
+
+        # Streamed inputs are fingerprinted by remote size/mtime, downloaded ones by content hash
+        def stage_fingerprint(results):
+            if file_in.stream:
+                return fingerprint_remote(feed, file_in, sftp_in)
+            return fingerprint_input(feed, file_in, results[f'download_{feed.name}'])
+
+        # Parse, dropping rows behind the watermark or already in mastercompletions
+        # (enriching feeds also filter out inactive activities & fill emails from the roster)
+        # Only whole files go to the process pool; chunked/streamed csv feeds stay on this stage thread as a lazy
+        # chunk generator the load stage consumes, so parsing overlaps the read and the insert
+        def stage_parse(results):
+            file_path = results[f'download_{feed.name}']
+            roster = results['roster'] if feed.enrich else None
+
+            if not chunked:
+                return parse_feed(feed_pool, file_in, file_path, table_tmp, watermarks[feed.name], pending_watermarks[feed.name],
+                                  catalog=catalog if feed.enrich else None, roster=roster, keys=warm.key_state['keys'],
+                                  key_index=key_index)
+
+            if file_in.stream:
+                chunks = import_remote_chunked(file_in, sftp_in, usecols=lambda column: column in parse_columns,
+                                               dtype=parse_dtypes, tee_path=file_path)
+            else:
+                chunks = import_files_chunked(file_in, file_path, usecols=lambda column: column in parse_columns, dtype=parse_dtypes)
+
+            chunks = general_parse_chunks(chunks, file_in)
+            chunks = (watermark_rows(chunk, watermarks[feed.name], pending_watermarks[feed.name]) for chunk in chunks)
+            if feed.enrich:
+                chunks = (filter_active_activities(chunk, catalog) for chunk in chunks)
+                chunks = (enrich_emails(chunk, roster, table_tmp) for chunk in chunks)
+            return (drop_known_keys(chunk, warm.key_state['keys'], table_tmp, key_index) for chunk in chunks)
+
+        # Query Insert
+        def stage_load(results):
+            with connections.connection(server_aidwsql.server) as conn_aidwsql:
+                if chunked:
+                    insert_query_chunks(conn_aidwsql, results[f'parse_{feed.name}'], table_tmp)
+                else:
+                    insert_query(conn_aidwsql, results[f'parse_{feed.name}'], table_tmp)
+
+            if feed.enrich:
+                log_catalog_stats(catalog)
+
+        # Query correct email (SQL-side fallback for rows the roster cache could not fill)
+        def stage_correct_email(results):
+            with connections.connection(server_sql11worke.server) as conn_sql11worke:
+                correct_email(conn_sql11worke, table_tmp, table_vw_emp_roster)
+
+        # Merge new rows into mastercompletions - the one step the feeds share, after the merge_after feeds
+        # (rows only come back for the export or the key index)
+        # Rows left out without an email are kept with the watermark and processed again on the next runs
+        def stage_merge(results):
+            with connections.connection(server_aidwsql.server) as conn_aidwsql:
+                df_unmatched = unmatched_email_rows(conn_aidwsql, table_tmp)
+                df_new_rows = merge_new_rows(conn_aidwsql, table_tmp, table_mastercompletions,
+                                             return_rows=feed.export or key_index.enabled)
+
+            if key_index.enabled:
+                warm.key_state['keys'] = update_key_index(key_index, warm.key_state['keys'], df_new_rows, table_mastercompletions)
+
+            retry_unmatched_rows(pending_watermarks[feed.name], df_unmatched, run_state.retry_days)
+            save_watermark(run_state, file_in.nickname, pending_watermarks[feed.name])
+
+            merged_rows[feed.name] = row_count(df_new_rows)
+            return df_new_rows if feed.export else None
+
+        # Build the SumTotal record columns & export csv/txt in one pass (constants filled in by the writer)
+        def stage_export(results):
+            df_final = template_parse(results[f'merge_{feed.name}'], sumtotal_template)
+            export_files(df_final, files_by_nickname[feed.file_out_csv], files_by_nickname[feed.file_out_txt],
+                         template=sumtotal_template)
+
+        # Upload file to SFTP (SumTotal)
+        def stage_upload(results):
+            upload_file(sftp_by_name[feed.upload], files_by_nickname[feed.file_out_txt].path)
+
+        # Archive files
+        def stage_archive(results):
+            archive_files(archive, feed_report_files(feed, results),
+                          run_id=f"{datetime.now().strftime('%Y%m%d%H%M')}_{feed.name}")
+
+        def stage_record(results):
+            record_input(feed, file_in, results[f'fingerprint_{feed.name}'])
+
+        parse_deps = [f'fingerprint_{feed.name}', 'key_index'] + (['catalog', 'roster'] if feed.enrich else [])
+        merge_deps = [f'correct_email_{feed.name}'] if feed.enrich else [f'load_{feed.name}']
+
+        stages = [
+            pipeline_stage(f'download_{feed.name}', stage_download, group=group),
+            pipeline_stage(f'fingerprint_{feed.name}', stage_fingerprint, deps=[f'download_{feed.name}'], group=group),
+            pipeline_stage(f'parse_{feed.name}', stage_parse, deps=parse_deps, group=group, release=True),
+            pipeline_stage(f'load_{feed.name}', stage_load, deps=[f'parse_{feed.name}'], group=group),
+            pipeline_stage(f'merge_{feed.name}', stage_merge, deps=merge_deps, group=group, release=True,
+                           after=[f'merge_{name}' for name in feed.merge_after], locks=['mastercompletions'])]
+
+        if feed.enrich:
+            stages.append(pipeline_stage(f'correct_email_{feed.name}', stage_correct_email, deps=[f'load_{feed.name}'], group=group))
+
+        if feed.export:
+            stages += [
+                pipeline_stage(f'export_{feed.name}', stage_export, deps=[f'merge_{feed.name}'], group=group),
+                pipeline_stage(f'upload_{feed.name}', stage_upload, deps=[f'export_{feed.name}'], group=group),
+                pipeline_stage(f'archive_{feed.name}', stage_archive, deps=[f'export_{feed.name}'], group=group, locks=['archive']),
+                pipeline_stage(f'record_{feed.name}', stage_record, deps=[f'upload_{feed.name}', f'archive_{feed.name}'], group=group)]
+        else:
+            stages.append(pipeline_stage(f'record_{feed.name}', stage_record, deps=[f'merge_{feed.name}'], group=group))
+
+        return stages
+
+    # Files a feed leaves behind for the archive & email
+    def feed_report_files(feed, results):
+        files = {}
+        # A stream without stream_archive leaves no local copy of the input
+        file_in = files_by_nickname[feed.file]
+        if not file_in.stream or file_in.stream_archive:
+            files[feed.name] = results.get(f'download_{feed.name}') or ''
+        if feed.export:
+            files[f'{feed.name}_sumtotal_txt'] = files_by_nickname[feed.file_out_txt].path
+            files[f'{feed.name}_sumtotal_csv'] = files_by_nickname[feed.file_out_csv].path
+        return files
+
+
+    stages = [pipeline_stage('key_index', stage_key_index)]
+    if any(feed.enrich for feed in feeds):
+        stages += [pipeline_stage('catalog', stage_catalog), pipeline_stage('roster', stage_roster)]
+    for feed in feeds:
+        stages += feed_stages(feed)
+
+    limits = {f"feed:{feed.name}": max(feed.max_concurrency, 1) for feed in feeds}
+
+    if args.dry_run:
+        log_pipeline_plan(stages, limits)
+        return {}, {}, {}
+
+    # SQL Server connections - opened in the background, checked out when first needed
+    if warm.connections is None:
+        warm.connections = sql_connections(config)
+    connections = warm.connections
+    connections.prefetch([server_aidwsql.server])
+
+    # Whole-file feeds are parsed in worker processes (--processes 0 parses them on the stage threads too)
+    if warm.feed_pool is None:
+        warm.feed_pool = feed_process_pool(args.processes)
+    feed_pool = warm.feed_pool
 
+    try:
+        results, status = run_pipeline(stages, max_workers=args.workers, limits=limits)
+    finally:
+        if feed_pool is not None and not warm.persistent:
+            feed_pool.shutdown()
 
-    # Import Tracorp
-    df_tracorp_file = download_file(sftp_st.sftpurl, sftp_st.username, sftp_st.file, sftp_st.key, temp_path)
+    connections.log_connect_stats()
+    if not warm.persistent:
+        connections.close_all()
+        transfers.close_all()
 
-    # Parse Tracorp
-    df_tracorp_parsed = general_parse(df_tracorp_file, file_in_tracorp)
 
-    # Parse filter out inactive activities
-    df_tracorp_active_activities = dfs_merge(df_tracorp_parsed, df_active_activities)
+    # Send Email in the background (summary only if the zipped files are over the cap)
+    run_stats = {'stages': ", ".join(f"{name}={state}" for name, state in status.items())}
+    report_files = {}
+    for feed in feeds:
+        report_files.update(feed_report_files(feed, results))
+        if feed.export:
+            run_stats[f'new {feed.name} completions'] = merged_rows.get(feed.name)
+    peak = peak_rss_mb()
+    run_stats['peak RSS (MB)'] = f"{peak['self']} ({peak['scope']} peak)"
+    report = email_log_and_files(smtp_connect, log_file, report_files, run_stats)
 
-    # Query Insert Tracorp
-    insert_query(conn_aidwsql, df_tracorp_active_activities, table_tmp_tracorp)
+    # The run does not wait for SMTP: a one-off run exits once the (non-daemon) sender is done,
+    # service mode joins the outstanding senders when it stops
+    warm.reports = [sender for sender in warm.reports if sender.is_alive()] + [report]
 
-    # Query correct email
-    correct_email(conn_sql11worke)
+    # The temp files can go once they are in the zip
+    report.bundled.wait(timeout=600)
 
-    # Query to df remove duplicates with mastercompletions
-    df_tracorp_no_duplicates = general_distinct_query(conn_aidwsql, table_tmp_tracorp, table_mastercompletions)
 
+    # Clear temp directory
+    # Delete all files in temp directory
+    for filename in os.listdir(temp_path):
+        file_path = os.path.join(temp_path, filename)
+        try:
+            if os.path.isfile(file_path) or os.path.islink(file_path):
+                os.unlink(file_path)
+            elif os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+        except Exception as e:
+            logging.critical('Failed to delete %s. Reason: %s' % (file_path, e))
+        else:
+            logging.debug("Deleted " + file_path)  
 
+    return results, status, merged_rows
 
-    # Insert df_tracorp_no_duplicates into mastercompletions
-    insert_query(conn_aidwsql, df_tracorp_no_duplicates, table_mastercompletions)
 
 
-    # Parse final df with required, static values
-    df_tracorp_final = final_parse(df_tracorp_no_duplicates)
+# Service mode - poll the feed sources and run a cycle when one has changed, keeping state warm
+def service_command(config):
 
+    service = service_instance(config)[0]
+    metrics = service_metrics(service.poll_interval)
+    warm = warm_state(persistent=True)
 
-    # Export to main csv
-    export_csv(df_tracorp_final, file_out_csv)
+    if service.health_port:
+        start_health_server(service.health_host, service.health_port, metrics)
 
-    # Export to tmp csv
-    export_csv(df_tracorp_final, file_out_tmp)
+    # Remote size/mtime of every feed's file, as of the last successful cycle
+    seen = {}
+    polled = {}
 
-    # Export to txt
-    export_txt(file_out_tmp, file_out_txt)
+    def poll():
+        sftp_by_name = {sftp_server.name: sftp_server for sftp_server in sftp_instance(config)}
+        changed = []
+        for feed in feed_instance(config):
+            sftp_in = sftp_by_name[feed.sftp]
+            polled[feed.name] = transfers.remote_identity(sftp_in, sftp_in.file)
+            if polled[feed.name] != seen.get(feed.name):
+                changed.append(feed.name)
 
-    # Upload file to SFTP (SumTotal)
-    upload_file(sftp_st.sftpurl, sftp_st.username, sftp_st.file, sftp_st.key, export_txt)
+        if changed or args.force:
+            logging.info(f"New input: {', '.join(changed) or 'none (--force)'}")
+            return True
 
+        logging.debug("No new input")
+        return False
 
-    # Archive files
-    archive_files(df_tracorp_file, export_txt, export_csv)
+    def run_cycle():
+        log_file = log_file_name(args.path)
+        switch_log_file(log_file)
+        reset_run_profile()
 
+        started = time.time()
+        results, status, merged_rows = main(log_file, config, warm)
+        write_run_profile(log_file)
 
-    # Send Email
-    email_log_and_files(smtp_connect.addressFrom, smtp_connect.addressTo, smtp_connect.server, smtp_connect.port,
-                        log_file, df_tracorp_file, export_txt, export_csv)
+        metrics.cycle_finished(started, time.time() - started, status, merged_rows)
 
+        # Failed cycles are retried at the next poll
+        if not any(state in ('failed', 'skipped') for state in status.values()):
+            seen.update(polled)
 
-    # Clear temp directory
-    # Delete all files in temp directory
-    for filename in os.listdir(temp_path):
-        file_path = os.path.join(temp_path, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-        except Exception as e:
-            logging.critical('Failed to delete %s. Reason: %s' % (file_path, e))
-        else:
-            logging.debug("Deleted " + file_path)  
+    try:
+        run_service(service, poll, run_cycle, metrics)
+    finally:
+        for report in warm.reports:
+            if report.is_alive():
+                logging.info("Waiting for the report email to finish sending...")
+            report.join()
+        if warm.feed_pool is not None:
+            warm.feed_pool.shutdown()
+        if warm.connections is not None:
+            warm.connections.close_all()
+        transfers.close_all()
 
 
 
@@ -437,9 +619,11 @@ if __name__ == "__main__":
 
     # Parse arguments
     args = parse_args() 
+    # Absolute, so paths still resolve after main() changes into the temp directory
+    args.path = os.path.abspath(args.path)
 
     # Setup logging
-    log_file = setup_logging(args.path, args.debug)
+    log_file = os.path.abspath(setup_logging(args.path, args.debug))
 
     # Log arguments
     logging.debug("Working directory: " + args.path)
@@ -450,5 +634,43 @@ if __name__ == "__main__":
     # Read configuration file
     config = read_config(args.config)
 
+    # Tracing / --profile output goes next to the log file
+    configure_tracing(args.profile, os.path.dirname(log_file))
+
+    # Config check (no pipeline modules needed)
+    if args.check_config:
+        problems = check_config(config)
+        for problem in problems:
+            logging.critical(f"Config problem: {problem}")
+        if problems:
+            raise SystemExit(1)
+        logging.info(f"Configuration OK: {args.config}")
+        raise SystemExit(0)
+
+    load_pipeline_modules()
+
+    # Key index maintenance commands
+    if args.rebuild_key_index or args.check_key_index:
+        key_index_command(config)
+
+    # Local store refresh
+    elif args.sync_local:
+        local_store_command(config)
+
+    # Archive maintenance commands
+    elif args.archive_prune or args.archive_lookup:
+        archive = archive_instance(config)[0]
+        archive.path = os.path.abspath(os.path.join(args.path, archive.path))
+        if args.archive_prune:
+            prune_archive(archive)
+        if args.archive_lookup:
+            lookup_archive(archive, args.archive_lookup)
+
+    # Service mode
+    elif args.service:
+        service_command(config)
+
     # Run main
-    main(log_file, config)
+    else:
+        main(log_file, config)
+        write_run_profile(log_file)
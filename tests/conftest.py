@@ -0,0 +1,37 @@
+import os.path
+import sys
+import configparser
+import pytest
+
+# The modules live flat in the repo root
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
+
+import variables
+
+
+
+# The shipped config.ini
+@pytest.fixture
+def config():
+    config = configparser.ConfigParser()
+    config.read(os.path.join(repo_dir, 'config.ini'))
+    return config
+
+
+# SQL tables by name
+@pytest.fixture
+def tables(config):
+    return {table.name: table for table in variables.table_instance(config)}
+
+
+# Local store (--no-sql) holding the configured tables
+@pytest.fixture
+def local_connections(tmp_path, config):
+    from functions_local import local_connection_manager
+
+    settings = variables.local_store_settings(path=str(tmp_path / "local.sqlite3"))
+    connections = local_connection_manager(settings, variables.table_instance(config))
+    yield connections
+    connections.close_all()
@@ -0,0 +1,22 @@
+import pytest
+import variables
+from functions_catalog import activity_catalog
+
+
+def test_first_load_failure_raises(tmp_path):
+    catalog = activity_catalog(variables.catalog_settings(source='file', path=str(tmp_path / "missing.txt"), query='', ttl=0))
+
+    with pytest.raises(FileNotFoundError):
+        catalog.refresh()
+
+
+def test_failed_reload_keeps_loaded_codes(tmp_path):
+    codes_file = tmp_path / "activities.txt"
+    codes_file.write_text("ACT1\nACT2\n")
+    catalog = activity_catalog(variables.catalog_settings(source='file', path=str(codes_file), query='', ttl=0))
+
+    catalog.refresh()
+    codes_file.unlink()
+    catalog.refresh()
+
+    assert list(catalog.codes) == ['ACT1', 'ACT2']
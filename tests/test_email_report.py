@@ -0,0 +1,135 @@
+import io
+import os
+import time
+import email
+import zipfile
+import threading
+import socketserver
+import pytest
+import variables
+from functions_in_out import email_log_and_files
+
+
+# # Local SMTP debugging server - keeps every message it receives
+
+class smtp_handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"220 stand-in ESMTP\r\n")
+        data = None
+
+        for line in self.rfile:
+            if data is not None:
+                if line.rstrip(b"\r\n") == b".":
+                    self.server.messages.append(b"".join(data))
+                    data = None
+                    self.wfile.write(b"250 OK\r\n")
+                else:
+                    data.append(line[1:] if line.startswith(b"..") else line)
+                continue
+
+            command = line[:4].upper()
+            if command == b"DATA":
+                data = []
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                break
+            elif command in (b"EHLO", b"HELO", b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                self.wfile.write(b"250 OK\r\n")
+            else:
+                self.wfile.write(b"502 Not implemented\r\n")
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), smtp_handler)
+    server.messages = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def smtp_settings(server, max_attachment_mb):
+    return variables.smtp_settings(server='127.0.0.1', port=server.server_address[1], addressFrom='from@azdot.gov',
+                                   addressTo='to@azdot.gov', starttls=False, max_attachment_mb=max_attachment_mb)
+
+
+# Send a report and return the one message the server got
+def send_report(server, max_attachment_mb, log_file, files):
+    sender = email_log_and_files(smtp_settings(server, max_attachment_mb), str(log_file), files, {'stages': 'parse=done'})
+    sender.join(timeout=30)
+    assert len(server.messages) == 1
+    return email.message_from_bytes(server.messages[0])
+
+
+def body_of(message):
+    return next(part.get_payload(decode=True).decode() for part in message.walk() if part.get_content_type() == 'text/plain')
+
+
+def attachments_of(message):
+    return [part for part in message.walk() if part.get_filename()]
+
+
+@pytest.fixture
+def report_files(tmp_path):
+    log_file = tmp_path / "reformatTracorp_202401010900.log"
+    log_file.write_text("2024-01-01 09:00:00 INFO Logging started\n")
+    export = tmp_path / "toSumtotal.csv"
+    export.write_text("EmployeeNumber,ActivityCode\n" + "one@azdot.gov,ACT1\n" * 1000)
+    return log_file, {'tracorp_sumtotal_csv': str(export)}
+
+
+def test_zipped_bundle_is_attached_under_the_cap(smtp_server, report_files):
+    log_file, files = report_files
+
+    message = send_report(smtp_server, 10, log_file, files)
+
+    attachments = attachments_of(message)
+    assert [part.get_filename() for part in attachments] == ["reformatTracorp_202401010900.report.zip"]
+    bundle = zipfile.ZipFile(io.BytesIO(attachments[0].get_payload(decode=True)))
+    assert sorted(bundle.namelist()) == ["reformatTracorp_202401010900.log", "toSumtotal.csv"]
+    assert "Attachments left out" not in body_of(message)
+    assert not log_file.with_suffix(".report.zip").exists()
+
+
+def test_summary_only_over_the_cap(smtp_server, report_files):
+    log_file, files = report_files
+
+    message = send_report(smtp_server, 0, log_file, files)
+
+    body = body_of(message)
+    assert attachments_of(message) == []
+    assert "Attachments left out: bundle is over the 0 MB cap." in body
+    assert f"The files are kept in {log_file.with_suffix('.report.zip')} for 14 days." in body
+    assert log_file.with_suffix(".report.zip").exists()
+    assert "stages: parse=done" in body
+    assert "toSumtotal.csv" in body
+
+
+def test_summary_only_when_bundling_fails(smtp_server, report_files, tmp_path):
+    _, files = report_files
+
+    # The bundle goes next to the log file, in a directory that does not exist
+    message = send_report(smtp_server, 10, tmp_path / "missing" / "run.log", files)
+
+    body = body_of(message)
+    assert attachments_of(message) == []
+    assert "the report bundle could not be created" in body
+    assert "over the" not in body
+
+
+def test_old_report_bundles_are_pruned(smtp_server, report_files, tmp_path):
+    log_file, files = report_files
+    old_bundle = tmp_path / "reformatTracorp_202312010900.report.zip"
+    old_bundle.write_bytes(b"")
+    old = time.time() - 15 * 86400
+    os.utime(old_bundle, (old, old))
+    recent_bundle = tmp_path / "reformatTracorp_202312310900.report.zip"
+    recent_bundle.write_bytes(b"")
+
+    send_report(smtp_server, 10, log_file, files)
+
+    assert not old_bundle.exists()
+    assert recent_bundle.exists()
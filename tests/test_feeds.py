@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+import variables
+from functions_feeds import feed_process_pool, parse_feed
+from functions_state import start_watermark
+
+
+def tracorp_file():
+    return variables.raw_file(path='sumTotal.csv', name='sumTotal.csv', csv_true='True', nickname='tracorp',
+                              delimiter=',', fileType='csv')
+
+
+@pytest.fixture(params=[0, 1], ids=['stage thread', 'process pool'])
+def pool(request):
+    pool = feed_process_pool(request.param)
+    yield pool
+    if pool is not None:
+        pool.shutdown()
+
+
+def test_feed_with_changed_columns_fails_the_parse(tmp_path, tables, pool):
+    file_path = tmp_path / "sumTotal.csv"
+    file_path.write_text("Code,Date Completed\nACT1,2024-05-01\n")
+
+    with pytest.raises(KeyError):
+        parse_feed(pool, tracorp_file(), str(file_path), tables['tmp_Tracorp_Daily'], None, start_watermark(None))
+
+
+def test_malformed_csv_fails_the_parse(tmp_path, tables, pool):
+    file_path = tmp_path / "sumTotal.csv"
+    file_path.write_text('Activity Code,Completion Date\n"ACT1,2024-05-01\nACT2,2024-05-02,extra,fields\n')
+
+    with pytest.raises(Exception):
+        parse_feed(pool, tracorp_file(), str(file_path), tables['tmp_Tracorp_Daily'], None, start_watermark(None))
+
+
+def test_feed_parses_to_the_schema(tmp_path, tables, pool):
+    file_path = tmp_path / "sumTotal.csv"
+    today = pd.Timestamp.now().strftime('%Y-%m-%d')
+    file_path.write_text(f"Activity Code,Completion Date,Score,Student ID,Student Username\nACT1,{today},100,ONE@azdot.gov,1001\n")
+
+    df = parse_feed(pool, tracorp_file(), str(file_path), tables['tmp_Tracorp_Daily'], None, start_watermark(None))
+
+    assert df['Email'].tolist() == ['one@azdot.gov']
+    assert df['EmpID'].tolist() == [1001]
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import variables
+from functions_key_index import key_digests, drop_known_keys, update_key_index, load_key_index, load_sidecar_digests
+
+
+def completions(rows):
+    return pd.DataFrame(rows, columns=['ActivityCode', 'Email', 'EmpID', 'CompletionDate', 'Score']).astype(
+        {'CompletionDate': 'datetime64[ns]'})
+
+
+def test_known_rows_are_dropped_and_new_rows_kept(tmp_path, tables):
+    settings = variables.key_index_settings(enabled=True, path=str(tmp_path / "keys.npy"))
+    mastercompletions = tables['mastercompletions']
+
+    merged = completions([['ACT1', 'a@azdot.gov', 1, '2024-05-01', 100]])
+    keys = update_key_index(settings, load_key_index(settings), merged, mastercompletions)
+    assert len(load_key_index(settings)) == 1
+    assert np.array_equal(load_sidecar_digests(settings), keys)
+
+    staged = completions([['ACT1', 'a@azdot.gov', 1, '2024-05-01', 100],
+                          ['ACT2', 'b@azdot.gov', 2, '2024-05-01', 90]])
+    df = drop_known_keys(staged, keys, mastercompletions, settings)
+
+    assert df['ActivityCode'].tolist() == ['ACT2']
+
+
+def test_digest_hit_without_exact_key_is_left_to_sql(tmp_path, tables):
+    settings = variables.key_index_settings(enabled=True, path=str(tmp_path / "keys.npy"))
+    mastercompletions = tables['mastercompletions']
+
+    keys = update_key_index(settings, load_key_index(settings),
+                            completions([['ACT1', 'a@azdot.gov', 1, '2024-05-01', 100]]), mastercompletions)
+
+    # A colliding digest: in the index, but its full key was never merged
+    staged = completions([['ACT9', 'z@azdot.gov', 9, '2024-05-02', 80]])
+    collided = np.union1d(keys, key_digests(staged, 'ActivityCode', 'Email', 'CompletionDate'))
+
+    df = drop_known_keys(staged, collided, mastercompletions, settings)
+
+    assert len(df.index) == 1
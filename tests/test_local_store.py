@@ -0,0 +1,80 @@
+import pandas as pd
+from functions_sql import (sql_dialect, table_ref, insert_query, insert_query_chunks, correct_email,
+                           unmatched_email_rows, merge_new_rows)
+
+
+def staged(rows, email='Email_adotmaster'):
+    return pd.DataFrame(rows, columns=['ActivityCode', 'CompletionDate', 'Score', 'Email', 'EmpID', email]).astype(
+        {'CompletionDate': 'datetime64[ns]'})
+
+
+rows = [['ACT1', '2024-05-01', 100, 'e1001', 1001, 'one@azdot.gov'],
+        ['ACT2', '2024-05-02', 90, 'e1002', 1002, None],
+        ['ACT3', '2024-05-03', 80, 'e1003', 1003, None]]
+
+
+def count(conn, table):
+    return conn.execute(f"SELECT COUNT(*) FROM {table_ref(conn, table)}").fetchone()[0]
+
+
+def test_local_connections_use_the_sqlite_dialect(local_connections, tables):
+    with local_connections.connection('aidwsqld98001') as conn:
+        assert sql_dialect(conn) == 'sqlite'
+        assert table_ref(conn, tables['mastercompletions']) == '"mastercompletions"'
+
+
+def test_insert_replaces_the_tmp_table(local_connections, tables):
+    table_tmp = tables['tmp_Tracorp_Daily']
+
+    with local_connections.connection('local') as conn:
+        insert_query(conn, staged(rows), table_tmp)
+        assert count(conn, table_tmp) == 3
+
+        insert_query_chunks(conn, iter([staged(rows[:1]), staged(rows[2:])]), table_tmp)
+        assert count(conn, table_tmp) == 2
+
+
+def test_correct_email_fills_null_emails_from_the_roster(local_connections, tables):
+    table_tmp = tables['tmp_Tracorp_Daily']
+    roster = tables['VW_EmployeeRoster']
+
+    with local_connections.connection('local') as conn:
+        conn.executemany('INSERT INTO "VW_EmployeeRoster" (EIN, EmployeeEmailAddress) VALUES (?, ?)',
+                         [('1002', 'two@azdot.gov'), ('1009', 'nine@azdot.gov')])
+        insert_query(conn, staged(rows), table_tmp)
+
+        correct_email(conn, table_tmp, roster)
+
+        emails = dict(conn.execute('SELECT ActivityCode, Email_adotmaster FROM "tmp_Tracorp_Daily"').fetchall())
+        assert emails == {'ACT1': 'one@azdot.gov', 'ACT2': 'two@azdot.gov', 'ACT3': None}
+        unmatched = unmatched_email_rows(conn, table_tmp)
+        assert unmatched['ActivityCode'].tolist() == ['ACT3']
+        assert unmatched['CompletionDate'].tolist() == [pd.Timestamp('2024-05-03')]
+        assert unmatched['EmpID'].astype(str).tolist() == ['1003']
+
+
+def test_merge_skips_duplicates_and_rows_without_email_on_rerun(local_connections, tables):
+    table_tmp = tables['tmp_Tracorp_Daily']
+    mastercompletions = tables['mastercompletions']
+    blank = [['ACT4', '2024-05-04', 70, 'e1004', 1004, 'BLANK']]
+
+    with local_connections.connection('local') as conn:
+        insert_query(conn, staged(rows + blank), table_tmp)
+        merged = merge_new_rows(conn, table_tmp, mastercompletions, return_rows=True)
+
+        # NULL and BLANK emails stay out
+        assert merged['Email'].tolist() == ['one@azdot.gov']
+        assert merged['CompletionDate'].tolist() == [pd.Timestamp('2024-05-01')]
+        assert count(conn, mastercompletions) == 1
+
+        # Same input again - nothing new
+        insert_query(conn, staged(rows + blank), table_tmp)
+        assert merge_new_rows(conn, table_tmp, mastercompletions, return_rows=True).empty
+        assert merge_new_rows(conn, table_tmp, mastercompletions) is None
+        assert count(conn, mastercompletions) == 1
+
+        # The missing email turns up on a later run - only that row is new
+        insert_query(conn, staged([['ACT2', '2024-05-02', 90, 'e1002', 1002, 'two@azdot.gov']] + rows[:1]), table_tmp)
+        merged = merge_new_rows(conn, table_tmp, mastercompletions, return_rows=True)
+        assert merged['Email'].tolist() == ['two@azdot.gov']
+        assert count(conn, mastercompletions) == 2
@@ -0,0 +1,316 @@
+import os
+import shutil
+import socket
+import threading
+import paramiko
+import pytest
+import variables
+from functions_sftp import sftp_transfer_manager
+
+
+# # Local paramiko SFTP stand-in - serves a directory over an in-process transport
+
+host_key = paramiko.RSAKey.generate(2048)
+
+
+class stand_in_server(paramiko.ServerInterface):
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+# Open file - reads past faults['read_limit'] / writes past faults['write_limit'] fail,
+# as if the connection had dropped mid-transfer
+class stand_in_handle(paramiko.SFTPHandle):
+    def __init__(self, flags, faults):
+        super().__init__(flags)
+        self.faults = faults
+
+    def read(self, offset, length):
+        limit = self.faults.get('read_limit')
+        if limit is not None and offset + length > limit:
+            return paramiko.SFTP_FAILURE
+        return super().read(offset, length)
+
+    def write(self, offset, data):
+        limit = self.faults.get('write_limit')
+        if limit is not None and offset + len(data) > limit:
+            return paramiko.SFTP_FAILURE
+        return super().write(offset, data)
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class stand_in_sftp(paramiko.SFTPServerInterface):
+    def __init__(self, server, root, faults):
+        super().__init__(server)
+        self.root = root
+        self.faults = faults
+
+    def local(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.local(path), flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+
+        handle = stand_in_handle(flags, self.faults)
+        handle.filename = self.local(path)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        os.remove(self.local(path))
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        os.rename(self.local(oldpath), self.local(newpath))
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self.local(oldpath), self.local(newpath))
+        return paramiko.SFTP_OK
+
+
+# connect(sftp_info) for sftp_transfer_manager - a fresh stand-in session per call
+class stand_in_connect:
+    def __init__(self, root):
+        self.root = root
+        self.faults = {'read_limit': None, 'write_limit': None}
+        self.calls = 0
+
+    def __call__(self, sftp_info):
+        self.calls += 1
+        client_socket, server_socket = socket.socketpair()
+
+        server = paramiko.Transport(server_socket)
+        server.add_server_key(host_key)
+        server.set_subsystem_handler('sftp', paramiko.SFTPServer, stand_in_sftp, self.root, self.faults)
+        server.start_server(event=threading.Event(), server=stand_in_server())
+
+        client = paramiko.Transport(client_socket)
+        client.connect()
+        client.auth_none(sftp_info.username)
+        return paramiko.SFTPClient.from_transport(client)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    root = tmp_path / "remote"
+    root.mkdir()
+    return root
+
+
+@pytest.fixture
+def connect(remote):
+    return stand_in_connect(str(remote))
+
+
+@pytest.fixture
+def sftp_info():
+    return variables.sftp_settings(sftpurl='stand-in', username='tracorp', key='', file='/sumTotal.csv')
+
+
+def test_interrupted_download_resumes_at_the_partial_offset(tmp_path, remote, connect, sftp_info, caplog):
+    data = os.urandom(1500000)
+    (remote / "sumTotal.csv").write_bytes(data)
+    transfers = sftp_transfer_manager(connect=connect)
+
+    connect.faults['read_limit'] = 600000
+    with pytest.raises(IOError):
+        transfers.download(sftp_info, str(tmp_path))
+
+    offset = os.path.getsize(tmp_path / "sumTotal.csv.part")
+    assert 0 < offset <= 600000
+
+    connect.faults['read_limit'] = None
+    caplog.set_level('INFO')
+    local_file = transfers.download(sftp_info, str(tmp_path))
+    transfers.close_all()
+
+    assert f"resuming at {offset})" in caplog.text
+    assert open(local_file, "rb").read() == data
+    assert not os.path.exists(local_file + ".part")
+    assert not os.path.exists(local_file + ".part.json")
+
+
+def test_failed_run_download_resumes_after_the_temp_cleanup(tmp_path, remote, connect, sftp_info, caplog):
+    data = os.urandom(1500000)
+    (remote / "sumTotal.csv").write_bytes(data)
+    temp_dir = tmp_path / "temp"
+    temp_dir.mkdir()
+    partial_dir = str(tmp_path / "state" / "partial")
+
+    # Failed run - main() then clears the temp directory
+    transfers = sftp_transfer_manager(connect=connect, partial_dir=partial_dir)
+    connect.faults['read_limit'] = 600000
+    with pytest.raises(IOError):
+        transfers.download(sftp_info, str(temp_dir))
+    transfers.close_all()
+    shutil.rmtree(temp_dir)
+    temp_dir.mkdir()
+    offset = os.path.getsize(os.path.join(partial_dir, "sumTotal.csv.part"))
+    assert offset > 0
+
+    # Next run
+    transfers = sftp_transfer_manager(connect=connect, partial_dir=partial_dir)
+    connect.faults['read_limit'] = None
+    caplog.set_level('INFO')
+    local_file = transfers.download(sftp_info, str(temp_dir))
+    transfers.close_all()
+
+    assert f"resuming at {offset})" in caplog.text
+    assert open(local_file, "rb").read() == data
+    assert os.listdir(partial_dir) == []
+
+
+def test_partial_of_a_changed_remote_file_is_not_resumed(tmp_path, remote, connect, sftp_info, caplog):
+    (remote / "sumTotal.csv").write_bytes(b"a" * 1000)
+    transfers = sftp_transfer_manager(connect=connect)
+
+    connect.faults['read_limit'] = 500
+    with pytest.raises(IOError):
+        transfers.download(sftp_info, str(tmp_path))
+
+    # A new file lands on the server before the retry
+    data = b"b" * 2000
+    (remote / "sumTotal.csv").write_bytes(data)
+    connect.faults['read_limit'] = None
+    caplog.set_level('INFO')
+    local_file = transfers.download(sftp_info, str(tmp_path))
+    transfers.close_all()
+
+    assert "resuming at 0)" in caplog.text
+    assert open(local_file, "rb").read() == data
+
+
+def test_dropped_session_is_reopened_on_retry(tmp_path, remote, connect, sftp_info):
+    data = os.urandom(100000)
+    (remote / "sumTotal.csv").write_bytes(data)
+    transfers = sftp_transfer_manager(connect=connect)
+
+    transfers.download(sftp_info, str(tmp_path))
+    transfers.download(sftp_info, str(tmp_path))
+    assert connect.calls == 1
+
+    transfers.session(sftp_info).get_channel().get_transport().close()
+    local_file = transfers.download(sftp_info, str(tmp_path))
+    transfers.close_all()
+
+    assert connect.calls == 2
+    assert open(local_file, "rb").read() == data
+
+
+def test_interrupted_upload_resumes_at_the_remote_offset(tmp_path, remote, connect, sftp_info, caplog):
+    data = os.urandom(700000)
+    local_file = tmp_path / "TracorpTraining.txt"
+    local_file.write_bytes(data)
+    transfers = sftp_transfer_manager(connect=connect, partial_dir=str(tmp_path / "partial"))
+
+    connect.faults['write_limit'] = 300000
+    with pytest.raises(IOError):
+        transfers.upload(sftp_info, str(local_file))
+    transfers.close_all()
+    offset = os.path.getsize(remote / "TracorpTraining.txt.part")
+    assert 0 < offset <= 300000
+
+    connect.faults['write_limit'] = None
+    caplog.set_level('INFO')
+    transfers.upload(sftp_info, str(local_file))
+    transfers.close_all()
+
+    assert f"resuming at {offset})" in caplog.text
+    assert (remote / "TracorpTraining.txt").read_bytes() == data
+    assert not (remote / "TracorpTraining.txt.part").exists()
+    assert os.listdir(tmp_path / "partial") == []
+
+
+def test_stale_upload_partial_of_another_file_is_not_resumed(tmp_path, remote, connect, sftp_info, caplog):
+    (remote / "TracorpTraining.txt.part").write_bytes(b"OLD RUN PARTIAL ")
+    local_file = tmp_path / "TracorpTraining.txt"
+    local_file.write_bytes(b"OLD RUN PARTIAL  DIFFERENT FILE")
+    transfers = sftp_transfer_manager(connect=connect)
+
+    caplog.set_level('INFO')
+    transfers.upload(sftp_info, str(local_file))
+    transfers.close_all()
+
+    assert "resuming at 0)" in caplog.text
+    assert (remote / "TracorpTraining.txt").read_bytes() == b"OLD RUN PARTIAL  DIFFERENT FILE"
+
+
+def test_upload_partial_of_an_earlier_export_is_not_resumed(tmp_path, remote, connect, sftp_info, caplog):
+    local_file = tmp_path / "TracorpTraining.txt"
+    local_file.write_bytes(b"a" * 700000)
+    transfers = sftp_transfer_manager(connect=connect)
+
+    connect.faults['write_limit'] = 300000
+    with pytest.raises(IOError):
+        transfers.upload(sftp_info, str(local_file))
+    transfers.close_all()
+
+    # The next run exports a different file under the same name
+    data = b"b" * 700000
+    local_file.write_bytes(data)
+    connect.faults['write_limit'] = None
+    caplog.set_level('INFO')
+    transfers.upload(sftp_info, str(local_file))
+    transfers.close_all()
+
+    assert "resuming at 0)" in caplog.text
+    assert (remote / "TracorpTraining.txt").read_bytes() == data
+
+
+def test_stream_parse_without_archive_writes_nothing(tmp_path, remote, connect, sftp_info, monkeypatch):
+    import functions_in_out
+    (remote / "sumTotal.csv").write_text("ActivityCode,Score\nACT1,100\nACT2,90\nACT3,80\n")
+    monkeypatch.setattr(functions_in_out, 'transfers', sftp_transfer_manager(connect=connect))
+    monkeypatch.chdir(tmp_path)
+    file_in = variables.raw_file(path='sumTotal.csv', name='sumTotal.csv', csv_true='True', nickname='tracorp',
+                                 delimiter=',', fileType='csv', chunksize=2, stream=True, stream_archive=False)
+
+    chunks = list(functions_in_out.import_remote_chunked(file_in, sftp_info, tee_path=None))
+    functions_in_out.transfers.close_all()
+
+    assert [len(chunk.index) for chunk in chunks] == [2, 1]
+    assert sorted(os.listdir(tmp_path)) == ['remote']
+
+
+def test_stream_archive_copy_lands_in_a_new_directory(tmp_path, remote, connect, sftp_info, monkeypatch):
+    import functions_in_out
+    data = "ActivityCode,Score\nACT1,100\nACT2,90\n"
+    (remote / "sumTotal.csv").write_text(data)
+    monkeypatch.setattr(functions_in_out, 'transfers', sftp_transfer_manager(connect=connect))
+    file_in = variables.raw_file(path='sumTotal.csv', name='sumTotal.csv', csv_true='True', nickname='tracorp',
+                                 delimiter=',', fileType='csv', chunksize=2, stream=True, stream_archive=True)
+    tee_path = tmp_path / "temp" / "sumTotal.csv"
+
+    list(functions_in_out.import_remote_chunked(file_in, sftp_info, tee_path=str(tee_path)))
+    functions_in_out.transfers.close_all()
+
+    assert tee_path.read_text() == data
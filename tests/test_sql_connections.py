@@ -0,0 +1,45 @@
+import sqlite3
+import threading
+import variables
+from functions_sql import connection_manager
+
+
+# connection_manager with in-memory SQLite connections in place of pyodbc
+class stand_in_manager(connection_manager):
+    def __init__(self, servers):
+        super().__init__(servers)
+        self.opened = []
+        self.release_connect = threading.Event()
+
+    def open_connection(self, name):
+        self.release_connect.wait(timeout=10)
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.opened.append(conn)
+        return conn
+
+
+def is_open(conn):
+    try:
+        conn.execute("SELECT 1;")
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+
+def test_prefetched_connection_outliving_an_idle_one_is_closed(config):
+    manager = stand_in_manager(variables.server_instance(config))
+    manager.release_connect.set()
+
+    # The roster stage holds sql11prode while the download stage prefetches it
+    with manager.connection('sql11prode') as held:
+        manager.release_connect.clear()
+        manager.prefetch(['sql11prode'])
+    manager.release_connect.set()
+
+    with manager.connection('sql11prode') as conn:
+        assert conn is held
+
+    manager.close_all()
+
+    assert len(manager.opened) == 2
+    assert not any(is_open(conn) for conn in manager.opened)
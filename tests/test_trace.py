@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+from functions_trace import peak_rss_mb, reset_run_profile
+
+
+# A service cycle's peak RSS must not carry an earlier cycle's peak
+@pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'), reason="peak RSS can only be reset on Linux")
+def test_peak_rss_is_per_cycle_after_reset():
+    block = b'x' * (200 * 2**20)
+    before = peak_rss_mb()
+    del block
+
+    reset_run_profile()
+    after = peak_rss_mb()
+
+    assert before['self'] >= 200
+    assert after['scope'] == 'run'
+    assert after['self'] < before['self'] - 150
@@ -0,0 +1,87 @@
+import pandas as pd
+import variables
+from functions_state import (load_watermark, start_watermark, watermark_rows, retry_unmatched_rows, save_watermark,
+                             update_run_state)
+from functions_roster import enrich_emails
+from functions_sql import insert_query, correct_email, unmatched_email_rows, merge_new_rows
+
+
+# Parsed tracorp rows (as general_parse_fast leaves them)
+parsed = pd.DataFrame({'ActivityCode': ['ACT1', 'ACT1', 'ACT2'],
+                       'CompletionDate': pd.to_datetime(['2024-05-01', '2024-05-02', '2024-05-03']),
+                       'Score': [100, 90, 80],
+                       'Email': ['e1001', 'e1002', 'e1001'],
+                       'EmpID': [1001, 1002, 1001]})
+
+
+# The tracorp branch from the watermark to the merge, as main() runs it
+def run_feed(connections, tables, run_state, roster, parsed=parsed):
+    table_tmp = tables['tmp_Tracorp_Daily']
+
+    watermark = load_watermark(run_state, 'tracorp')
+    pending = start_watermark(watermark)
+    df = watermark_rows(parsed.copy(), watermark, pending)
+    df = enrich_emails(df, roster, table_tmp)
+
+    with connections.connection('local') as conn:
+        insert_query(conn, df, table_tmp)
+        correct_email(conn, table_tmp, tables['VW_EmployeeRoster'])
+        unmatched = unmatched_email_rows(conn, table_tmp)
+        merged = merge_new_rows(conn, table_tmp, tables['mastercompletions'], return_rows=True)
+
+    retry_unmatched_rows(pending, unmatched, run_state.retry_days)
+    save_watermark(run_state, 'tracorp', pending)
+
+    return merged
+
+
+def test_row_left_out_for_the_roster_is_merged_on_a_later_run(tmp_path, tables, local_connections):
+    run_state = variables.run_state_settings(path=str(tmp_path / "run_state.json"))
+
+    # 1002 is a new hire, not on the roster yet
+    merged = run_feed(local_connections, tables, run_state, pd.Series({1001: 'one@azdot.gov'}))
+    assert sorted(merged['EmpID'].tolist()) == [1001, 1001]
+    assert load_watermark(run_state, 'tracorp')['date'] == '2024-05-03'
+    assert len(load_watermark(run_state, 'tracorp')['retry']) == 1
+
+    # The roster now has them
+    merged = run_feed(local_connections, tables, run_state, pd.Series({1001: 'one@azdot.gov', 1002: 'two@azdot.gov'}))
+    assert merged['Email'].tolist() == ['two@azdot.gov']
+    assert merged['CompletionDate'].tolist() == [pd.Timestamp('2024-05-02')]
+    assert load_watermark(run_state, 'tracorp')['date'] == '2024-05-03'
+    assert load_watermark(run_state, 'tracorp')['retry'] == {}
+
+
+def test_row_never_on_the_roster_does_not_hold_the_watermark(tmp_path, tables, local_connections):
+    run_state = variables.run_state_settings(path=str(tmp_path / "run_state.json"), retry_days=30)
+    roster = pd.Series({1001: 'one@azdot.gov'})
+
+    # 1002 is a contractor, never on the roster
+    run_feed(local_connections, tables, run_state, roster)
+
+    later = pd.DataFrame({'ActivityCode': ['ACT3'], 'CompletionDate': pd.to_datetime(['2024-05-10']), 'Score': [70],
+                          'Email': ['e1001'], 'EmpID': [1001]})
+    merged = run_feed(local_connections, tables, run_state, roster, parsed=pd.concat([parsed, later], ignore_index=True))
+    assert merged['CompletionDate'].tolist() == [pd.Timestamp('2024-05-10')]
+    watermark = load_watermark(run_state, 'tracorp')
+    assert watermark['date'] == '2024-05-10'
+    assert len(watermark['retry']) == 1
+
+    # Given up retry_days after it was first left out
+    first_left_out = (pd.Timestamp.now() - pd.Timedelta(days=31)).strftime('%Y-%m-%d')
+    update_run_state(run_state, 'watermarks', 'tracorp', dict(watermark, retry={key: first_left_out for key in watermark['retry']}))
+    run_feed(local_connections, tables, run_state, roster, parsed=pd.concat([parsed, later], ignore_index=True))
+    assert load_watermark(run_state, 'tracorp')['retry'] == {}
+
+
+def test_second_blank_email_employee_on_the_watermark_day_is_not_dropped():
+    first = pd.DataFrame({'ActivityCode': ['ACT1'], 'CompletionDate': pd.to_datetime(['2024-05-03']), 'Score': [100],
+                          'Email': ['BLANK'], 'EmpID': [1001]})
+    pending = start_watermark(None)
+    watermark_rows(first, None, pending)
+    watermark = {'date': '2024-05-03', 'keys': sorted(pending['keys'])}
+
+    # A later export adds a second employee without an email, same activity and day
+    later = pd.concat([first, first.assign(EmpID=[1002])], ignore_index=True)
+    df = watermark_rows(later, watermark, start_watermark(watermark))
+    assert df['EmpID'].tolist() == [1002]
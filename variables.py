@@ -1,12 +1,4 @@
-import glob
-import os.path
-import csv
-import pandas as pd
-from datetime import date, datetime, timedelta
-import pyodbc
-import logging
-import argparse
-import configparser
+from datetime import date, datetime
 
 
 today = date.today()
@@ -23,7 +15,7 @@ class sql_server:
         self.auth = auth
 
 class sql_tables:
-    def __init__(self, name, database, path, table_type, key_email, key_activity, key_date):
+    def __init__(self, name, database, path, table_type, key_email, key_activity, key_date, batch_size):
         self.name = name
         self.database = database
         self.path = path
@@ -31,31 +23,117 @@ class sql_tables:
         self.key_email = key_email
         self.key_activity = key_activity
         self.key_date = key_date
+        self.batch_size = batch_size
 
 class raw_file:
-    def __init__(self, path, name, csv_true, nickname, delimiter, fileType):
+    def __init__(self, path, name, csv_true, nickname, delimiter, fileType, chunksize=0, cache_dir='', date_format='', stream=False, stream_archive=False):
         self.path = path
         self.name = name
         self.csv_true = csv_true
         self.nickname = nickname
         self.delimiter = delimiter
         self.fileType = fileType
+        self.chunksize = chunksize
+        self.cache_dir = cache_dir
+        self.date_format = date_format
+        self.stream = stream
+        self.stream_archive = stream_archive
 
 
 class sftp_settings:
-    def __init__(self, sftpurl, username, key, file):
+    def __init__(self, sftpurl, username, key, file, port=22, known_hosts='', name=''):
+        self.name = name
         self.sftpurl = sftpurl
         self.username = username
         self.key = key
         self.file = file
+        self.port = port
+        self.known_hosts = known_hosts
+
+
+class key_index_settings:
+    def __init__(self, enabled, path):
+        self.enabled = enabled
+        self.path = path
+
+
+class catalog_settings:
+    def __init__(self, source, path, query, ttl):
+        self.source = source
+        self.path = path
+        self.query = query
+        self.ttl = ttl
+
+
+class roster_settings:
+    def __init__(self, enabled, path, ttl, delta_column):
+        self.enabled = enabled
+        self.path = path
+        self.ttl = ttl
+        self.delta_column = delta_column
+
+
+class run_state_settings:
+    def __init__(self, path, partial_path='state/partial', retry_days=30):
+        self.path = path
+        self.partial_path = partial_path
+        self.retry_days = retry_days
+
+
+class local_store_settings:
+    def __init__(self, path):
+        self.path = path
+
+
+class archive_settings:
+    def __init__(self, path, retention_days, compression):
+        self.path = path
+        self.retention_days = retention_days
+        self.compression = compression
+
+
+# Output template column - copied from source, formatted from a date source, or a constant
+class template_column:
+    def __init__(self, name, source=None, value=None, date_format=None):
+        self.name = name
+        self.source = source
+        self.value = value
+        self.date_format = date_format
+
+
+class service_settings:
+    def __init__(self, poll_interval, health_host, health_port):
+        self.poll_interval = poll_interval
+        self.health_host = health_host
+        self.health_port = health_port
+
+
+# Completions feed - references its SFTP section, input file (nickname) and tmp table (name)
+class feed_settings:
+    def __init__(self, name, sftp, file, table, enrich=False, export=False, upload='', file_out_csv='', file_out_txt='',
+                 merge_after=(), max_concurrency=2):
+        self.name = name
+        self.sftp = sftp
+        self.file = file
+        self.table = table
+        self.enrich = enrich
+        self.export = export
+        self.upload = upload
+        self.file_out_csv = file_out_csv
+        self.file_out_txt = file_out_txt
+        self.merge_after = list(merge_after)
+        self.max_concurrency = max_concurrency
 
 
 class smtp_settings:
-    def __init__(self, server, port, addressFrom , addressTo):
+    def __init__(self, server, port, addressFrom , addressTo, starttls=True, max_attachment_mb=10, keep_bundle_days=14):
         self.server = server
         self.port = port
         self.addressFrom = addressFrom
         self.addressTo = addressTo
+        self.starttls = starttls
+        self.max_attachment_mb = max_attachment_mb
+        self.keep_bundle_days = keep_bundle_days
 
 
 
@@ -88,7 +166,8 @@ def table_instance(config):
                                 table_type= table_config['table_type'],
                                 key_email= table_config['key_email'],
                                 key_activity= table_config['key_activity'],
-                                key_date= table_config['key_date'])
+                                key_date= table_config['key_date'],
+                                batch_size= table_config.getint('batch_size', fallback=1000))
             tables.append(table)
     return tables
 
@@ -104,7 +183,12 @@ def io_file_instance(config):
                                 csv_true= file_config['IsCsv'],
                                 nickname= file_config['nickname'],
                                 delimiter= file_config['delimiter'],
-                                fileType= file_config['type'])
+                                fileType= file_config['type'],
+                                chunksize= file_config.getint('chunksize', fallback=0),
+                                cache_dir= file_config.get('cache_dir', fallback=''),
+                                date_format= file_config.get('date_format', fallback='', raw=True),
+                                stream= file_config.getboolean('stream', fallback=False),
+                                stream_archive= file_config.getboolean('stream_archive', fallback=False))
             io_files.append(io_file)
     return io_files
 
@@ -119,12 +203,134 @@ def sftp_instance(config):
             sftp_info = sftp_settings(sftpurl= sftp_config['sftpurl'],
                                     username= sftp_config['username'],
                                     key= sftp_config['key'],
-                                    file= sftp_config['file'])
+                                    file= sftp_config['file'],
+                                    port= sftp_config.getint('port', fallback=22),
+                                    known_hosts= sftp_config.get('known_hosts', fallback=''),
+                                    name= key)
             sftp_infos.append(sftp_info)
     return sftp_infos
 
 
 
+# # Key Index Settings
+def key_index_instance(config):
+    key_indexes = []
+    for key in config.sections():
+        if key.startswith('key_index'):
+            index_config = config[key]
+            key_index = key_index_settings(enabled= index_config.getboolean('enabled', fallback=False),
+                                            path= index_config['path'])
+            key_indexes.append(key_index)
+    return key_indexes
+
+
+
+# # Activity Catalog Settings
+def catalog_instance(config):
+    catalogs = []
+    for key in config.sections():
+        if key.startswith('activity_catalog'):
+            catalog_config = config[key]
+            catalog = catalog_settings(source= catalog_config.get('source', fallback='list'),
+                                        path= catalog_config.get('path', fallback=''),
+                                        query= catalog_config.get('query', fallback=''),
+                                        ttl= catalog_config.getint('ttl', fallback=3600))
+            catalogs.append(catalog)
+    return catalogs
+
+
+
+# # Roster Cache Settings
+def roster_instance(config):
+    rosters = []
+    for key in config.sections():
+        if key.startswith('roster_cache'):
+            roster_config = config[key]
+            roster = roster_settings(enabled= roster_config.getboolean('enabled', fallback=False),
+                                    path= roster_config['path'],
+                                    ttl= roster_config.getint('ttl', fallback=86400),
+                                    delta_column= roster_config.get('delta_column', fallback=''))
+            rosters.append(roster)
+    return rosters
+
+
+
+# # Run State Settings
+def run_state_instance(config):
+    run_states = []
+    for key in config.sections():
+        if key.startswith('run_state'):
+            state_config = config[key]
+            run_state = run_state_settings(path= state_config['path'],
+                                           partial_path= state_config.get('partial_path', 'state/partial') or 'state/partial',
+                                           retry_days= state_config.getint('retry_days', 30))
+            run_states.append(run_state)
+    return run_states
+
+
+
+# # Local Store Settings
+def local_store_instance(config):
+    local_stores = []
+    for key in config.sections():
+        if key.startswith('local_store'):
+            store_config = config[key]
+            local_store = local_store_settings(path= store_config['path'])
+            local_stores.append(local_store)
+    return local_stores
+
+
+
+# # Archive Settings
+def archive_instance(config):
+    archives = []
+    for key in config.sections():
+        if key.startswith('archive'):
+            archive_config = config[key]
+            archive = archive_settings(path= archive_config['path'],
+                                        retention_days= archive_config.getint('retention_days', fallback=365),
+                                        compression= archive_config.get('compression', fallback='auto'))
+            archives.append(archive)
+    return archives
+
+
+
+# # Feeds
+def feed_instance(config):
+    feeds = []
+    for key in config.sections():
+        if key.startswith('feed_'):
+            feed_config = config[key]
+            feed = feed_settings(name= key[len('feed_'):],
+                                sftp= feed_config['sftp'],
+                                file= feed_config['file'],
+                                table= feed_config['table'],
+                                enrich= feed_config.getboolean('enrich', fallback=False),
+                                export= feed_config.getboolean('export', fallback=False),
+                                upload= feed_config.get('upload', fallback=''),
+                                file_out_csv= feed_config.get('file_out_csv', fallback=''),
+                                file_out_txt= feed_config.get('file_out_txt', fallback=''),
+                                merge_after= feed_config.get('merge_after', fallback='').split(),
+                                max_concurrency= feed_config.getint('max_concurrency', fallback=2))
+            feeds.append(feed)
+    return feeds
+
+
+
+# # Service Settings
+def service_instance(config):
+    services = []
+    for key in config.sections():
+        if key.startswith('service'):
+            service_config = config[key]
+            service = service_settings(poll_interval= service_config.getint('poll_interval', fallback=900),
+                                        health_host= service_config.get('health_host', fallback='127.0.0.1'),
+                                        health_port= service_config.getint('health_port', fallback=0))
+            services.append(service)
+    return services
+
+
+
 # # SMTP Settings
 def smtp_instance(config):
     smtp_infos = []
@@ -134,7 +340,10 @@ def smtp_instance(config):
             smtp_info = smtp_settings(server=smtp_config['smtpserver'],
                                         port=smtp_config['port'],
                                         addressFrom=smtp_config['from'],
-                                        addressTo=smtp_config['to'])
+                                        addressTo=smtp_config['to'],
+                                        starttls=smtp_config.getboolean('starttls', fallback=True),
+                                        max_attachment_mb=smtp_config.getfloat('max_attachment_mb', fallback=10),
+                                        keep_bundle_days=smtp_config.getint('keep_bundle_days', fallback=14))
             smtp_infos.append(smtp_info)
     return smtp_infos
 
@@ -147,6 +356,113 @@ def smtp_instance(config):
 
 
 
+# # Config check (--check-config) - list of problems, empty when main() can run with this config
+def check_config(config):
+
+    if config is None or not config.sections():
+        return ["No sections found (missing or unreadable config file?)"]
+
+    problems = []
+
+    # Every section parses, and there are as many of each as main() picks out
+    required = [(server_instance, 'sql_server_*', 2), (table_instance, 'sql_table_*', 4), (io_file_instance, 'file_*', 1),
+                (sftp_instance, 'SFTP*', 1), (feed_instance, 'feed_*', 1), (key_index_instance, 'key_index*', 1),
+                (catalog_instance, 'activity_catalog*', 1), (roster_instance, 'roster_cache*', 1),
+                (run_state_instance, 'run_state*', 1), (archive_instance, 'archive*', 1), (service_instance, 'service*', 0),
+                (local_store_instance, 'local_store*', 1),
+                (smtp_instance, 'Email*', 1)]
+    instances = {}
+    for instance_function, sections, minimum in required:
+        try:
+            instances[sections] = instance_function(config)
+        except (KeyError, ValueError) as e:
+            problems.append(f"[{sections}] {type(e).__name__}: {e}")
+            instances[sections] = []
+            continue
+        if len(instances[sections]) < minimum:
+            problems.append(f"[{sections}] {len(instances[sections])} section(s), at least {minimum} needed")
+
+    # Feed references
+    files = {io_file.nickname for io_file in instances['file_*']}
+    tables = {table.name for table in instances['sql_table_*']}
+    sftps = {sftp_info.name for sftp_info in instances['SFTP*']}
+    feeds = {feed.name for feed in instances['feed_*']}
+    for feed in instances['feed_*']:
+        references = [('sftp', feed.sftp, sftps), ('file', feed.file, files), ('table', feed.table, tables)]
+        if feed.export:
+            references += [('upload', feed.upload, sftps), ('file_out_csv', feed.file_out_csv, files),
+                           ('file_out_txt', feed.file_out_txt, files)]
+        references += [('merge_after', name, feeds) for name in feed.merge_after]
+        for option, value, known in references:
+            if value not in known:
+                problems.append(f"[feed_{feed.name}] {option} = {value!r} matches no section")
+
+    for service in instances['service*']:
+        if service.poll_interval <= 0:
+            problems.append(f"[service] poll_interval must be positive, not {service.poll_interval}")
+
+    return problems
+
+
+
+
+# Feed column mappings (general_parse_fast)
+# output column -> source columns to try, keyed by file nickname
+# (feeds without their own entry use "default")
+feed_column_maps = {
+    "default": {
+        "Status": ["Status"],
+        "ActivityCode": ["Activity Code", "ActivityCode"],
+        "CompletionDate": ["Completion Date", "CompletionDate"],
+        "Score": ["Score"],
+        "Email": ["Student ID", "Student Email"],
+        "EmpID": ["Student Username"]}}
+
+
+
+
+# Column dtypes at every stage boundary (apply_schema)
+# 'string' is Arrow-backed when pyarrow is installed; int scores are 0 when missing
+frame_schema = {
+    "ActivityCode": "category",
+    "Email": "string",
+    "Email_adotmaster": "string",
+    "EmpID": "Int64",
+    "CompletionDate": "datetime64[ns]",
+    "Score": "int32"}
+
+
+
+
+# SumTotal upload record layout (final_parse / export_files)
+sumtotal_template = [
+    template_column('EmployeeNumber', source='Email'),
+    template_column('ActivityCode', source='ActivityCode'),
+    template_column('ClassStartDate'),
+    template_column('RegistrationDate'),
+    template_column('CompletionDate', source='CompletionDate', date_format='%m/%d/%Y 09:00'),
+    template_column('FirstLaunchDate'),
+    template_column('Score', source='Score'),
+    template_column('Passed', value=1),
+    template_column('CancellationDate'),
+    template_column('PaymentTerm'),
+    template_column('Cost'),
+    template_column('Currency'),
+    template_column('Timezone', value='America/Phoenix'),
+    template_column('Status', value=4),
+    template_column('Notes'),
+    template_column('SubscriptionSourceActivityCode'),
+    template_column('SubscriptionSourceActivityStartDate'),
+    template_column('ElapsedTime'),
+    template_column('CompletionStatus', value=1),
+    template_column('Location_Name'),
+    template_column('Slotstart_Date'),
+    template_column('Slotend_Date'),
+    template_column('EmpID', source='EmpID')]
+
+
+
+
 # Activities
 active_activities = {
     "ActivityCode": ["ADAPPAB100W","ADAPPRQ200W","ADAPPRQ210W","ADAPPRQ220W",
@@ -161,6 +477,3 @@ active_activities = {
                     "MGT1005","MGT1006","MGT1007","PCI0002","PCI0003",
                     "PCI0004","PCI0005","RM29","SPSORI100","SPSPERFAPP",
                     "TRP1001","TRP1002","TRP1003","TRP1004","TRVPOL"]}
-
-
-df_active_activities = pd.DataFrame(active_activities)
\ No newline at end of file